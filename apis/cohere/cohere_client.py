@@ -1,34 +1,144 @@
+import hashlib
+import threading
+
 import cohere
+import numpy as np
 from cohere.classify import Example
 
+from common.embedding_cache import get_embedding_cache
+from common.instrumentation import instrumented
+from common.lru_cache import LRUCache
+from common.retry import retry_call
+from .embedding_executor import EmbeddingExecutor
+
+# Model of the moderation classifier
+MODERATION_MODEL = "large"
+# Number of moderation labels kept in memory
+MODERATION_CACHE_SIZE = 100_000
+# How comments are classified: "remote" with the classify endpoint, "local" by similarity to the embedded examples
+MODERATION_MODE = "remote"
+# In local mode, comments whose two most similar labels are closer than this are sent to the classify endpoint
+MODERATION_MARGIN = 0.02
+# Version of the local moderation centroids, to be increased whenever the examples or their embeddings change
+MODERATION_CENTROIDS_VERSION = 1
+# Version of the summarization prompt, to be increased whenever the prompt changes
+SUMMARY_PROMPT_VERSION = 1
+# Generation parameters of the summaries
+SUMMARY_GENERATION_PARAMS = {
+    "model": "xlarge",
+    "max_tokens": 100,
+    "temperature": 0.3,
+    "k": 3,
+    "p": 0,
+    "frequency_penalty": 1,
+    "presence_penalty": 0,
+    "stop_sequences": ["||"],
+}
+# Few-shot examples of the moderation classifier
+MODERATION_EXAMPLES = [
+    Example("This is dumb", "inappropriate"),
+    Example("💩", "inappropriate"),
+    Example("This is 💩", "inappropriate"),
+    Example("This is stupid", "negative"),
+    Example("You are ugly", "negative"),
+    Example("This video is beautiful", "appropriate"),
+    Example("This is amazing", "appropriate"),
+    Example("This is horrible", "negative"),
+    Example("Lovely video", "appropriate"),
+    Example("Edmunds is like conjob reports and is skewing data for tesla.  Also the XLE doesn’t compare to the Tesla, so the real numbers will be better for Tesla.", "neutral"),
+    Example("It is extremely rare that the batteries ever fail.  Statistically it is more likely to have an ice engine seize up.", "neutral"),
+    Example("Factor in Toyota reliability, fit and finish, resale and dealer support. Every Tesla I\'ve seen has had horrid quality issues and plagued with constant niggles.", "neutral"),
+    Example("Not realistic assumptions. Should use Tesla insurance. Should use more like 30k miles per year. Gas price is much higher in California. Most people keep car for more than 5 years. Also what about the cost to the environment and the cost saved to Tesla being a safer car.", "neutral"),
+    Example("Prius gets 57 mpg. as an owner of two Priuses. Not true and is baloney. oil change every 5k, 2 hours x 15 = 30 hours(75k miles.). Pumping gas once a week, 15 minutes x 52 weeks x 5 years = 65 hours. vs model 3 charge at home and no oil change. 30+65/24=3.95 days. Lost almost four days of time just pumping gas and oil change. Best of all. all Teslas are some of the safest vehicles on the road today. Who is SPAN?", "neutral"),
+    Example("Factor in range, and I’ll go with the Prius", "neutral"),
+    Example("Prius is not the luxury car how can you compare with any tesla", "neutral"),
+    Example("Great video as usual. Not doubting it drives well, but Mercedes has really messed up the design, don\'t know what\'s happening in their studio but it just looks really really odd. Inside and especially out.", "appropriate"),
+    Example("Wow, so tiny in the backseats. Very disappointing imo. No car for carrying tall people in the back. Not good for a car that is 4.72 meters long, bad package. But great review as allways thomas!", "neutral"),
+    Example("air suspension???....not for me...", "appropriate"),
+    Example("I remember back in the days Thomas said he was 186cm. Has Thomas grown taller??", "neutral"),
+    Example("I think Mercedes has lost some of it\'s charm", "neutral"),
+    Example("Agreed. This looks less sleek and more boxy mixed with a child’s idea of sporty.", "neutral"),
+    Example("I think the opposite is the case. Especially the interior has improved quite a bit in style.", "appropriate"),
+    Example("long ago, the absolute cheap plastic elements they use is shocking, the new GLE headlight knob is so shocking and cheap that I refuse to buy the brand period. Afer 20yrs they have lost me as a customer. I\'m shocked to say that a BMW interior is better quality than Mercedes.", "neutral"),
+    Example("You can say it “ a lot “", "neutral"),
+    Example("Yh Mercedes is no longer sleek", "neutral"),
+    Example("Front grill looks the cheapest to date on a merc. Interior is full of shiny plastic (piano black), big screens do not look expensive,... Not to speak about the fake exhaust.", "appropriate"),
+    Example("Mercedes\' cars have, over the years, had many, many attributes. Charm has never been one of them.", "neutral"),
+    Example("Bmw is miles ahead in terms of design and interior", "appropriate"),
+    Example("A LOT of its charm... The interiors are chasing after the bling-bling market, the opposite of what I associate with the brand. Also, every new incarnation bigger than the last. When will this madness end? If I wanted to be a bus driver I would buy a bus.", "neutral"),
+    Example("Your videos are great thanks for doing this for us all for so long!!! ", "appropriate"),
+    Example("And by the way those people they were making fun of you they’re jealous", "appropriate"),
+    Example("you know i have a red car and when i\'m wearing green i think to myself i don\'t really go with my car color today.....haha", "neutral"),
+    Example("This is shit", "inappropriate"),
+    Example("The offroad see through camera looks interesting", "appropriate"),
+    Example("Good video.", "appropriate"),
+    Example("I love German cars.....but Mercedes quality ranking is bad here in America currently; don\'t know if that\'s a domestic production issue or what?", "neutral"),
+    Example("Lovely car. Won’t buy mercedes though. It’s cheaply made and old Skool brand . Audi and Porsche so much better", "neutral"),
+    Example("Was looking forward to this review!", "appropriate"),
+    Example("This is crap", "negative"),
+    Example("looks like crap", "negative"),
+    Example("how 💩", "negative"),
+    Example("very much 💩", "negative"),
+    Example("a lot of 💩", "negative"),
+    Example("looks horrible", "negative"),
+]
+
 
+@instrumented("cohere")
 class CohereClient:
-    def __init__(self):
+    def __init__(self, embedding_cache=None, moderation_mode=MODERATION_MODE, client=None):
         """
         Initialize the Cohere client.
 
+        Parameters:
+            embedding_cache (EmbeddingCache | None): cache used by embed, defaults to the process-wide cache
+            moderation_mode (str): "remote" or "local", see classify_comments
+            client: object with the embed / classify / generate methods of cohere.Client used instead of it (for
+                example a local stand-in in the benchmarks)
         """
-        self.co = cohere.Client("YOUR_API_KEY")
+        self.co = client or cohere.Client("YOUR_API_KEY")
+        self.embedding_cache = embedding_cache or get_embedding_cache()
+        self.embedding_executor = EmbeddingExecutor(self._embed_batch, retryable=_is_retryable,
+                                                    splittable=_is_payload_error)
+        self.moderation_executor = EmbeddingExecutor(self._classify_batch, retryable=_is_retryable,
+                                                     splittable=_is_payload_error)
+        self.moderation_cache = LRUCache(max_size=MODERATION_CACHE_SIZE)
+        self.moderation_mode = moderation_mode
+        self._moderation_centroids = None
+        self._moderation_lock = threading.Lock()
 
     def embed(self, texts, model="large", truncate="NONE"):
         """
-        Embed the list of texts.
+        Embed the list of texts. Texts that were already embedded with the same model and truncate mode are
+        served from the embedding cache.
+
+        Parameters:
+            texts (list[str]): An array of strings for the model to embed
+            truncate (str): NONE|START|END, specifies how the API will handle inputs longer than the maximum token length
+
+        Returns:
+            float32 NumPy matrix with one embedding vector per text
+        """
+        return self.embedding_cache.embed(
+            texts, model, truncate, lambda missing_texts: self._embed_batches(missing_texts, model, truncate)
+        )
+
+    def _embed_batches(self, texts, model, truncate):
+        """
+        Embed the list of texts with the Cohere API, with several batches in parallel.
 
         Parameters:
             texts (list[str]): An array of strings for the model to embed
+            model (str): the embedding model
             truncate (str): NONE|START|END, specifies how the API will handle inputs longer than the maximum token length
 
         Returns:
-            list of vectors represint
+            list of embedding vectors, in the same order as the texts
         """
-        embeds = []
-        batch_size = 96
-        for i in range(0, len(texts), batch_size):
-            response = self.co.embed(
-                model=model, texts=texts[i : i + batch_size], truncate=truncate
-            ).embeddings
-            embeds.extend(response)
-        return embeds
+        return self.embedding_executor.embed(texts, model=model, truncate=truncate)
+
+    def _embed_batch(self, texts, model, truncate):
+        return self.co.embed(model=model, texts=texts, truncate=truncate).embeddings
 
     def check_comments_are_appropriate(self, texts):
         """
@@ -38,66 +148,88 @@ class CohereClient:
             texts (list): The text to be checked.
 
         Returns:
-            bool: True if the comment is appropriate, False otherwise.
+            list[str]: the moderation label of every text (appropriate, inappropriate, negative or neutral)
+        """
+        return self.classify_comments(texts)
+
+    def classify_comments(self, texts, embeddings=None):
+        """
+        Classifies comments with the moderation classifier. Labels are cached by moderation mode and text hash,
+        only the texts that were never classified in the current mode are classified.
+
+        In remote mode the texts are sent to the classify endpoint, in concurrent batches. In local mode every
+        comment gets the label whose examples centroid is the most similar to its embedding, with one matrix
+        product, and only the comments with a margin below MODERATION_MARGIN are sent to the classify endpoint.
+
+        Parameters:
+            texts (list[str]): the comments to classify
+            embeddings (numpy.ndarray | None): embeddings of the texts in local mode, computed when not given
+
+        Returns:
+            list[str]: the moderation label of every text, in the same order
+        """
+        keys = [_moderation_key(text, self.moderation_mode) for text in texts]
+        labels = [self.moderation_cache.get(key) for key in keys]
+        missing = {}
+        for i, (key, label) in enumerate(zip(keys, labels)):
+            if label is None:
+                missing.setdefault(key, i)
+        if missing:
+            missing_texts = [texts[i] for i in missing.values()]
+            if self.moderation_mode == "local":
+                missing_embeddings = None if embeddings is None else np.asarray(embeddings)[list(missing.values())]
+                predictions = self._classify_locally(missing_texts, missing_embeddings)
+            else:
+                predictions = self._classify_remotely(missing_texts)
+            predictions = dict(zip(missing, predictions))
+            for key, prediction in predictions.items():
+                self.moderation_cache.put(key, prediction)
+            labels = [predictions[key] if label is None else label for key, label in zip(keys, labels)]
+        return labels
+
+    def _classify_remotely(self, texts):
+        # the batching, rate limiting and retries of the embedding executor also fit classify requests
+        return self.moderation_executor.run(texts)
+
+    def _classify_locally(self, texts, embeddings=None):
+        """
+        Labels texts by cosine similarity between their embeddings and the centroids of the embedded examples of
+        every label. Low-margin texts are classified remotely.
+        """
+        if embeddings is None:
+            embeddings = self.embed(texts=texts)
+        label_names, centroids = self._get_moderation_centroids()
+        scores = _unit_rows(np.asarray(embeddings, dtype=np.float32)) @ centroids.T
+        ranking = np.argsort(-scores, axis=1)
+        rows = np.arange(len(texts))
+        margins = scores[rows, ranking[:, 0]] - scores[rows, ranking[:, 1]]
+        predictions = [label_names[i] for i in ranking[:, 0]]
+        uncertain = np.flatnonzero(margins < MODERATION_MARGIN)
+        if len(uncertain):
+            for i, prediction in zip(uncertain, self._classify_remotely([texts[i] for i in uncertain])):
+                predictions[i] = prediction
+        return predictions
+
+    def _get_moderation_centroids(self):
+        """
+        Returns the moderation labels and the normalized centroid of the embedded examples of every label, the
+        examples are embedded once.
         """
-        response = self.co.classify(
-            model='large',
-            inputs=texts,
-            examples=[Example("This is dumb", "inappropriate"), Example("💩", "inappropriate"),
-                      Example("This is 💩", "inappropriate"), Example("This is stupid", "negative"),
-                      Example("You are ugly", "negative"), Example("This video is beautiful", "appropriate"),
-                      Example("This is amazing", "appropriate"), Example("This is horrible", "negative"),
-                      Example("Lovely video", "appropriate"), Example(
-                    "Edmunds is like conjob reports and is skewing data for tesla.  Also the XLE doesn’t compare to the Tesla, so the real numbers will be better for Tesla.",
-                    "neutral"), Example(
-                    "It is extremely rare that the batteries ever fail.  Statistically it is more likely to have an ice engine seize up.",
-                    "neutral"), Example(
-                    "Factor in Toyota reliability, fit and finish, resale and dealer support. Every Tesla I\'ve seen has had horrid quality issues and plagued with constant niggles.",
-                    "neutral"), Example(
-                    "Not realistic assumptions. Should use Tesla insurance. Should use more like 30k miles per year. Gas price is much higher in California. Most people keep car for more than 5 years. Also what about the cost to the environment and the cost saved to Tesla being a safer car.",
-                    "neutral"), Example(
-                    "Prius gets 57 mpg. as an owner of two Priuses. Not true and is baloney. oil change every 5k, 2 hours x 15 = 30 hours(75k miles.). Pumping gas once a week, 15 minutes x 52 weeks x 5 years = 65 hours. vs model 3 charge at home and no oil change. 30+65/24=3.95 days. Lost almost four days of time just pumping gas and oil change. Best of all. all Teslas are some of the safest vehicles on the road today. Who is SPAN?",
-                    "neutral"), Example("Factor in range, and I’ll go with the Prius", "neutral"),
-                      Example("Prius is not the luxury car how can you compare with any tesla", "neutral"), Example(
-                    "Great video as usual. Not doubting it drives well, but Mercedes has really messed up the design, don\'t know what\'s happening in their studio but it just looks really really odd. Inside and especially out.",
-                    "appropriate"), Example(
-                    "Wow, so tiny in the backseats. Very disappointing imo. No car for carrying tall people in the back. Not good for a car that is 4.72 meters long, bad package. But great review as allways thomas!",
-                    "neutral"), Example("air suspension???....not for me...", "appropriate"),
-                      Example("I remember back in the days Thomas said he was 186cm. Has Thomas grown taller??",
-                              "neutral"), Example("I think Mercedes has lost some of it\'s charm", "neutral"),
-                      Example("Agreed. This looks less sleek and more boxy mixed with a child’s idea of sporty.",
-                              "neutral"), Example(
-                    "I think the opposite is the case. Especially the interior has improved quite a bit in style.",
-                    "appropriate"), Example(
-                    "long ago, the absolute cheap plastic elements they use is shocking, the new GLE headlight knob is so shocking and cheap that I refuse to buy the brand period. Afer 20yrs they have lost me as a customer. I\'m shocked to say that a BMW interior is better quality than Mercedes.",
-                    "neutral"), Example("You can say it “ a lot “", "neutral"),
-                      Example("Yh Mercedes is no longer sleek", "neutral"), Example(
-                    "Front grill looks the cheapest to date on a merc. Interior is full of shiny plastic (piano black), big screens do not look expensive,... Not to speak about the fake exhaust.",
-                    "appropriate"), Example(
-                    "Mercedes\' cars have, over the years, had many, many attributes. Charm has never been one of them.",
-                    "neutral"), Example("Bmw is miles ahead in terms of design and interior", "appropriate"), Example(
-                    "A LOT of its charm... The interiors are chasing after the bling-bling market, the opposite of what I associate with the brand. Also, every new incarnation bigger than the last. When will this madness end? If I wanted to be a bus driver I would buy a bus.",
-                    "neutral"),
-                      Example("Your videos are great thanks for doing this for us all for so long!!! ", "appropriate"),
-                      Example("And by the way those people they were making fun of you they’re jealous", "appropriate"),
-                      Example(
-                          "you know i have a red car and when i\'m wearing green i think to myself i don\'t really go with my car color today.....haha",
-                          "neutral"), Example("This is shit", "inappropriate"),
-                      Example("The offroad see through camera looks interesting", "appropriate"),
-                      Example("Good video.", "appropriate"), Example(
-                    "I love German cars.....but Mercedes quality ranking is bad here in America currently; don\'t know if that\'s a domestic production issue or what?",
-                    "neutral"), Example(
-                    "Lovely car. Won’t buy mercedes though. It’s cheaply made and old Skool brand . Audi and Porsche so much better",
-                    "neutral"), Example("Was looking forward to this review!", "appropriate"),
-                      Example("This is crap", "negative"), Example("looks like crap", "negative"),
-                      Example("how 💩", "negative"), Example("very much 💩", "negative"),
-                      Example("a lot of 💩", "negative"), Example("looks horrible", "negative")])
-        processed_responses = [comment.prediction for comment in response]
-        return processed_responses
+        with self._moderation_lock:
+            if self._moderation_centroids is None:
+                embeddings = _unit_rows(self.embed(texts=[example.text for example in MODERATION_EXAMPLES]))
+                example_labels = np.array([example.label for example in MODERATION_EXAMPLES])
+                label_names = sorted({example.label for example in MODERATION_EXAMPLES})
+                centroids = np.stack([embeddings[example_labels == label].mean(axis=0) for label in label_names])
+                self._moderation_centroids = (label_names, _unit_rows(centroids))
+            return self._moderation_centroids
+
+    def _classify_batch(self, texts):
+        response = self.co.classify(model=MODERATION_MODEL, inputs=texts, examples=MODERATION_EXAMPLES)
+        return [comment.prediction for comment in response]
 
     def summarize_comments(self, comments):
-        response = self.co.generate(
-            model='xlarge',
+        response = retry_call(lambda: self.co.generate(
             prompt=f"""Summarize these comments: 
         '@YearningFoSkins i think Magnus offered a draw',
         'At that time Magnus was having stomach issues so he offered a draw',
@@ -190,13 +322,41 @@ class CohereClient:
         {comments}
         -TLDR:
         """,
-            max_tokens=100,
-            temperature=0.3,
-            k=3,
-            p=0,
-            frequency_penalty=1,
-            presence_penalty=0,
-            stop_sequences=["||"],
-        )
+            **SUMMARY_GENERATION_PARAMS,
+        ), retryable=_is_retryable)
         comments_summary = response.generations[0].text.replace('||', '')
         return comments_summary
+
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _moderation_key(text, mode):
+    """
+    Cache key of the moderation label of a text. Local labels also depend on the centroids and on the margin under
+    which the classify endpoint decides.
+    """
+    if mode == "local":
+        classifier = f"local\0{MODERATION_CENTROIDS_VERSION}\0{MODERATION_MARGIN}\0{MODERATION_MODEL}"
+    else:
+        classifier = f"remote\0{MODERATION_MODEL}"
+    return hashlib.sha256(f"{classifier}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _is_retryable(error):
+    """
+    Client errors (invalid key, invalid request, ...) are not retried, rate limiting and server errors are.
+    """
+    status = getattr(error, "http_status", None)
+    return status is None or status == 429 or status >= 500
+
+
+def _is_payload_error(error):
+    """
+    Invalid requests and payloads that are too large are caused by the texts of the request, a smaller request
+    without the faulty text can succeed.
+    """
+    return getattr(error, "http_status", None) in (400, 413)
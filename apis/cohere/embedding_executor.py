@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from common.instrumentation import instrumented, propagate_context
+from common.rate_limiter import RateLimiter
+from common.retry import retry_call
+
+# Maximum number of texts accepted by one embed request
+MAX_BATCH_TEXTS = 96
+# Maximum number of characters sent in one embed request
+MAX_BATCH_CHARS = 96 * 1024
+# Number of embed requests running at the same time
+EMBED_MAX_WORKERS = 4
+# Maximum number of embed requests started per second
+EMBED_REQUESTS_PER_SECOND = 10
+
+
+@instrumented("embedding_executor")
+class EmbeddingExecutor:
+    """
+    Embeds texts with several concurrent batch requests. The batch function can be any request that returns one
+    result per text, run calls it the same way (the moderation classifier uses it for classify requests).
+
+    Texts are packed into batches bounded both by number of texts and by number of characters, the batches run
+    in a thread pool under a request rate limit and every batch is retried with backoff. A batch rejected because
+    of its content (see splittable) is split in two and each half is sent on its own, so one oversized or rejected
+    text does not fail the whole request; other errors fail the request once the retries are exhausted. The
+    returned vectors are always in the same order as the texts.
+    """
+
+    def __init__(self, embed_batch, max_workers=EMBED_MAX_WORKERS, requests_per_second=EMBED_REQUESTS_PER_SECOND,
+                 max_batch_texts=MAX_BATCH_TEXTS, max_batch_chars=MAX_BATCH_CHARS, retryable=None, splittable=None):
+        """
+        Initializes the executor.
+
+        Parameters:
+            embed_batch (callable): embeds a list of texts with one request and returns their vectors, it also
+                receives the request options passed to embed as keyword arguments
+            max_workers (int): number of batches embedded at the same time
+            requests_per_second (float | None): maximum number of requests started per second
+            max_batch_texts (int): maximum number of texts per request
+            max_batch_chars (int): maximum number of characters per request
+            retryable (callable | None): returns False for exceptions that should not be retried
+            splittable (callable | None): returns True for exceptions caused by the content of a batch (bad request,
+                payload too large), whose batch is split and sent again in halves. None never splits
+        """
+        self.embed_batch = embed_batch
+        self.max_workers = max_workers
+        self.max_batch_texts = max_batch_texts
+        self.max_batch_chars = max_batch_chars
+        self.retryable = retryable
+        self.splittable = splittable
+        self._rate_limiter = RateLimiter(requests_per_second)
+
+    def pack_batches(self, texts):
+        """
+        Splits texts into consecutive batches that respect the text and character budgets.
+
+        Parameters:
+            texts (list[str]): texts to embed
+
+        Returns:
+            a list of (start, stop) index ranges
+        """
+        batches = []
+        start = 0
+        batch_chars = 0
+        for i, text in enumerate(texts):
+            if i > start and (i - start == self.max_batch_texts or batch_chars + len(text) > self.max_batch_chars):
+                batches.append((start, i))
+                start = i
+                batch_chars = 0
+            batch_chars += len(text)
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def _embed_with_retry(self, texts, request_options):
+        def request():
+            self._rate_limiter.acquire()
+            return list(self.embed_batch(texts, **request_options))
+
+        try:
+            return retry_call(request, retryable=self.retryable)
+        except Exception as e:
+            # splitting only helps when a text of the batch is the problem, not when the service is failing
+            if len(texts) == 1 or self.splittable is None or not self.splittable(e):
+                raise
+            middle = len(texts) // 2
+            return self._embed_with_retry(texts[:middle], request_options) + self._embed_with_retry(
+                texts[middle:], request_options
+            )
+
+    def embed(self, texts, **request_options):
+        """
+        Embeds texts.
+
+        Parameters:
+            texts (list[str]): texts to embed
+            request_options: keyword arguments forwarded to embed_batch (model, truncate, ...)
+
+        Returns:
+            a list of vectors, in the same order as texts
+        """
+        return self.run(texts, **request_options)
+
+    def run(self, texts, **request_options):
+        """
+        Sends texts to the batch function.
+
+        Parameters:
+            texts (list[str]): texts to send
+            request_options: keyword arguments forwarded to the batch function
+
+        Returns:
+            a list with the result of every text, in the same order as texts
+        """
+        batches = self.pack_batches(texts)
+        if len(batches) <= 1 or self.max_workers <= 1:
+            return [
+                vector for start, stop in batches for vector in self._embed_with_retry(texts[start:stop], request_options)
+            ]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            results = executor.map(
+                propagate_context(lambda batch: self._embed_with_retry(texts[batch[0] : batch[1]], request_options)),
+                batches,
+            )
+            return [vector for batch_vectors in results for vector in batch_vectors]
@@ -1,20 +1,65 @@
+import hashlib
+import json
 import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 
+from common.comment_store import iter_documents
+from common.instrumentation import instrumented, propagate_context
+from common.lru_cache import LRUCache
+from common.rate_limiter import RateLimiter
+from common.retry import retry_call
+
 
 CREDENTIALS_FILE = "credentials/firestore-credentials.json"
+# Number of documents requested by one batched read
+READ_BATCH_SIZE = 100
+# Maximum number of batched reads running concurrently
+READ_MAX_WORKERS = 8
+# Approximate number of bytes of documents kept in the read cache, shared by all the collections
+READ_CACHE_BYTES = 32 * 1024 * 1024
+# Number of documents committed by one write batch (the Firestore maximum)
+WRITE_BATCH_SIZE = 500
+# Maximum number of write batches committed concurrently
+WRITE_MAX_WORKERS = 8
+# Maximum number of documents written per second, None removes the limit
+WRITE_DOCUMENTS_PER_SECOND = 2000
+# Field in which the hash of the content of every saved document is stored
+CONTENT_HASH_FIELD = "_contentHash"
+# Maximum number of content hashes of stored documents kept in memory, over all the collections
+STORED_HASHES_SIZE = 1000000
 
 
+@instrumented("firestore")
 class FirestoreClient:
-    def __init__(self):
+    def __init__(self, db=None):
         """
         Initializes the Firestore client.
+
+        Parameters:
+            db: Firestore client used instead of the one of the app initialized with CREDENTIALS_FILE (for example a
+                local stand-in in the tests)
         """
-        cred = credentials.Certificate(CREDENTIALS_FILE)
-        self.app = firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
+        if db is None:
+            cred = credentials.Certificate(CREDENTIALS_FILE)
+            self.app = firebase_admin.initialize_app(cred)
+            db = firestore.client()
+        self.db = db
+        # documents read, keyed on (collection, document ID)
+        self._read_cache = LRUCache(max_size=READ_CACHE_BYTES, sizeof=_document_size)
+        # content hashes of the stored documents, by collection
+        self._stored_hashes = LRUCache(max_size=STORED_HASHES_SIZE, sizeof=len)
+        self._stored_hashes_lock = threading.Lock()
+        self._write_limiter = RateLimiter(rate=WRITE_DOCUMENTS_PER_SECOND, burst=WRITE_BATCH_SIZE)
+        self.last_write_stats = None
 
     def get_document_by_id(self, collection, document_id):
         """
@@ -27,24 +72,49 @@ class FirestoreClient:
         Returns:
             a list of dictionaries representing the retrieved documents
         """
-        doc_ref = self.db.collection(collection).document(document_id)
-        doc = doc_ref.get()
-        return doc.to_dict()
+        documents = self.get_documents_by_ids(collection, [document_id])
+        return documents[0] if documents else None
 
     def get_documents_by_ids(self, collection, document_ids):
         """
         Retrieves a batch of documents from a collection by document ID.
 
+        The documents are read through an LRU cache shared by all the collections, the missing ones are read with
+        batched gets of READ_BATCH_SIZE documents running concurrently.
+
         Parameters:
             collection (str): the name of the collection to retrieve from
             document_ids (list[str]): a list of document IDs to retrieve
 
         Returns:
-            a list of dictionaries representing the retrieved documents
+            a list of dictionaries representing the retrieved documents, in the order of document_ids, without the
+            documents that don't exist
         """
-        collection_ref = self.db.collection(collection)
-        docs = [collection_ref.document(document_id).get() for document_id in document_ids]
-        return [doc.to_dict() for doc in docs if doc.exists]
+        found = {}
+        missing = []
+        for document_id in dict.fromkeys(document_ids):
+            document = self._read_cache.get((collection, document_id))
+            if document is None:
+                missing.append(document_id)
+            else:
+                found[document_id] = document
+
+        if missing:
+            collection_ref = self.db.collection(collection)
+
+            def read_batch(batch_ids):
+                refs = [collection_ref.document(document_id) for document_id in batch_ids]
+                return [(doc.id, _without_hash(doc.to_dict())) for doc in self.db.get_all(refs) if doc.exists]
+
+            batches = [missing[i:i + READ_BATCH_SIZE] for i in range(0, len(missing), READ_BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=min(READ_MAX_WORKERS, len(batches))) as executor:
+                for batch in executor.map(propagate_context(read_batch), batches):
+                    for document_id, document in batch:
+                        self._read_cache.put((collection, document_id), document)
+                        found[document_id] = document
+
+        # copies, so that callers can't modify the cached documents
+        return [dict(found[document_id]) for document_id in document_ids if document_id in found]
 
     def get_documents_by_filters(self, collection, filters):
         """
@@ -62,7 +132,7 @@ class FirestoreClient:
         for field, operation, value in filters:
             query = query.where(field, operation, value)
         result = query.get()
-        return [doc.to_dict() for doc in result if doc.exists]
+        return [_without_hash(doc.to_dict()) for doc in result if doc.exists]
 
     def save_document(self, collection, document):
         """
@@ -75,20 +145,128 @@ class FirestoreClient:
         document_id, document_details = list(document.items())[0]
         doc_ref = self.db.collection(collection).document(document_id)
         doc_ref.set(document_details)
+        self._read_cache.pop((collection, document_id))
+        stored_hashes = self._stored_hashes.get(collection)
+        if stored_hashes is not None:
+            stored_hashes.pop(document_id, None)
 
-    def save_documents(self, collection, documents):
+    def _stored_hashes_of(self, collection):
         """
-        Saves documents in a collection.
+        Returns the content hashes of the documents stored in a collection, read once per collection with a
+        query that only selects the hash field.
+        """
+        stored_hashes = self._stored_hashes.get(collection)
+        if stored_hashes is not None:
+            return stored_hashes
 
-        Parameters:
-            collection (str): the name of the collection to save to
-            documents (list[dict]): a list of dictionaries with key = document id and value a dictionary of data to save to the document
+        # streamed without holding the lock, so that the saves to the other collections don't wait for it
+        stored_hashes = {}
+        for doc in self.db.collection(collection).select([CONTENT_HASH_FIELD]).stream():
+            content_hash = (doc.to_dict() or {}).get(CONTENT_HASH_FIELD)
+            if content_hash is not None:
+                stored_hashes[doc.id] = content_hash
+
+        with self._stored_hashes_lock:
+            # a concurrent save to the same collection may have published its hashes in the meantime
+            published = self._stored_hashes.get(collection)
+            if published is not None:
+                return published
+            self._stored_hashes.put(collection, stored_hashes)
+            return stored_hashes
+
+    def _commit_batch(self, collection, chunk):
+        """
+        Commits one write batch, retrying it with exponential backoff when it fails.
         """
-        batch_size = 500
-        for i in range(0, len(documents), batch_size):
+        self._write_limiter.acquire(len(chunk))
+
+        def commit():
             batch = self.db.batch()
-            for document in documents[i : i + batch_size]:
-                document_id, document_details = list(document.items())[0]
+            for document_id, document_details, _, _ in chunk:
                 doc_ref = self.db.collection(collection).document(document_id)
                 batch.set(doc_ref, document_details)
             batch.commit()
+
+        retry_call(commit, retryable=_is_retryable)
+
+    def save_documents(self, collection, documents, max_workers=WRITE_MAX_WORKERS):
+        """
+        Saves documents in a collection.
+
+        Documents whose content hash matches the one stored for them are skipped. The others are committed in
+        batches of WRITE_BATCH_SIZE documents, up to max_workers batches at a time and at most
+        WRITE_DOCUMENTS_PER_SECOND documents per second; failed batches are retried with exponential backoff.
+
+        Parameters:
+            collection (str): the name of the collection to save to
+            documents (list[dict] | CommentStore): a list of dictionaries with key = document id and value a dictionary of data to save to the document
+            max_workers (int): maximum number of batches committed concurrently
+
+        Returns:
+            a dictionary with the number of documents written and skipped, the bytes written, the duration in
+            seconds and the documents and bytes written per second
+        """
+        started_at = time.perf_counter()
+        stored_hashes = self._stored_hashes_of(collection)
+        stats = {"documents": 0, "skipped": 0, "bytes": 0}
+
+        def changed_documents():
+            for document_id, document_details in iter_documents(documents):
+                content = json.dumps(document_details, sort_keys=True, default=str).encode("utf-8")
+                content_hash = hashlib.sha256(content).hexdigest()
+                if stored_hashes.get(document_id) == content_hash:
+                    stats["skipped"] += 1
+                    continue
+                yield document_id, {**document_details, CONTENT_HASH_FIELD: content_hash}, content_hash, len(content)
+
+        def finish(future, chunk):
+            future.result()
+            for document_id, _, content_hash, size in chunk:
+                stored_hashes[document_id] = content_hash
+                self._read_cache.pop((collection, document_id))
+                stats["documents"] += 1
+                stats["bytes"] += size
+
+        changed = changed_documents()
+        pending = deque()
+        commit_batch = propagate_context(self._commit_batch)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                chunk = list(islice(changed, WRITE_BATCH_SIZE))
+                if not chunk:
+                    break
+                # bound the batches in flight, so that large inputs are not all held in memory
+                if len(pending) >= 2 * max_workers:
+                    finish(*pending.popleft())
+                pending.append((executor.submit(commit_batch, collection, chunk), chunk))
+            while pending:
+                finish(*pending.popleft())
+        # cached again, so that the cache accounts for the hashes added by this save
+        self._stored_hashes.put(collection, stored_hashes)
+
+        seconds = time.perf_counter() - started_at
+        stats["seconds"] = seconds
+        stats["documents_per_second"] = stats["documents"] / seconds if seconds else 0.0
+        stats["bytes_per_second"] = stats["bytes"] / seconds if seconds else 0.0
+        self.last_write_stats = stats
+        return stats
+
+
+def _document_size(document):
+    """
+    Approximates the number of bytes of a document, for the size-based eviction of the read cache.
+    """
+    return sys.getsizeof(document) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in document.items())
+
+
+def _without_hash(document):
+    document.pop(CONTENT_HASH_FIELD, None)
+    return document
+
+
+def _is_retryable(error):
+    """
+    Returns True for the errors worth retrying: network errors, conflicts, rate limiting and server errors.
+    """
+    status = getattr(error, "code", None)
+    return not isinstance(status, int) or status in (409, 429) or status >= 500
@@ -0,0 +1 @@
+from .local_vector_index import LocalVectorIndex
@@ -0,0 +1,522 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from common.instrumentation import instrumented
+
+# Directory where the namespaces of the local indexes are persisted
+VECTOR_INDEX_DIR = "cache/vector_index"
+# Below this number of vectors a namespace is searched exactly, above it through an IVF index
+IVF_MIN_VECTORS = 50_000
+# Number of IVF lists probed by a query
+IVF_NPROBE = 16
+# Maximum number of vectors used to train the IVF quantizer
+IVF_TRAINING_SAMPLE_SIZE = 50_000
+# Number of rows scored at once when assigning vectors to IVF lists
+ASSIGNMENT_CHUNK_SIZE = 8192
+# A namespace is compacted once this share of its rows holds overwritten vectors
+COMPACTION_THRESHOLD = 0.5
+# Maximum number of query x vector scores computed at once by a batched query
+QUERY_BATCH_SCORES = 16 * 1024 * 1024
+
+
+@instrumented("local_index", exclude=("_namespace",))
+class LocalVectorIndex:
+    """
+    In-process vector index with the interface of PineconeClient, for running without the network round trips to
+    Pinecone. Vectors are compared by cosine similarity and grouped in namespaces, each one persisted under
+    data_dir/index_name/namespace as a memory-mapped float32 matrix and an append-only log of ids and metadata.
+
+    Namespaces are searched exactly with one matrix-vector product until they hold IVF_MIN_VECTORS vectors, and
+    through an IVF index (k-means lists, of which the IVF_NPROBE closest to the query are searched) above that.
+    """
+
+    def __init__(self, index_name, data_dir=VECTOR_INDEX_DIR):
+        """
+        Initializes the index.
+
+        Parameters:
+            index_name (str): name of the index, the namespaces are kept under data_dir/index_name
+            data_dir (str | None): directory of the persisted namespaces, None keeps them in memory only
+        """
+        self.directory = None if data_dir is None else os.path.join(data_dir, _safe_name(index_name))
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _namespace(self, namespace):
+        with self._lock:
+            if namespace not in self._namespaces:
+                directory = None if self.directory is None else os.path.join(self.directory, _safe_name(namespace))
+                self._namespaces[namespace] = _Namespace(directory)
+            return self._namespaces[namespace]
+
+    def fetch_by_ids(self, ids, namespace):
+        """
+        Fetches embeddings vectors in the specified namespace.
+
+        Parameters:
+            ids (list[str]): list of vector ids to fetch
+            namespace (str): namespace to fetch vectors from
+
+        Returns:
+            a dictionary with the namespace and, by id, the vectors found with their values and metadata
+        """
+        return {"namespace": namespace, "vectors": self._namespace(namespace).fetch(ids)}
+
+    def save(self, vectors, namespace):
+        """
+        Saves embeddings vectors in the specified namespace, replacing the vectors with the same ids.
+
+        Parameters:
+            vectors: list[str, list | numpy.ndarray, dict]
+                id (str): vector identifier
+                vector (list | numpy.ndarray) - embedded item
+                metadata (dict) - dict with item metadata
+            namespace (str): namespace to save vectors, usually corresponding video id
+
+        Returns:
+            None
+        """
+        if len(vectors):
+            self._namespace(namespace).upsert(vectors)
+
+    def delete(self, namespace, ids, delete_all=False, filters={}):
+        """
+        Deletes vectors in the specified namespace.
+
+        Parameters:
+            namespace(str): the namespace to query
+            ids (list[str] | None): list of vector ids to delete
+            delete_all (bool): True or False, specifiec to delete all ids from namespace or not
+            filter (dict | None): dictionary with field-value filters
+
+        Returns:
+            an empty dictionary, like Pinecone
+        """
+        if delete_all and filters:
+            raise Exception("No filter expected when delete_all=true")
+        elif delete_all:
+            with self._lock:
+                namespace_index = self._namespaces.pop(namespace, None)
+            if namespace_index is None:
+                namespace_index = _Namespace(
+                    None if self.directory is None else os.path.join(self.directory, _safe_name(namespace))
+                )
+            namespace_index.drop()
+        else:
+            self._namespace(namespace).delete(ids, filters)
+        return {}
+
+    def query(
+        self,
+        namespace,
+        vector,
+        id=None,
+        filter={},
+        top_k=10,
+        include_values=False,
+        include_metadata=False,
+    ):
+        """
+        It retrieves the ids of the most similar items in a namespace, along with their similarity scores.
+
+        Parameters:
+            namespace (str): The namespace to query.
+            vector (list[float] | numpy.ndarray): query vector. This should be the same length as the dimension of the index being queried
+            id (str): the unique ID of the vector to be used as a query vector
+            filter (dict): The filter to apply on vector metadata to limit the search.
+            top_k (int): The number of results to return for each query.
+            include_values (bool): kept for compatibility with PineconeClient, the ids are returned alone
+            include_metadata (bool): kept for compatibility with PineconeClient, the ids are returned alone
+
+        Returns:
+            The ids of the most similar items in a namespace, most similar first.
+        """
+        if vector is not None and id:
+            raise Exception("Vector id and vector not allowed in same query")
+        elif vector is None and not id:
+            raise Exception("Provide id or vector to query")
+        namespace_index = self._namespace(namespace)
+        if vector is None:
+            found = namespace_index.fetch([id])
+            if not found:
+                return []
+            vector = found[id]["values"]
+        rows, _ = namespace_index.search(np.asarray(vector, dtype=np.float32), top_k, filter)
+        return namespace_index.ids_of(rows)
+
+    def query_batch(self, namespace, vectors, filter={}, top_k=10, include_metadata=False):
+        """
+        Retrieves the most similar items of several query vectors, scoring all the queries with one matrix product.
+
+        Parameters:
+            namespace (str): The namespace to query.
+            vectors (list[list[float]] | numpy.ndarray): matrix of query vectors, one row per query
+            filter (dict): The filter to apply on vector metadata to limit the search.
+            top_k (int): The number of results to return for each query.
+            include_metadata (bool): indicates whether the metadata of the matches is returned
+
+        Returns:
+            a list with, for every query and in the same order, a dictionary with the "ids" and "scores" of the
+            matches, most similar first, and their "metadata" when include_metadata is True
+        """
+        namespace_index = self._namespace(namespace)
+        results = []
+        for rows, scores in namespace_index.search_batch(np.asarray(vectors, dtype=np.float32), top_k, filter):
+            result = {"ids": namespace_index.ids_of(rows), "scores": scores.tolist()}
+            if include_metadata:
+                result["metadata"] = namespace_index.metadata_of(rows)
+            results.append(result)
+        return results
+
+
+class _Namespace:
+    """
+    Vectors of one namespace.
+
+    Upserts append rows: a vector saved again under an existing id gets a new row and its previous row is marked
+    dead. Rows are appended to a raw float32 file that is memory-mapped for reads, together with a JSON line holding
+    the id and the metadata of the row. Deletions and too many dead rows rewrite the files without the dead rows.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.RLock()
+        self._reset()
+        if directory is not None:
+            self._vectors_path = os.path.join(directory, "vectors.f32")
+            self._records_path = os.path.join(directory, "records.jsonl")
+            self._meta_path = os.path.join(directory, "meta.json")
+            self._load()
+
+    def _reset(self):
+        self._dimension = None
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._num_rows = 0
+        self._inverse_norms = np.empty(0, dtype=np.float32)
+        self._alive = np.empty(0, dtype=bool)
+        self._ids = []
+        self._metadata = []
+        self._row_index = {}
+        self._columns = {}
+        self._ivf = None
+
+    @property
+    def size(self):
+        return len(self._row_index)
+
+    def _load(self):
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path) as f:
+            self._dimension = json.load(f)["dimension"]
+        with open(self._records_path) as f:
+            records = [json.loads(line) for line in f if line.endswith("\n")]
+        row_bytes = self._dimension * 4
+        rows = min(len(records), os.path.getsize(self._vectors_path) // row_bytes)
+        # drop a partially written tail, so that the next append stays aligned with the records
+        os.truncate(self._vectors_path, rows * row_bytes)
+        if rows < len(records):
+            self._write_records(records[:rows], mode="w")
+        if rows:
+            matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self._dimension))
+            self._append_rows(matrix, [record[0] for record in records[:rows]],
+                              [record[1] for record in records[:rows]], matrix)
+
+    def _write_records(self, records, mode="a"):
+        with open(self._records_path, mode) as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+    def _append_rows(self, vectors, ids, metadata, matrix):
+        """
+        Registers rows appended to the matrix, matrix being the matrix once the rows are appended
+        """
+        first_row = self._num_rows
+        self._matrix = matrix
+        self._num_rows = first_row + len(ids)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1
+        self._inverse_norms = np.concatenate([self._inverse_norms, (1 / norms).astype(np.float32)])
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+        self._ids.extend(ids)
+        self._metadata.extend(metadata)
+        for row, vector_id in enumerate(ids, start=first_row):
+            previous_row = self._row_index.get(vector_id)
+            if previous_row is not None:
+                self._alive[previous_row] = False
+            self._row_index[vector_id] = row
+        if self._ivf is not None:
+            self._ivf.add(self._unit_rows(first_row, self._num_rows))
+
+    def _unit_rows(self, start, stop):
+        return np.asarray(self._matrix[start:stop]) * self._inverse_norms[start:stop, None]
+
+    def upsert(self, vectors):
+        ids = [str(vector[0]) for vector in vectors]
+        values = np.asarray([np.asarray(vector[1], dtype=np.float32) for vector in vectors])
+        metadata = [dict(vector[2]) if len(vector) > 2 and vector[2] else {} for vector in vectors]
+        with self._lock:
+            if self._dimension is None:
+                self._dimension = values.shape[1]
+                if self._directory is not None:
+                    os.makedirs(self._directory, exist_ok=True)
+                    with open(self._meta_path, "w") as f:
+                        json.dump({"dimension": self._dimension}, f)
+            elif values.shape[1] != self._dimension:
+                raise Exception(f"Vector dimension {values.shape[1]} does not match the index dimension {self._dimension}")
+
+            if self._directory is None:
+                matrix = self._matrix
+                if len(matrix) < self._num_rows + len(ids):
+                    # grow the in-memory matrix by doubling its capacity
+                    matrix = np.empty((max(2 * len(matrix), self._num_rows + len(ids)), self._dimension), np.float32)
+                    if self._num_rows:
+                        matrix[:self._num_rows] = self._matrix[:self._num_rows]
+                matrix[self._num_rows:self._num_rows + len(ids)] = values
+            else:
+                # vectors are written before their records, so a record always points to a complete row
+                with open(self._vectors_path, "ab") as f:
+                    f.write(values.tobytes())
+                self._write_records([[vector_id, meta] for vector_id, meta in zip(ids, metadata)])
+                matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                   shape=(self._num_rows + len(ids), self._dimension))
+            self._append_rows(values, ids, metadata, matrix)
+            if self._num_rows - self.size > COMPACTION_THRESHOLD * self._num_rows:
+                self._compact()
+
+    def fetch(self, ids):
+        with self._lock:
+            vectors = {}
+            for vector_id in ids:
+                row = self._row_index.get(vector_id)
+                if row is not None:
+                    vectors[vector_id] = {
+                        "id": vector_id,
+                        "values": np.asarray(self._matrix[row]).tolist(),
+                        "metadata": self._metadata[row],
+                    }
+            return vectors
+
+    def ids_of(self, rows):
+        with self._lock:
+            return [self._ids[row] for row in rows]
+
+    def metadata_of(self, rows):
+        with self._lock:
+            return [self._metadata[row] for row in rows]
+
+    def delete(self, ids, filters):
+        with self._lock:
+            delete = np.zeros(self._num_rows, dtype=bool)
+            if ids:
+                rows = [self._row_index[vector_id] for vector_id in ids if vector_id in self._row_index]
+                delete[rows] = True
+            if filters:
+                matches = self._filter_mask(filters)
+                delete = delete & matches if ids else matches
+            delete &= self._alive
+            if delete.any():
+                for row in np.flatnonzero(delete):
+                    del self._row_index[self._ids[row]]
+                self._alive &= ~delete
+                self._compact()
+
+    def drop(self):
+        with self._lock:
+            if self._directory is not None and os.path.exists(self._directory):
+                shutil.rmtree(self._directory)
+            self._reset()
+
+    def _compact(self):
+        """
+        Rewrites the namespace without its dead rows
+        """
+        rows = np.flatnonzero(self._alive)
+        vectors = np.asarray(self._matrix[rows]) if len(rows) else np.empty((0, self._dimension), np.float32)
+        ids = [self._ids[row] for row in rows]
+        metadata = [self._metadata[row] for row in rows]
+        dimension = self._dimension
+        self._reset()
+        self._dimension = dimension
+        if self._directory is None:
+            self._append_rows(vectors, ids, metadata, vectors)
+            return
+        for path, content in ((self._vectors_path, vectors.tobytes()),
+                              (self._records_path, "".join(json.dumps([i, m]) + "\n" for i, m in zip(ids, metadata)))):
+            with open(path + ".tmp", "wb" if isinstance(content, bytes) else "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=vectors.shape) if len(ids) else vectors
+        self._append_rows(vectors, ids, metadata, matrix)
+
+    def _column(self, key):
+        """
+        Returns the dictionary-encoded values of a metadata field, -1 where the field is missing
+        """
+        codes, lookup = self._columns.get(key, (np.empty(0, dtype=np.int32), {}))
+        if len(codes) < self._num_rows:
+            new_codes = [lookup.setdefault(_hashable(meta[key]), len(lookup)) if key in meta else -1
+                         for meta in self._metadata[len(codes):self._num_rows]]
+            codes = np.concatenate([codes, np.asarray(new_codes, dtype=np.int32)])
+            self._columns[key] = (codes, lookup)
+        return codes, lookup
+
+    def _filter_mask(self, filters):
+        """
+        Evaluates a Pinecone metadata filter ($eq, $ne, $in, $nin, $and, $or) on every row. A None value matches
+        the rows where the field is None or missing
+        """
+        mask = np.ones(self._num_rows, dtype=bool)
+        for key, condition in filters.items():
+            if key == "$and":
+                for sub_filter in condition:
+                    mask &= self._filter_mask(sub_filter)
+                continue
+            if key == "$or":
+                matches = np.zeros(self._num_rows, dtype=bool)
+                for sub_filter in condition:
+                    matches |= self._filter_mask(sub_filter)
+                mask &= matches
+                continue
+            codes, lookup = self._column(key)
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator, value in condition.items():
+                if operator in ("$eq", "$ne"):
+                    value = [value]
+                elif operator not in ("$in", "$nin"):
+                    raise Exception(f"Unsupported filter operator {operator}")
+                value_codes = [lookup[_hashable(item)] for item in value if _hashable(item) in lookup]
+                matches = np.isin(codes, value_codes)
+                if any(item is None for item in value):
+                    matches |= codes < 0
+                mask &= matches if operator in ("$eq", "$in") else ~matches & (codes >= 0)
+        return mask
+
+    def search(self, query, top_k, filters=None):
+        """
+        Returns the rows of the top_k vectors most similar to the query, with their cosine similarities
+        """
+        with self._lock:
+            if self.size == 0 or top_k <= 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            query = query / (norm if norm else 1)
+            mask = self._alive & self._filter_mask(filters) if filters else self._alive
+
+            rows = None
+            if self.size >= IVF_MIN_VECTORS:
+                if self._ivf is None or self._ivf.needs_training(self.size):
+                    self._train_ivf()
+                candidates = self._ivf.candidates(query, IVF_NPROBE)
+                candidates = candidates[mask[candidates]]
+                if len(candidates) >= top_k:
+                    rows = candidates
+            if rows is None and mask is self._alive and self.size > self._num_rows / 2:
+                scores = np.asarray(self._matrix[:self._num_rows]) @ query * self._inverse_norms
+                scores[~mask] = -np.inf
+                rows = np.arange(self._num_rows)
+            else:
+                if rows is None:
+                    rows = np.flatnonzero(mask)
+                scores = np.asarray(self._matrix[rows]) @ query * self._inverse_norms[rows]
+
+            top_k = min(top_k, int(np.isfinite(scores).sum()))
+            if top_k == 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            top = np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")][:top_k]
+            return rows[top], scores[top]
+
+    def search_batch(self, queries, top_k, filters=None):
+        """
+        Returns, for every query, the rows of the top_k most similar vectors with their cosine similarities
+        """
+        with self._lock:
+            if len(queries) == 0:
+                return []
+            if self.size >= IVF_MIN_VECTORS or self.size == 0 or top_k <= 0:
+                # the IVF lists probed differ between queries
+                return [self.search(query, top_k, filters) for query in queries]
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            queries = queries / norms
+            mask = self._alive & self._filter_mask(filters) if filters else self._alive
+            rows = np.flatnonzero(mask)
+            top_k = min(top_k, len(rows))
+            if top_k == 0:
+                return [(rows, np.empty(0, dtype=np.float32)) for _ in queries]
+            vectors = np.asarray(self._matrix[rows]) * self._inverse_norms[rows, None]
+
+            results = []
+            step = max(1, QUERY_BATCH_SCORES // len(rows))
+            for start in range(0, len(queries), step):
+                scores = queries[start:start + step] @ vectors.T
+                if top_k < len(rows):
+                    top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+                else:
+                    top = np.broadcast_to(np.arange(len(rows)), scores.shape)
+                top_scores = np.take_along_axis(scores, top, axis=1)
+                order = np.argsort(-top_scores, axis=1, kind="stable")
+                top = np.take_along_axis(top, order, axis=1)
+                top_scores = np.take_along_axis(top_scores, order, axis=1)
+                results.extend(zip(rows[top], top_scores))
+            return results
+
+    def _train_ivf(self):
+        rows = np.flatnonzero(self._alive)
+        if len(rows) > IVF_TRAINING_SAMPLE_SIZE:
+            rows = np.sort(np.random.default_rng(0).choice(rows, IVF_TRAINING_SAMPLE_SIZE, replace=False))
+        sample = np.asarray(self._matrix[rows]) * self._inverse_norms[rows, None]
+        self._ivf = _IVFIndex(sample, self.size)
+        for start in range(0, self._num_rows, ASSIGNMENT_CHUNK_SIZE):
+            self._ivf.add(self._unit_rows(start, min(start + ASSIGNMENT_CHUNK_SIZE, self._num_rows)))
+
+
+class _IVFIndex:
+    """
+    Inverted file index: the vectors are split in lists by their closest k-means centroid, and a query only
+    scores the vectors of the lists whose centroids are closest to it. Rows are assigned as they are appended, and
+    the quantizer is trained again once the namespace has doubled.
+    """
+
+    def __init__(self, sample, trained_size):
+        n_lists = int(np.clip(np.sqrt(trained_size), 16, 4096))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=1, random_state=0).fit(sample)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        self.centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        self.trained_size = trained_size
+        self._assignments = []
+        self._order = None
+        self._offsets = None
+
+    def needs_training(self, size):
+        return size > 2 * self.trained_size
+
+    def add(self, unit_rows):
+        for start in range(0, len(unit_rows), ASSIGNMENT_CHUNK_SIZE):
+            chunk = unit_rows[start:start + ASSIGNMENT_CHUNK_SIZE]
+            self._assignments.append((chunk @ self.centroids.T).argmax(axis=1).astype(np.int32))
+        self._order = None
+
+    def candidates(self, query, nprobe):
+        if self._order is None:
+            assignments = np.concatenate(self._assignments)
+            self._assignments = [assignments]
+            self._order = np.argsort(assignments, kind="stable")
+            self._offsets = np.searchsorted(assignments[self._order], np.arange(len(self.centroids) + 1))
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self._order[self._offsets[i]:self._offsets[i + 1]] for i in lists]))
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _safe_name(name):
+    return "".join(char if char.isalnum() or char in "-_." else "_" for char in name)
@@ -1,11 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pinecone
 
+from common.instrumentation import instrumented, propagate_context
+
 # API key for Pinecone Vector DB
 API_KEY = "YOUR_API_KEY"
 # GCP environment zone
 ENVIRONMENT = "us-east1-gcp"
+# Maximum number of concurrent query requests of a batched query
+QUERY_MAX_WORKERS = 8
 
 
+@instrumented("pinecone")
 class PineconeClient:
     def __init__(self, index_name):
         """
@@ -33,9 +40,9 @@ class PineconeClient:
         Saves embeddings vectors in the specified namespace.
 
         Parameters:
-            vectors: list[str, list, dict]
+            vectors: list[str, list | numpy.ndarray, dict]
                 id (str): vector identifier
-                vector (list) - embedded item
+                vector (list | numpy.ndarray) - embedded item
                 metadata (dict) - dict with item metadata
             namespace (str): namespace to save vectors, usually corresponding video id
 
@@ -44,7 +51,8 @@ class PineconeClient:
         """
         batch_size = 100
         for i in range(0, len(vectors), batch_size):
-            self.index.upsert(vectors=vectors[i : i + batch_size], namespace=namespace)
+            batch = [(id, _to_list(values), *rest) for id, values, *rest in vectors[i : i + batch_size]]
+            self.index.upsert(vectors=batch, namespace=namespace)
 
     def delete(self, namespace, ids, delete_all=False, filters={}):
         """
@@ -84,7 +92,7 @@ class PineconeClient:
 
         Parameters:
             namespace (str): The namespace to query.
-            vector (list[int]): query vector. This should be the same length as the dimension of the index being queried
+            vector (list[float] | numpy.ndarray): query vector. This should be the same length as the dimension of the index being queried
             id (str): the unique ID of the vector to be used as a query vector
             filter (dict): The filter to apply on vector metadata to limit the search.
             top_k (int): The number of results to return for each query.
@@ -94,12 +102,12 @@ class PineconeClient:
         Returns:
             The ids of the most similar items in a namespace, along with their similarity scores.
         """
-        if vector and id:
+        if vector is not None and id:
             raise Exception("Vector id and vector not allowed in same query")
-        elif vector:
+        elif vector is not None:
             query_response = self.index.query(
                 namespace=namespace,
-                vector=vector,
+                vector=_to_list(vector),
                 filter=filter,
                 top_k=top_k,
                 include_values=include_values,
@@ -118,3 +126,47 @@ class PineconeClient:
             raise Exception("Provide id or vector to query")
         query_answers = [answer['id'] for answer in query_response['matches']]
         return query_answers
+
+    def query_batch(self, namespace, vectors, filter={}, top_k=10, include_metadata=False):
+        """
+        Retrieves the most similar items of several query vectors, sending the queries concurrently.
+
+        Parameters:
+            namespace (str): The namespace to query.
+            vectors (list[list[float]] | numpy.ndarray): matrix of query vectors, one row per query
+            filter (dict): The filter to apply on vector metadata to limit the search.
+            top_k (int): The number of results to return for each query.
+            include_metadata (bool): indicates whether the metadata of the matches is returned
+
+        Returns:
+            a list with, for every query and in the same order, a dictionary with the "ids" and "scores" of the
+            matches, most similar first, and their "metadata" when include_metadata is True
+        """
+        def query_one(vector):
+            query_response = self.index.query(
+                namespace=namespace,
+                vector=_to_list(vector),
+                filter=filter,
+                top_k=top_k,
+                include_metadata=include_metadata,
+            )
+            matches = query_response['matches']
+            result = {
+                "ids": [match['id'] for match in matches],
+                "scores": [match['score'] for match in matches],
+            }
+            if include_metadata:
+                result["metadata"] = [match.get('metadata') or {} for match in matches]
+            return result
+
+        if len(vectors) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(vectors))) as executor:
+            return list(executor.map(propagate_context(query_one), vectors))
+
+
+def _to_list(vector):
+    """
+    Converts NumPy vectors to the plain lists expected by the Pinecone client.
+    """
+    return vector.tolist() if hasattr(vector, "tolist") else vector
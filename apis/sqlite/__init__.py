@@ -0,0 +1 @@
+from .sqlite_client import SQLiteClient
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.comment_store import iter_documents
+from common.instrumentation import instrumented
+
+# File of the SQLite database in which the documents are stored
+DATABASE_FILE = "cache/documents.sqlite3"
+# Number of ids looked up by one query
+READ_BATCH_SIZE = 500
+# Document fields stored in their own indexed columns, with their SQLite types
+INDEXED_FIELDS = {
+    "parentId": "TEXT",
+    "publishedAt": "TEXT",
+    "likeCount": "INTEGER",
+}
+# SQL operators of the Firestore filter operators
+FILTER_OPERATORS = {
+    "==": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "in": "IN",
+    "not-in": "NOT IN",
+}
+
+
+@instrumented("sqlite", exclude=("_connection", "_table"))
+class SQLiteClient:
+    """
+    Local document store with the interface of FirestoreClient, built on SQLite in WAL mode.
+
+    Every collection is a table with the document id, the JSON of the document, the hash of its content and the
+    fields of INDEXED_FIELDS copied to indexed columns, so filters on them are index lookups. Every thread uses
+    its own connection.
+    """
+
+    def __init__(self, database_file=DATABASE_FILE):
+        """
+        Opens (and creates when needed) the database.
+
+        Parameters:
+            database_file (str): path of the SQLite database file
+        """
+        directory = os.path.dirname(database_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.database_file = database_file
+        self._local = threading.local()
+        self._tables = set()
+        self._tables_lock = threading.Lock()
+        self.last_write_stats = None
+        self._connection().execute("PRAGMA journal_mode=WAL")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _table(self, collection):
+        """
+        Returns the quoted table name of a collection, creating the table and its indexes on first use.
+        """
+        table = _quote(collection)
+        with self._tables_lock:
+            if collection not in self._tables:
+                columns = "".join(f", {_quote(field)} {sql_type}" for field, sql_type in INDEXED_FIELDS.items())
+                with self._connection() as connection:
+                    connection.execute(
+                        f"CREATE TABLE IF NOT EXISTS {table} "
+                        f"(id TEXT PRIMARY KEY, document TEXT NOT NULL, content_hash TEXT NOT NULL{columns})"
+                    )
+                    for field in INDEXED_FIELDS:
+                        connection.execute(
+                            f"CREATE INDEX IF NOT EXISTS {_quote(f'{collection}_{field}')} ON {table} ({_quote(field)})"
+                        )
+                self._tables.add(collection)
+        return table
+
+    def get_document_by_id(self, collection, document_id):
+        """
+        Retrieves a document from a collection by its ID.
+
+        Parameters:
+            collection (str): the name of the collection to retrieve from
+            document_id (str): a document ID to retrieve
+
+        Returns:
+            a dictionary representing the retrieved document, None when it doesn't exist
+        """
+        documents = self.get_documents_by_ids(collection, [document_id])
+        return documents[0] if documents else None
+
+    def get_documents_by_ids(self, collection, document_ids):
+        """
+        Retrieves a batch of documents from a collection by document ID.
+
+        Parameters:
+            collection (str): the name of the collection to retrieve from
+            document_ids (list[str]): a list of document IDs to retrieve
+
+        Returns:
+            a list of dictionaries representing the retrieved documents, in the order of document_ids, without the
+            documents that don't exist
+        """
+        table = self._table(collection)
+        connection = self._connection()
+        distinct_ids = list(dict.fromkeys(document_ids))
+        found = {}
+        for i in range(0, len(distinct_ids), READ_BATCH_SIZE):
+            batch_ids = distinct_ids[i:i + READ_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT id, document FROM {table} WHERE id IN ({', '.join('?' * len(batch_ids))})", batch_ids
+            )
+            found.update(rows)
+        return [json.loads(found[document_id]) for document_id in document_ids if document_id in found]
+
+    def get_documents_by_filters(self, collection, filters):
+        """
+        Retrieves documents from a collection that match the specified filters.
+
+        Parameters:
+            collection (str): the name of the collection to retrieve from
+            filters (list[tuple]): a list of tuples with field name, operator, values to filter by
+
+        Returns:
+            a list of dictionaries representing the retrieved documents
+        """
+        table = self._table(collection)
+        conditions = []
+        parameters = []
+        for field, operation, value in filters:
+            if operation not in FILTER_OPERATORS:
+                raise Exception(f"Unsupported filter operator {operation}")
+            if field in INDEXED_FIELDS:
+                column = _quote(field)
+            else:
+                column = "json_extract(document, ?)"
+                parameters.append(f'$."{field}"')
+            if operation in ("in", "not-in"):
+                conditions.append(f"{column} {FILTER_OPERATORS[operation]} ({', '.join('?' * len(value))})")
+                parameters.extend(value)
+            else:
+                conditions.append(f"{column} {FILTER_OPERATORS[operation]} ?")
+                parameters.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connection().execute(f"SELECT document FROM {table}{where}", parameters)
+        return [json.loads(document) for document, in rows]
+
+    def save_document(self, collection, document):
+        """
+        Saves a document in a collection.
+
+        Parameters:
+            collectionn (str): the name of the collection to save to
+            document (dict): a dictionary with key = document id and value a dictionary of data to save to the document
+        """
+        self.save_documents(collection, [document])
+
+    def save_documents(self, collection, documents, max_workers=None):
+        """
+        Saves documents in a collection, in one transaction. Documents whose content is unchanged are not
+        written again.
+
+        Parameters:
+            collection (str): the name of the collection to save to
+            documents (list[dict] | CommentStore): a list of dictionaries with key = document id and value a dictionary of data to save to the document
+            max_workers (int | None): kept for compatibility with FirestoreClient, SQLite has a single writer
+
+        Returns:
+            a dictionary with the number of documents written and skipped, the bytes written, the duration in
+            seconds and the documents and bytes written per second
+        """
+        started_at = time.perf_counter()
+        table = self._table(collection)
+        fields = list(INDEXED_FIELDS)
+        rows = {}
+        for document_id, document_details in iter_documents(documents):
+            content = json.dumps(document_details, sort_keys=True, default=str)
+            content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            rows[document_id] = (document_id, content, content_hash, *(document_details.get(field) for field in fields))
+
+        connection = self._connection()
+        stored_hashes = {}
+        ids = list(rows)
+        for i in range(0, len(ids), READ_BATCH_SIZE):
+            batch_ids = ids[i:i + READ_BATCH_SIZE]
+            stored_hashes.update(connection.execute(
+                f"SELECT id, content_hash FROM {table} WHERE id IN ({', '.join('?' * len(batch_ids))})", batch_ids
+            ))
+        changed = [row for document_id, row in rows.items() if stored_hashes.get(document_id) != row[2]]
+
+        columns = ["id", "document", "content_hash"] + [_quote(field) for field in fields]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+        with connection:
+            connection.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates}",
+                changed,
+            )
+
+        seconds = time.perf_counter() - started_at
+        stats = {
+            "documents": len(changed),
+            "skipped": len(rows) - len(changed),
+            "bytes": sum(len(row[1].encode("utf-8")) for row in changed),
+            "seconds": seconds,
+        }
+        stats["documents_per_second"] = stats["documents"] / seconds if seconds else 0.0
+        stats["bytes_per_second"] = stats["bytes"] / seconds if seconds else 0.0
+        self.last_write_stats = stats
+        return stats
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
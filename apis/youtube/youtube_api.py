@@ -1,22 +1,57 @@
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from googleapiclient.discovery import build
 
+from common.comment_store import CommentStore
+from common.instrumentation import instrumented, propagate_context
+
 # Developer key for the YouTube API
 DEVELOPER_KEY = "YOUR_API_KEY"
 # YouTube API service name
 YOUTUBE_API_SERVICE_NAME = "youtube"
 # YouTube API version
 YOUTUBE_API_VERSION = "v3"
+# Maximum number of reply threads fetched concurrently
+MAX_REPLY_WORKERS = 8
 
 
+@instrumented("youtube", exclude=("_get_service", "_parse_reply", "_parse_comment_thread"))
 class YouTubeAPI:
-    def __init__(self):
+    def __init__(self, max_reply_workers=MAX_REPLY_WORKERS, service=None):
         """
         Initializes the YouTube API client
+
+        Parameters:
+            max_reply_workers (int): maximum number of reply threads fetched concurrently, 1 fetches them sequentially
+            service: thread-safe API resource used by every thread instead of the resources built with
+                googleapiclient (for example a local stand-in in the benchmarks)
         """
-        self.youtube = build(
+        self._service = service
+        self.youtube = service or build(
             YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, developerKey=DEVELOPER_KEY
         )
+        self.max_reply_workers = max_reply_workers
+        self._local = threading.local()
+        self._local.youtube = self.youtube
+
+    def _get_service(self):
+        """
+        Returns the API resource for the calling thread. The underlying httplib2 transport is not
+        thread-safe, so every worker thread builds and keeps its own resource.
+
+        Returns:
+            the YouTube API resource
+        """
+        if self._service is not None:
+            return self._service
+        youtube = getattr(self._local, "youtube", None)
+        if youtube is None:
+            youtube = build(
+                YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, developerKey=DEVELOPER_KEY
+            )
+            self._local.youtube = youtube
+        return youtube
 
     def _get_comments(self, video_id, next_page_token=None):
         """
@@ -30,7 +65,7 @@ class YouTubeAPI:
             results
         """
         results = (
-            self.youtube.commentThreads()
+            self._get_service().commentThreads()
             .list(
                 part="id,snippet,replies",
                 maxResults=100,
@@ -54,7 +89,7 @@ class YouTubeAPI:
             results
         """
         results = (
-            self.youtube.comments()
+            self._get_service().comments()
             .list(
                 part="snippet",
                 parentId=parent_id,
@@ -66,81 +101,198 @@ class YouTubeAPI:
         )
         return results
 
-    def fetch_comment_threads(self, video_id):
+    def get_comment_count(self, video_id):
+        """
+        Retrieves the number of comments of a video, from the video statistics
+
+        Parameters:
+            video_id (str): ID of the video
+
+        Returns:
+            the number of comments (top-level comments and replies), None when the video doesn't exist or its
+            comments are disabled
+        """
+        results = (
+            self._get_service().videos()
+            .list(part="statistics", id=video_id)
+            .execute()
+        )
+        items = results.get("items", [])
+        if not items or "commentCount" not in items[0]["statistics"]:
+            return None
+        return int(items[0]["statistics"]["commentCount"])
+
+    def get_latest_comment_id(self, video_id):
+        """
+        Retrieves the ID of the most recent top-level comment of a video
+
+        Parameters:
+            video_id (str): ID of the video
+
+        Returns:
+            the ID of the comment thread, None when the video has no comments
+        """
+        results = (
+            self._get_service().commentThreads()
+            .list(part="id", maxResults=1, videoId=video_id, order="time")
+            .execute()
+        )
+        items = results.get("items", [])
+        return items[0]["id"] if items else None
+
+    @staticmethod
+    def _parse_reply(reply, parent_comment_id, store):
+        """
+        Adds a reply resource to a comment store.
+
+        Parameters:
+            reply (dict): comment resource returned by the API
+            parent_comment_id (str): ID of the top-level comment
+            store (CommentStore): store the reply is added to
+        """
+        store.add(
+            reply["id"].split(".")[1],
+            author=reply["snippet"]["authorDisplayName"],
+            text=reply["snippet"]["textDisplay"],
+            like_count=reply["snippet"]["likeCount"],
+            published_at=reply["snippet"]["publishedAt"],
+            parent_id=parent_comment_id,
+        )
+
+    def _parse_comment_thread(self, item, store):
+        """
+        Adds a comment thread resource (the top-level comment and its inline replies) to a comment store.
+
+        Parameters:
+            item (dict): comment thread resource returned by the API
+            store (CommentStore): store the comments are added to
+
+        Returns:
+            True if the replies of the thread still need to be fetched separately
+        """
+        comment = item["snippet"]["topLevelComment"]
+        comment_id = item["id"]
+        total_reply_count = item["snippet"]["totalReplyCount"]
+        store.add(
+            comment_id,
+            author=comment["snippet"]["authorDisplayName"],
+            text=comment["snippet"]["textDisplay"],
+            like_count=comment["snippet"]["likeCount"],
+            published_at=comment["snippet"]["publishedAt"],
+            total_reply_count=total_reply_count,
+        )
+
+        if total_reply_count > 0:
+            # the thread only embeds a few replies, the rest are fetched separately
+            if total_reply_count > len(item["replies"]["comments"]):
+                return True
+            # add only fetched replies equals total number of replies
+            for reply in item["replies"]["comments"]:
+                self._parse_reply(reply, comment_id, store)
+        return False
+
+    def _fetch_replies(self, parent_comment_id):
+        """
+        Retrieves every page of replies for a given comment.
+
+        Parameters:
+            parent_comment_id (str): ID of the top-level comment
+
+        Returns:
+            a CommentStore with the replies
+        """
+        replies_data = CommentStore()
+        # Token for the next set of replies
+        next_page_token_replies = None
+        while True:
+            replies = self._get_replies(
+                parent_id=parent_comment_id, next_page_token=next_page_token_replies
+            )
+            for reply in replies["items"]:
+                self._parse_reply(reply, parent_comment_id, replies_data)
+
+            # Update the token for the next set of replies
+            next_page_token_replies = replies.get("nextPageToken")
+            # Exit the loop if there are no more replies
+            if next_page_token_replies is None:
+                break
+        return replies_data
+
+    def fetch_comment_threads(self, video_id, max_workers=None):
+        """
+        Retrieves all comments and replies for a given video.
+
+        Parameters:
+            video_id (str): ID of the video
+            max_workers (int | None): number of reply threads fetched concurrently, defaults to max_reply_workers
+
+        Returns:
+            a CommentStore with the comments
+        """
         comments_with_replies = []
-        comments_data = []
+        comments_data = CommentStore()
         next_page_token = None
 
         while True:
             # Retrieve top-level comments
             comments = self._get_comments(video_id, next_page_token)
             for item in comments["items"]:
-                comment = item["snippet"]["topLevelComment"]
-                comment_id = item["id"]
-                total_reply_count = item["snippet"]["totalReplyCount"]
-                comments_data.append(
-                    {
-                        comment_id: {
-                            "author": comment["snippet"]["authorDisplayName"],
-                            "text": comment["snippet"]["textDisplay"],
-                            "likeCount": comment["snippet"]["likeCount"],
-                            "totalReplyCount": total_reply_count,
-                            "publishedAt": comment["snippet"]["publishedAt"],
-                        }
-                    }
-                )
-
-                if total_reply_count > 0:
-                    # add top level commenent ids to list only when fetched replies less than total
-                    if total_reply_count > len(item["replies"]["comments"]):
-                        comments_with_replies.append(item["id"])
-                    else:  # add only fetched replies equals total number of replies
-                        # comments_data[comment_id]['replies'] = {}
-                        for reply in item["replies"]["comments"]:
-                            reply_id = reply["id"].split(".")[1]
-                            comments_data.append(
-                                {
-                                    reply_id: {
-                                        "parentId": comment_id,
-                                        "author": reply["snippet"]["authorDisplayName"],
-                                        "text": reply["snippet"]["textDisplay"],
-                                        "likeCount": reply["snippet"]["likeCount"],
-                                        "publishedAt": comment["snippet"]["publishedAt"],
-                                    }
-                                }
-                            )
+                if self._parse_comment_thread(item, comments_data):
+                    comments_with_replies.append(item["id"])
             # Update the token for the next set of comments
             next_page_token = comments.get("nextPageToken")
             # Exit the loop if there are no more comments
             if next_page_token is None:
                 break
 
-        for parent_comment_id in comments_with_replies:
+        if max_workers is None:
+            max_workers = self.max_reply_workers
+        if max_workers <= 1 or len(comments_with_replies) <= 1:
+            for parent_comment_id in comments_with_replies:
+                comments_data.extend(self._fetch_replies(parent_comment_id))
+        else:
+            # map keeps the replies grouped in the same order as their parents
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(comments_with_replies))) as executor:
+                for replies_data in executor.map(propagate_context(self._fetch_replies), comments_with_replies):
+                    comments_data.extend(replies_data)
+        return comments_data
+
+    def stream_comment_threads(self, video_id, max_workers=None):
+        """
+        Retrieves the comments and replies for a given video page by page, yielding each page as soon as it
+        arrives. Reply threads are fetched in the background while the following top-level pages are read.
+
+        Parameters:
+            video_id (str): ID of the video
+            max_workers (int | None): number of reply threads fetched concurrently, defaults to max_reply_workers
+
+        Yields:
+            CommentStore pages
+        """
+        if max_workers is None:
+            max_workers = self.max_reply_workers
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        pending = set()
+        next_page_token = None
+        try:
             while True:
-                # Token for the next set of replies
-                next_page_token_replies = None
-                replies = self._get_replies(
-                    parent_id=parent_comment_id, next_page_token=next_page_token_replies
-                )
-                # comments_data[parent_comment_id]['replies'] = {}
-                for reply in replies["items"]:
-                    # parent_id = reply['snippet']['parentId']
-                    reply_id = reply["id"].split(".")[1]
-                    comments_data.append(
-                        {
-                            reply_id: {
-                                "parentId": parent_comment_id,
-                                "author": reply["snippet"]["authorDisplayName"],
-                                "text": reply["snippet"]["textDisplay"],
-                                "likeCount": reply["snippet"]["likeCount"],
-                                "publishedAt": reply["snippet"]["publishedAt"],
-                            }
-                        }
-                    )
-
-                # Update the token for the next set of replies
-                next_page_token_replies = replies.get("nextPageToken")
-                # Exit the loop if there are no more replies
-                if next_page_token_replies is None:
+                comments = self._get_comments(video_id, next_page_token)
+                page = CommentStore(capacity=len(comments["items"]))
+                for item in comments["items"]:
+                    if self._parse_comment_thread(item, page):
+                        pending.add(executor.submit(propagate_context(self._fetch_replies), item["id"]))
+                yield page
+
+                # hand over reply threads that finished meanwhile without waiting for the others
+                for future in [future for future in pending if future.done()]:
+                    pending.discard(future)
+                    yield future.result()
+
+                next_page_token = comments.get("nextPageToken")
+                if next_page_token is None:
                     break
-        return comments_data
+
+            for future in as_completed(pending):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -1,3 +1,4 @@
+import time
 from datetime import datetime
 
 import streamlit as st
@@ -7,28 +8,30 @@ import pandas as pd
 
 from apis.youtube.youtube_api import YouTubeAPI
 from apis.firestore.firestore_client import FirestoreClient
+from apis.sqlite.sqlite_client import SQLiteClient
 from apis.cohere.cohere_client import CohereClient
 from apis.pinecone.pinecone_client import PineconeClient
-from comment_analysis.topic_identifier import TopicIdentifier
+from apis.local_index.local_vector_index import LocalVectorIndex
 from comment_analysis.cluster_identifier import ClusterIdentifier
+from comment_analysis.cluster_summarizer import ClusterSummarizer
+from common.instrumentation import get_metrics, scope
+from pipeline.ingestion import CommentIngestionPipeline, CommentLimitExceeded
+from pipeline.jobs import AnalysisJobRunner, FAILED
+
+# Store of the comments: "firestore", or "sqlite" to keep them in a local SQLite database
+DOCUMENT_STORE = "firestore"
+# Index of the comment embeddings: "pinecone", or "local" to keep them in an in-process index persisted on disk
+VECTOR_INDEX = "pinecone"
+# Seconds between two refreshes of the page while a video is analyzed
+JOB_POLL_INTERVAL = 1.0
+# Memory allowed for the intermediate arrays of the clustering of a large video, in megabytes
+LARGE_VIDEO_MEMORY_BUDGET_MB = 1024
 
 
 def prepare_topics_for_display(topics_details):
-    topics = []
-    weights = []
-    for i, topic in topics_details.items():
-        topics_words_and_weights = []
-        for topic_word_and_weight in topic.split(" + "):
-            (weight, topic_word) = tuple(topic_word_and_weight.split("*")) 
-            topics_words_and_weights.append((float(weight), topic_word.replace("\"", ""))) 
-        topics_words_and_weights.sort(key=lambda x: x[0], reverse=True)
-        subtopics = [item[1] for item in topics_words_and_weights]
-        total_weights = sum([item[0] for item in topics_words_and_weights])
-        adjusted_weights = [item[0]/total_weights*100 for item in topics_words_and_weights]
-        topics.append(subtopics)
-        weights.append(adjusted_weights)
-    
-    return (topics, weights)        
+    # the words of every topic are already sorted by decreasing weight
+    weights = topics_details.word_weights / topics_details.word_weights.sum(axis=1, keepdims=True) * 100
+    return (topics_details.words, weights.tolist())
 
 
 def plot_pie_chart(labels, sizes):
@@ -51,36 +54,39 @@ def plot_pie_charts(labels, sizes):
         st.pyplot(fig)
 
 
-def display_topics(topics):
+def display_topics(topics, comments):
     topic_labels, weights = prepare_topics_for_display(topics)
     st.title("Topics discussed")
     plot_pie_charts(topic_labels, weights)
 
+    # the document-topic matrix is computed once per video, drilling into a topic doesn't run inference again
+    topic_sizes = topics.topic_sizes()
+    for topic_id, words in enumerate(topic_labels):
+        with st.expander(f"Topic {topic_id + 1} ({', '.join(words)}) - {topic_sizes[topic_id]} comments"):
+            for position in topics.topic_documents(topic_id, min_weight=0.5, limit=5):
+                st.write(comments[position])
+
 
 def find_author_by_comment_id(id, comments):
-    return [comment_details["author"] for comment in comments for comment_id, comment_details in comment.items() if comment_id == id][0]
+    return comments.author(id)
 
 
 def find_text_by_comment_id(id, comments):
-    return [comment_details["text"] for comment in comments for comment_id, comment_details in comment.items() if comment_id == id][0]
+    return comments.text(id)
 
 
-def prepare_clusters_for_display(cohere, clusters, firestore, video_id):
-    clusters.pop("-1","")
-    cluster_metrics = []
+def prepare_clusters_for_display(clusters, cluster_summaries):
     st.title("Comments clusters")
-    for cluster_id, comment_ids in clusters.items():
-        cluster_cardinality = len(comment_ids)
-        cluster_comments = []
-        full_comments = firestore.get_documents_by_ids(collection=video_id, document_ids=comment_ids)
-        cluster_comments = [comment["text"] for comment in full_comments if len(comment["text"]) < 100]
-        cluster_summary = cohere.summarize_comments("\n".join(cluster_comments[:15]))
-        cluster_metrics.append([cluster_id, cluster_summary, cluster_cardinality])
+    # the summaries are generated by the analysis job, concurrently and cached by cluster members
+    cluster_metrics = [
+        [cluster_id, cluster_summaries.get(cluster_id, ""), len(comment_ids)]
+        for cluster_id, comment_ids in clusters.items() if cluster_id != "-1"
+    ]
     return pd.DataFrame(cluster_metrics, columns=['Cluster ID', 'Cluster Summary', 'Cluster Cardinality'])
 
 
-def display_clusters(cohere, clusters, firestore, video_id):
-    df = prepare_clusters_for_display(cohere, clusters, firestore, video_id)
+def display_clusters(clusters, cluster_summaries):
+    df = prepare_clusters_for_display(clusters, cluster_summaries)
     hide_table_row_index = """
             <style>
             thead tr th:first-child {display:none}
@@ -93,34 +99,70 @@ def display_clusters(cohere, clusters, firestore, video_id):
     st.table(df)
 
 
+def display_metrics(video_id):
+    """
+    Shows the time, calls, items, payload sizes and retries of every operation of the analysis of a video in the
+    sidebar, with JSON and Prometheus exports.
+    """
+    metrics = get_metrics()
+    operations = metrics.snapshot(video_id)
+    st.sidebar.title("Performance metrics")
+    if not operations:
+        st.sidebar.write("No metrics were recorded for this video in this process")
+        return
+    df = pd.DataFrame.from_dict(operations, orient='index').sort_values('seconds', ascending=False)
+    st.sidebar.dataframe(df)
+    st.sidebar.download_button("Download as JSON", metrics.to_json(video_id),
+                               file_name=f"{video_id}-metrics.json", mime="application/json")
+    st.sidebar.download_button("Download as Prometheus text", metrics.to_prometheus(video_id),
+                               file_name=f"{video_id}-metrics.prom", mime="text/plain")
+
+
+@st.experimental_singleton
+def get_services():
+    """
+    Creates the API clients and the analysis job runner once per process. They are shared by all the sessions, so
+    the clients' caches and the results of the analyses are shared too.
+    """
+    youtube = YouTubeAPI()
+    if DOCUMENT_STORE == "sqlite":
+        firestore = SQLiteClient()
+    else:
+        firestore = FirestoreClient()
+    cohere = CohereClient()
+    cluster_model = ClusterIdentifier(cohere)
+    # large videos are clustered with a memory-bounded backend, their embeddings are memory-mapped
+    large_cluster_model = ClusterIdentifier(cohere, backend='minibatch_kmeans',
+                                            memory_budget_mb=LARGE_VIDEO_MEMORY_BUDGET_MB)
+    cluster_summarizer = ClusterSummarizer(cohere)
+    if VECTOR_INDEX == "local":
+        pinecone = LocalVectorIndex(index_name='youtube-comments')
+    else:
+        pinecone = PineconeClient(index_name='youtube-comments')
+    ingestion = CommentIngestionPipeline(youtube, firestore, cohere, pinecone)
+    job_runner = AnalysisJobRunner(ingestion, cluster_model, cluster_summarizer,
+                                   large_cluster_model=large_cluster_model)
+    return {
+        "youtube": youtube,
+        "firestore": firestore,
+        "cohere": cohere,
+        "pinecone": pinecone,
+        "job_runner": job_runner,
+    }
+
+
 def main():
     if "started" not in st.session_state:
         st.session_state["started"] = True
         st.session_state["videos"] = {}
         st.session_state["questions_asked"] = {}
+        st.session_state["jobs"] = {}
 
-        youtube = YouTubeAPI()
-        firestore = FirestoreClient()
-        topic_model = TopicIdentifier()
-        cluster_model = ClusterIdentifier()
-
-        cohere = CohereClient()
-        pinecone = PineconeClient(index_name='youtube-comments')
-        st.session_state["youtube"] = youtube
-        st.session_state["firestore"] = firestore
-        st.session_state["topic_model"] = topic_model
-        st.session_state["cluster_model"] = cluster_model
-        st.session_state["cohere"] = cohere
-        st.session_state["pinecone"] = pinecone
-
-    else:
-        st.session_state['started'] = True
-        youtube = st.session_state['youtube']
-        firestore = st.session_state['firestore']
-        topic_model = st.session_state['topic_model']
-        cluster_model = st.session_state['cluster_model']
-        cohere = st.session_state['cohere']
-        pinecone = st.session_state['pinecone']
+    services = get_services()
+    firestore = services['firestore']
+    cohere = services['cohere']
+    pinecone = services['pinecone']
+    job_runner = services['job_runner']
 
     # define the main interface components of the application
     st.header("TubeTalk")
@@ -141,56 +183,53 @@ def main():
         button = False
         video_id = None
 
-    if (youtube_url and button) or video_id in st.session_state.keys():
+    # the metrics of the video grow while its analysis runs, the panel is refreshed with the page
+    if video_id is not None and st.sidebar.checkbox("Show performance metrics"):
+        display_metrics(video_id)
+
+    if (youtube_url and button) or video_id in st.session_state['jobs'].keys():
         if 'youtube_url' in st.session_state.keys():
             if youtube_url != st.session_state['youtube_url']:
                 st.session_state['youtube_url'] = youtube_url
-                st.session_state.pop('question')
+                st.session_state.pop('question', None)
         else:
             st.session_state['youtube_url'] = youtube_url
         video_id = youtube_url.split('v=')[1].split('&')[0]
 
-        with st.spinner('Analyzing video comments'):
-            if video_id in st.session_state['videos'].keys():
-                # st.session_state['videos'][video_id] = {}  
-                all_comments = []
-                comments = st.session_state['videos'][video_id]['comments_raw']
-                topics = st.session_state['videos'][video_id]['topics']
-                clusters = st.session_state['videos'][video_id]['clusters']
-
-                for comment_metadata in comments:
-                    for k, v in comment_metadata.items():
-                        all_comments.append(v['text'])
-
-                display_topics(topics)
-                display_clusters(cohere, clusters, firestore, video_id)
-
+        # the analysis runs in the background, the page polls it until it is done
+        # comments are saved, embedded and indexed while they are being fetched
+        # sessions opening the same video share its job, which is only submitted again when its comments change
+        if button:
+            st.session_state['jobs'][video_id] = job_runner.submit(video_id)
+        job = st.session_state['jobs'][video_id]
+        if not job.finished:
+            st.progress(job.progress)
+            st.write(f"Analyzing video comments ({job.stage or 'waiting'})")
+            time.sleep(JOB_POLL_INTERVAL)
+            st.experimental_rerun()
+        if job.state == FAILED:
+            if isinstance(job.error, CommentLimitExceeded):
+                st.error(f"Please choose a video with less than {job_runner.comment_limit} comments")
             else:
-                # main part of the application which is extracting comments, topics and clusters
-                comments = youtube.fetch_comment_threads(video_id)
-                if len(comments) >= 500:
-                    st.error("Please choose a video with 500 comments or less")
-                    return
-                firestore.save_documents(collection=video_id, documents=comments)
-
-                st.session_state['videos'][video_id] = {}
-                all_comments = []
-                for comment_metadata in comments:
-                    for k, v in comment_metadata.items():
-                        all_comments.append(v['text'])
-
-                topic_model(texts=all_comments)
-                topic_model.identify_topics(num_topics=4)
-                topics = topic_model.extract_topics(num_words=4)
-                clusters = cluster_model.analyze_comments(comments=comments)
-                
-                st.session_state['videos'][video_id]['comments_raw'] = comments
-                st.session_state['videos'][video_id]['comments'] = all_comments
-                st.session_state['videos'][video_id]['topics'] = topics
-                st.session_state['videos'][video_id]['clusters'] = clusters
-
-                display_topics(topics)
-                display_clusters(cohere, clusters, firestore, video_id)
+                st.error(f"The analysis of the video comments failed: {job.error}")
+            return
+
+        if st.session_state['videos'].get(video_id, {}).get('fingerprint') != job.fingerprint:
+            comments = job.results['ingest']['comments']
+            st.session_state['videos'][video_id] = {'fingerprint': job.fingerprint}
+            st.session_state['videos'][video_id]['embedded_comments'] = job.results['ingest']['embeddings']
+            st.session_state['videos'][video_id]['pinecone_state'] = True
+            st.session_state['videos'][video_id]['comments_raw'] = comments
+            st.session_state['videos'][video_id]['comments'] = comments.texts.tolist()
+            st.session_state['videos'][video_id]['topics'] = job.results['topics']
+            st.session_state['videos'][video_id]['clusters'] = job.results['clusters']
+            st.session_state['videos'][video_id]['cluster_summaries'] = job.results['summaries']
+
+        comments = st.session_state['videos'][video_id]['comments_raw']
+        all_comments = st.session_state['videos'][video_id]['comments']
+        display_topics(st.session_state['videos'][video_id]['topics'], all_comments)
+        display_clusters(st.session_state['videos'][video_id]['clusters'],
+                         st.session_state['videos'][video_id]['cluster_summaries'])
 
         # st.write("Insights (grafice si metrici - topics / clusters")
 
@@ -204,7 +243,7 @@ def main():
         else:
             message = 'Wait a second while we find the answers to your question 🧐'
 
-        with st.spinner(message):
+        with st.spinner(message), scope(video_id):
             video_id = youtube_url.split('v=')[1].split('&')[0]
             if video_id in st.session_state['videos'].keys():
                 if 'embedded_comments' in st.session_state['videos'][video_id].keys():
@@ -216,11 +255,11 @@ def main():
                 if 'pinecone_state' in st.session_state['videos'][video_id].keys():
                     pass
                 else:
-                    ids = [list(comment_id.keys())[0] for comment_id in comments]
-
+                    ids = comments.ids.tolist()
                     parent_ids = [
-                        {"parentId": list(comment.values())[0]["parentId"]} if "parentId" in list(comment.values())[
-                            0] else {"parentId": "None"} for comment in comments]
+                        {"parentId": "None" if parent_id is None else parent_id, **({"moderation": moderation} if moderation else {})}
+                        for parent_id, moderation in zip(comments.parent_ids, comments.moderation)
+                    ]
                     pinecone_data = list(zip(ids, embedded_comments, parent_ids))
                     pinecone.save(vectors=pinecone_data, namespace=video_id)
 
@@ -250,7 +289,7 @@ def main():
 
                 if 'responses' not in st.session_state['videos'][video_id]:
                     question_embedding = cohere.embed(texts=[question])
-                    response_ids = pinecone.query(namespace=video_id, vector=question_embedding, top_k=8)
+                    response_ids = pinecone.query(namespace=video_id, vector=question_embedding[0], top_k=8)
                     st.session_state['videos'][video_id]['response_ids'] = response_ids
                     responses_texts = firestore.get_documents_by_ids(collection=video_id, document_ids=response_ids)
                     st.session_state['videos'][video_id]['responses_texts'] = responses_texts
@@ -261,7 +300,10 @@ def main():
                 for response in st.session_state['videos'][video_id]['responses_texts']:
                     response_texts.append(response['text'])
 
-                curated_responses = cohere.check_comments_are_appropriate(texts=response_texts)
+                # the labels are computed at ingestion and saved with the comments
+                curated_responses = [response.get('moderation') for response in st.session_state['videos'][video_id]['responses_texts']]
+                if None in curated_responses:
+                    curated_responses = cohere.check_comments_are_appropriate(texts=response_texts)
                 for appropriate_state, response in zip(curated_responses, st.session_state['videos'][video_id]['responses_texts']):
                     if appropriate_state == "appropriate":
                         st.markdown('---------------------------------')
@@ -0,0 +1,261 @@
+"""
+End-to-end benchmark of the comment analysis pipeline on synthetic videos, without any live service.
+
+For every size, a synthetic video is generated and served by local stand-ins of YouTube, Cohere, Firestore and
+Pinecone (see benchmarks/fakes.py) with a simulated latency per call. The stages of the analysis are timed one after
+the other on the real code:
+
+    fetch_comment_threads   YouTubeAPI paging and parsing of the comment threads and replies
+    process_comments        ClusterIdentifier._process_comments
+    ingestion               CommentIngestionPipeline.run (moderation, persistence, embedding and indexing)
+    identify_clusters       ClusterIdentifier._identify_clusters, with the backend used by the app for the size
+    lda_training            TopicIdentifier corpus building, LDA training and topic inference
+    summarization           ClusterSummarizer.summarize of all the clusters
+
+The results are written as JSON (--output) and can be compared with a previous run (--baseline), in which case the
+benchmark fails when a stage got slower than --max-slowdown times its baseline.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline --sizes 1000 10000 100000 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import comment_analysis.topic_identifier as topic_identifier
+from apis.cohere.cohere_client import CohereClient
+from apis.local_index.local_vector_index import LocalVectorIndex
+from apis.sqlite.sqlite_client import SQLiteClient
+from apis.youtube.youtube_api import YouTubeAPI
+from benchmarks.fakes import EMBEDDING_DIMENSIONS, FakeCohereClient, FakeYouTubeService, LatencyProxy
+from benchmarks.synthetic import MAX_REPLIES, MEAN_WORDS, REPLY_RATIO, WORDS_SIGMA, SyntheticCorpus
+from comment_analysis.cluster_identifier import ClusterIdentifier
+from comment_analysis.cluster_summarizer import ClusterSummarizer
+from common.embedding_cache import EmbeddingCache
+from pipeline.ingestion import CommentIngestionPipeline
+from pipeline.jobs import LARGE_VIDEO_MIN_COMMENTS, NUM_TOPICS, NUM_WORDS
+
+SIZES = [1_000, 10_000, 100_000]
+# Simulated latency of one call to each service, in seconds
+LATENCIES = {
+    "youtube": 0.05,
+    "cohere": 0.1,
+    "firestore": 0.02,
+    "pinecone": 0.02,
+}
+# A stage slower than its baseline by this factor is reported as a regression
+MAX_SLOWDOWN = 1.5
+# Differences under this many seconds are measurement noise, never regressions
+MIN_REGRESSION_SECONDS = 0.1
+VIDEO_ID = "benchmark"
+
+
+class _StageTimer:
+    """
+    Times the stages of one run and records the calls they made to the stand-ins.
+    """
+
+    def __init__(self, size, services):
+        self.size = size
+        self.services = services
+        self.results = []
+
+    def _calls(self):
+        return {
+            f"{name}.{method}": count
+            for name, service in self.services.items() for method, count in service.calls.items()
+        }
+
+    def run(self, stage, fn, *args, **kwargs):
+        calls_before = self._calls()
+        start = time.perf_counter()
+        value = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        calls = {
+            method: count - calls_before.get(method, 0)
+            for method, count in self._calls().items() if count != calls_before.get(method, 0)
+        }
+        result = {
+            "stage": stage,
+            "comments": self.size,
+            "seconds": seconds,
+            "microseconds_per_comment": seconds / self.size * 1e6,
+            "calls": calls,
+        }
+        self.results.append(result)
+        print(f"{self.size:>8} comments  {stage:<22} {seconds:9.3f}s  {sum(calls.values()):>6} calls",
+              file=sys.stderr, flush=True)
+        return value
+
+
+def run_size(size, latencies, dimensions, corpus_options, work_dir, backend=None):
+    """
+    Generates a synthetic video and times every stage of its analysis.
+
+    Parameters:
+        size (int): number of comments of the video
+        latencies (dict): simulated latency of every service, in seconds
+        dimensions (int): number of dimensions of the embeddings
+        corpus_options (dict): keyword arguments of SyntheticCorpus
+        work_dir (str): directory of the local stores, caches and corpora of the run
+        backend (str | None): clustering backend, defaults to the one the app uses for videos of this size
+
+    Returns:
+        a list with the result of every stage
+    """
+    corpus = SyntheticCorpus(size, **corpus_options)
+    services = {
+        "youtube": FakeYouTubeService(corpus, latency=latencies["youtube"]),
+        "cohere": FakeCohereClient(dimensions=dimensions, latency=latencies["cohere"]),
+        "firestore": LatencyProxy(SQLiteClient(os.path.join(work_dir, "documents.sqlite3")),
+                                  latency=latencies["firestore"]),
+        "pinecone": LatencyProxy(LocalVectorIndex(VIDEO_ID, data_dir=os.path.join(work_dir, "vector_index")),
+                                 latency=latencies["pinecone"]),
+    }
+    youtube = YouTubeAPI(service=services["youtube"])
+    cohere = CohereClient(embedding_cache=EmbeddingCache(cache_dir=os.path.join(work_dir, "embeddings")),
+                          client=services["cohere"])
+    if backend is None:
+        backend = "minibatch_kmeans" if size >= LARGE_VIDEO_MIN_COMMENTS else "dbscan"
+    cluster_identifier = ClusterIdentifier(cohere, backend=backend)
+    topic_identifier.TOPIC_DATA_DIR = os.path.join(work_dir, "topics")
+    timer = _StageTimer(size, services)
+
+    comments = timer.run("fetch_comment_threads", youtube.fetch_comment_threads, VIDEO_ID)
+    timer.run("process_comments", cluster_identifier._process_comments, comments)
+
+    ingestion = CommentIngestionPipeline(youtube, services["firestore"], cohere, services["pinecone"])
+    comments, embeddings = timer.run("ingestion", ingestion.run, VIDEO_ID)
+
+    cluster_identifier._process_comments(comments)
+    cluster_identifier._embedded_comments = embeddings
+    timer.run("identify_clusters", cluster_identifier._identify_clusters)
+    cluster_identifier._determine_cluster_comments()
+    clusters = {
+        cluster_id: comment_ids for cluster_id, comment_ids in cluster_identifier._clustered_comments.items()
+        if cluster_id != "-1"
+    }
+
+    def train_topics():
+        topic_model = topic_identifier.TopicIdentifier()
+        topic_model(texts=comments.texts.tolist(), video_id=VIDEO_ID)
+        topic_model.identify_topics(num_topics=NUM_TOPICS)
+        return topic_model.extract_topics(num_words=NUM_WORDS)
+
+    timer.run("lda_training", train_topics)
+    timer.run("summarization", ClusterSummarizer(cohere).summarize, clusters, comments)
+    return timer.results
+
+
+def find_regressions(results, baseline, max_slowdown=MAX_SLOWDOWN):
+    """
+    Compares the results of a run with the results of a previous run.
+
+    Parameters:
+        results (list[dict]): results of the run
+        baseline (list[dict]): results of the previous run
+        max_slowdown (float): a stage slower than its baseline by this factor is a regression
+
+    Returns:
+        a list of messages, one per regression
+    """
+    baseline_seconds = {(result["stage"], result["comments"]): result["seconds"] for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_seconds.get((result["stage"], result["comments"]))
+        if previous is None:
+            continue
+        if result["seconds"] > previous * max_slowdown and result["seconds"] - previous > MIN_REGRESSION_SECONDS:
+            regressions.append(
+                f"{result['stage']} at {result['comments']} comments: {result['seconds']:.3f}s "
+                f"instead of {previous:.3f}s ({result['seconds'] / previous:.1f}x)"
+            )
+    return regressions
+
+
+def _environment():
+    import gensim
+    import pandas
+    import sklearn
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "scikit-learn": sklearn.__version__,
+        "gensim": gensim.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--output", help="file the JSON results are written to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN)
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    parser.add_argument("--backend", help="clustering backend, defaults to the one the app uses for each size")
+    for service, latency in LATENCIES.items():
+        parser.add_argument(f"--{service}-latency", type=float, default=latency,
+                            help=f"seconds per {service} call (default {latency})")
+    parser.add_argument("--no-latency", action="store_true", help="don't simulate any latency")
+    parser.add_argument("--reply-ratio", type=float, default=REPLY_RATIO)
+    parser.add_argument("--max-replies", type=int, default=MAX_REPLIES)
+    parser.add_argument("--mean-words", type=float, default=MEAN_WORDS)
+    parser.add_argument("--words-sigma", type=float, default=WORDS_SIGMA)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    latencies = {
+        service: 0.0 if args.no_latency else getattr(args, f"{service}_latency") for service in LATENCIES
+    }
+    corpus_options = {
+        "reply_ratio": args.reply_ratio,
+        "max_replies": args.max_replies,
+        "mean_words": args.mean_words,
+        "words_sigma": args.words_sigma,
+        "seed": args.seed,
+    }
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="bench-pipeline-") as work_dir:
+            results.extend(run_size(size, latencies, args.dimensions, corpus_options, work_dir, args.backend))
+
+    report = {
+        "benchmark": "pipeline",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": _environment(),
+        "config": {
+            "sizes": args.sizes,
+            "latencies": latencies,
+            "dimensions": args.dimensions,
+            "backend": args.backend,
+            "corpus": corpus_options,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f)["results"], args.max_slowdown)
+        if regressions:
+            raise SystemExit("Performance regressions:\n" + "\n".join(regressions))
+        print(f"No stage is more than {args.max_slowdown}x slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of ClusterIdentifier._process_comments.
+
+Builds synthetic comment stores of increasing size and times the DataFrame construction, reporting the time per
+comment so that a super-linear regression (like the former per-row concat) shows up immediately.
+
+Run from the repository root:
+    python -m benchmarks.bench_process_comments
+"""
+import argparse
+import random
+import string
+import time
+
+from comment_analysis.cluster_identifier import ClusterIdentifier
+from common.comment_store import CommentStore
+
+SIZES = [1_000, 10_000, 100_000]
+# A slowdown per comment larger than this factor between the smallest and the largest size is reported
+MAX_SLOWDOWN = 3.0
+
+
+def make_comments(size, reply_ratio=0.3, seed=0):
+    """
+    Builds a store with size comments, a reply_ratio fraction of them being replies.
+    """
+    rng = random.Random(seed)
+    store = CommentStore(capacity=size)
+    top_level_ids = []
+    for i in range(size):
+        text = " ".join(
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(rng.randint(3, 60))
+        )
+        parent_id = rng.choice(top_level_ids) if top_level_ids and rng.random() < reply_ratio else None
+        store.add(
+            f"comment-{i}",
+            author=f"author-{rng.randint(0, size // 4)}",
+            text=text,
+            like_count=rng.randint(0, 100),
+            published_at="2023-01-20T10:00:00Z",
+            parent_id=parent_id,
+            total_reply_count=None if parent_id else 0,
+        )
+        if parent_id is None:
+            top_level_ids.append(f"comment-{i}")
+    return store
+
+
+def run(sizes=SIZES, repeat=3):
+    # the embedding client is never used by _process_comments
+    cluster_identifier = ClusterIdentifier(cohere_client=object())
+    results = []
+    for size in sizes:
+        comments = make_comments(size)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cluster_identifier._process_comments(comments)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results.append({"comments": size, "seconds": best, "microseconds_per_comment": best / size * 1e6})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    for result in results:
+        print(f"{result['comments']:>8} comments: {result['seconds']:.4f}s "
+              f"({result['microseconds_per_comment']:.2f} us/comment)")
+    slowdown = results[-1]["microseconds_per_comment"] / results[0]["microseconds_per_comment"]
+    if slowdown > MAX_SLOWDOWN:
+        raise SystemExit(f"_process_comments does not scale linearly: {slowdown:.1f}x slower per comment")
+    print(f"Scaling OK: {slowdown:.2f}x time per comment between the smallest and largest size")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Local stand-ins of the external services, used by the benchmarks.
+
+FakeYouTubeService and FakeCohereClient replace the googleapiclient resource and the cohere.Client used by
+YouTubeAPI and CohereClient, so the code of the clients themselves (paging, parsing, batching, caching) is measured.
+Firestore and Pinecone are replaced by the local SQLiteClient and LocalVectorIndex, which have the same interface,
+wrapped in a LatencyProxy. Every stand-in sleeps for a configurable latency on each call and counts its calls.
+"""
+import collections
+import hashlib
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+
+# Number of dimensions of the fake embeddings
+EMBEDDING_DIMENSIONS = 1024
+
+
+class _CallCounter:
+    """
+    Thread-safe count of the calls of every method of a stand-in
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self._calls_lock = threading.Lock()
+
+    def _record(self, method, latency):
+        with self._calls_lock:
+            self.calls[method] += 1
+        if latency > 0:
+            time.sleep(latency)
+
+
+class _Request:
+    def __init__(self, service, method, handler, parameters):
+        self._service = service
+        self._method = method
+        self._handler = handler
+        self._parameters = parameters
+
+    def execute(self):
+        self._service._record(self._method, self._service.latency)
+        return self._handler(**self._parameters)
+
+
+class _Resource:
+    def __init__(self, service, name, handler):
+        self._service = service
+        self._name = name
+        self._handler = handler
+
+    def list(self, **parameters):
+        return _Request(self._service, f"{self._name}.list", self._handler, parameters)
+
+
+class FakeYouTubeService(_CallCounter):
+    """
+    Stand-in of the YouTube Data API resource, serving the comments of a SyntheticCorpus for any video ID.
+    """
+
+    def __init__(self, corpus, latency=0.0):
+        """
+        Parameters:
+            corpus (SyntheticCorpus): comments served by the service
+            latency (float): seconds slept by every request
+        """
+        super().__init__()
+        self.corpus = corpus
+        self.latency = latency
+
+    def commentThreads(self):
+        return _Resource(self, "commentThreads", self._comment_threads)
+
+    def comments(self):
+        return _Resource(self, "comments", self._comments)
+
+    def videos(self):
+        return _Resource(self, "videos", self._videos)
+
+    def _comment_threads(self, pageToken=None, maxResults=20, **parameters):
+        start = int(pageToken or 0)
+        end = min(start + maxResults, self.corpus.num_threads)
+        response = {"items": [self.corpus.thread_resource(thread) for thread in range(start, end)]}
+        if end < self.corpus.num_threads:
+            response["nextPageToken"] = str(end)
+        return response
+
+    def _comments(self, parentId, pageToken=None, maxResults=20, **parameters):
+        thread = self.corpus.thread_of(parentId)
+        reply_count = int(self.corpus.reply_counts[thread])
+        start = int(pageToken or 0)
+        end = min(start + maxResults, reply_count)
+        response = {"items": [self.corpus.reply_resource(thread, reply) for reply in range(start, end)]}
+        if end < reply_count:
+            response["nextPageToken"] = str(end)
+        return response
+
+    def _videos(self, id, **parameters):
+        return {"items": [{"id": id, "statistics": {"commentCount": str(len(self.corpus))}}]}
+
+
+class FakeCohereClient(_CallCounter):
+    """
+    Stand-in of cohere.Client with deterministic outputs.
+
+    The embedding of a text is the normalized mean of pseudo-random vectors of its words, so texts sharing words
+    have similar embeddings. Classifications and generations are derived from a hash of the inputs.
+    """
+
+    def __init__(self, dimensions=EMBEDDING_DIMENSIONS, latency=0.0, seed=0):
+        """
+        Parameters:
+            dimensions (int): number of dimensions of the embeddings
+            latency (float): seconds slept by every call
+            seed (int): seed of the word vectors
+        """
+        super().__init__()
+        self.dimensions = dimensions
+        self.latency = latency
+        self.seed = seed
+        self._word_vectors = {}
+
+    def _word_vector(self, word):
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            rng = np.random.default_rng([self.seed, zlib.crc32(word.encode("utf-8"))])
+            vector = rng.standard_normal(self.dimensions).astype(np.float32)
+            self._word_vectors[word] = vector
+        return vector
+
+    def embed(self, texts, model=None, truncate=None):
+        self._record("embed", self.latency)
+        words = [text.split() for text in texts]
+        rows = [row for row, text_words in enumerate(words) if text_words]
+        embeddings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        if rows:
+            vectors = np.stack([self._word_vector(word) for row in rows for word in words[row]])
+            offsets = np.cumsum([0] + [len(words[row]) for row in rows[:-1]])
+            embeddings[rows] = np.add.reduceat(vectors, offsets)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        # the SDK returns lists of floats
+        return SimpleNamespace(embeddings=(embeddings / norms).tolist())
+
+    def classify(self, inputs, examples, model=None):
+        self._record("classify", self.latency)
+        labels = sorted({example.label for example in examples})
+        return [
+            SimpleNamespace(prediction=labels[zlib.crc32(text.encode("utf-8")) % len(labels)], confidence=1.0)
+            for text in inputs
+        ]
+
+    def generate(self, prompt, **parameters):
+        self._record("generate", self.latency)
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+        return SimpleNamespace(generations=[SimpleNamespace(text=f" Summary {digest}")])
+
+
+class LatencyProxy(_CallCounter):
+    """
+    Wraps a client, sleeping for latency seconds and counting the call before every call of one of its methods.
+    """
+
+    def __init__(self, target, latency=0.0):
+        """
+        Parameters:
+            target: the wrapped client
+            latency (float): seconds slept by every call
+        """
+        super().__init__()
+        self._target = target
+        self.latency = latency
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._record(name, self.latency)
+            return attribute(*args, **kwargs)
+
+        return call
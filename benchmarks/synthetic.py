@@ -0,0 +1,167 @@
+"""
+Synthetic comments of a YouTube video, used by the benchmarks.
+
+Comments are grouped in threads like the YouTube API returns them: a top-level comment followed by its replies
+(YouTube threads are one level deep, so the shape of a thread is its number of replies). Every thread is about one
+of a few topics, and its texts mix words of that topic with common words, so embeddings, clusters and topics
+computed on the corpus have some structure to find.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Share of the comments that are replies
+REPLY_RATIO = 0.3
+# Maximum number of replies of a thread
+MAX_REPLIES = 50
+# Mean number of words of a comment, the lengths follow a log-normal distribution
+MEAN_WORDS = 20
+# Standard deviation of the logarithm of the comment lengths
+WORDS_SIGMA = 0.8
+# Longest comment, in words
+MAX_WORDS = 500
+# Number of topics the threads are about
+NUM_TOPICS = 12
+# Number of words specific to every topic
+TOPIC_WORDS = 200
+# Number of words shared by all the topics
+COMMON_WORDS = 1000
+# Share of the words of a comment drawn from the words of its topic
+TOPIC_WORD_RATIO = 0.6
+# Number of replies embedded in a comment thread resource by the YouTube API
+INLINE_REPLIES = 5
+
+
+class SyntheticCorpus:
+    """
+    Comments of a synthetic video, in thread order: every top-level comment is followed by its replies.
+    """
+
+    def __init__(self, size, reply_ratio=REPLY_RATIO, max_replies=MAX_REPLIES, mean_words=MEAN_WORDS,
+                 words_sigma=WORDS_SIGMA, max_words=MAX_WORDS, num_topics=NUM_TOPICS, seed=0):
+        """
+        Generates the comments.
+
+        Parameters:
+            size (int): number of comments, top-level comments and replies
+            reply_ratio (float): share of the comments that are replies
+            max_replies (int): maximum number of replies of a thread
+            mean_words (float): mean number of words of a comment
+            words_sigma (float): standard deviation of the logarithm of the comment lengths
+            max_words (int): longest comment, in words
+            num_topics (int): number of topics the threads are about
+            seed (int): seed of the random generator, the same seed generates the same corpus
+        """
+        rng = np.random.default_rng(seed)
+        self.size = size
+
+        # replies per thread follow a geometric distribution whose mean gives the requested reply ratio
+        mean_replies = reply_ratio / (1 - reply_ratio) if reply_ratio < 1 else max_replies
+        reply_counts = []
+        total = 0
+        while total < size:
+            replies = min(int(rng.geometric(1 / (1 + mean_replies))) - 1, max_replies, size - total - 1)
+            reply_counts.append(replies)
+            total += replies + 1
+        self.thread_starts = np.concatenate([[0], np.cumsum(np.array(reply_counts) + 1)[:-1]]).astype(int)
+        self.reply_counts = np.array(reply_counts, dtype=int)
+        self.thread_ids = [f"thread{thread}" for thread in range(len(reply_counts))]
+        self._thread_index = {thread_id: thread for thread, thread_id in enumerate(self.thread_ids)}
+
+        thread_topics = rng.integers(0, num_topics, len(reply_counts))
+        topics = np.repeat(thread_topics, self.reply_counts + 1)
+        mu = np.log(mean_words) - words_sigma ** 2 / 2
+        lengths = np.clip(np.rint(rng.lognormal(mu, words_sigma, size)), 1, max_words).astype(int)
+        vocabulary = _pseudo_words(rng, num_topics * TOPIC_WORDS + COMMON_WORDS)
+        from_topic = rng.random(lengths.sum()) < TOPIC_WORD_RATIO
+        word_topics = np.repeat(topics, lengths)
+        word_ids = np.where(
+            from_topic,
+            word_topics * TOPIC_WORDS + rng.integers(0, TOPIC_WORDS, lengths.sum()),
+            num_topics * TOPIC_WORDS + rng.integers(0, COMMON_WORDS, lengths.sum()),
+        )
+        words = vocabulary[word_ids]
+        ends = np.cumsum(lengths)
+        self.texts = [" ".join(words[end - length:end]) for end, length in zip(ends, lengths)]
+        self.topics = topics
+        self.authors = [f"author{author}" for author in rng.integers(0, max(1, size // 4), size)]
+        self.like_counts = rng.zipf(2.0, size).clip(max=100_000) - 1
+        start = datetime(2023, 1, 20)
+        self.published_at = [
+            (start + timedelta(seconds=int(offset))).strftime("%Y-%m-%dT%H:%M:%SZ")
+            for offset in np.sort(rng.integers(0, 30 * 24 * 3600, size))
+        ]
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def num_threads(self):
+        return len(self.thread_ids)
+
+    def _snippet(self, position):
+        return {
+            "authorDisplayName": self.authors[position],
+            "textDisplay": self.texts[position],
+            "likeCount": int(self.like_counts[position]),
+            "publishedAt": self.published_at[position],
+        }
+
+    def reply_resource(self, thread, reply):
+        """
+        Returns a reply in the format of the YouTube comments resource.
+
+        Parameters:
+            thread (int): index of the thread
+            reply (int): index of the reply within the thread
+
+        Returns:
+            a dictionary
+        """
+        position = self.thread_starts[thread] + 1 + reply
+        thread_id = self.thread_ids[thread]
+        return {"id": f"{thread_id}.{thread_id}r{reply}", "snippet": self._snippet(position)}
+
+    def thread_resource(self, thread):
+        """
+        Returns a thread in the format of the YouTube commentThreads resource, with its first replies inline.
+
+        Parameters:
+            thread (int): index of the thread
+
+        Returns:
+            a dictionary
+        """
+        position = self.thread_starts[thread]
+        reply_count = int(self.reply_counts[thread])
+        resource = {
+            "id": self.thread_ids[thread],
+            "snippet": {
+                "topLevelComment": {"id": self.thread_ids[thread], "snippet": self._snippet(position)},
+                "totalReplyCount": reply_count,
+            },
+        }
+        if reply_count:
+            resource["replies"] = {
+                "comments": [self.reply_resource(thread, reply) for reply in range(min(reply_count, INLINE_REPLIES))]
+            }
+        return resource
+
+    def thread_of(self, thread_id):
+        """
+        Returns the index of a thread from its ID.
+        """
+        return self._thread_index[thread_id]
+
+
+def _pseudo_words(rng, count):
+    """
+    Returns count distinct pronounceable words
+    """
+    consonants = np.array(list("bcdfghjklmnprstvz"))
+    vowels = np.array(list("aeiou"))
+    words = set()
+    while len(words) < count:
+        syllables = rng.integers(2, 5)
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(syllables)))
+    return np.array(sorted(words))
@@ -3,17 +3,79 @@ from pandas import json_normalize
 import json
 import numpy as np
 import time
-import cohere
 from math import ceil
-from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+from apis.cohere.cohere_client import CohereClient
+from common.comment_store import CommentStore
+from common.instrumentation import instrumented
+from common.lru_cache import LRUCache
+from comment_analysis.clustering_backends import create_backend, euclidean_to_cosine
+
+# Share of the comments at the last full clustering that may be left unassigned before re-clustering a video
+DRIFT_THRESHOLD = 0.1
+# Growth of a video since its last full clustering after which it is re-clustered anyway
+MAX_GROWTH = 1.0
+# Memory held by the clustering states kept for incremental updates, in bytes
+VIDEO_STATES_BYTES = 256 * 1024 * 1024
+# Seconds for which the clustering state of a video is kept for incremental updates
+VIDEO_STATE_TTL = 6 * 60 * 60
+
+
+class _VideoClusters:
+    """
+    Clustering state kept per video for incremental updates
+    """
+
+    def __init__(self, comments, labels, backend):
+        self.comments = comments
+        self.labels = labels
+        self.backend = backend
+        self.comments_at_fit = len(comments)
+        self.unassigned_since_fit = 0
+        self.core_index = None
+        if len(backend.core_points_):
+            self.core_index = NearestNeighbors(n_neighbors=1).fit(backend.core_points_)
+
+    def drift(self):
+        return self.unassigned_since_fit / max(1, self.comments_at_fit)
+
+    def growth(self):
+        return (len(self.comments) - self.comments_at_fit) / max(1, self.comments_at_fit)
+
+    def size(self):
+        """
+        Returns an estimate of the memory held by the state, in bytes: the comment texts, the labels and the core
+        points, which are also copied by the core index
+        """
+        size = sum(len(text) for text in self.comments.texts) * 4 + self.labels.nbytes
+        if self.core_index is not None:
+            size += 2 * self.backend.core_points_.nbytes
+        return size
 
 
+@instrumented("clusters", exclude=("get_number_of_clusters", "get_cluster_comments"))
 class ClusterIdentifier:
 
-    _api_key = 'f1DZIoFirHG7l5CcbCyvF0J3ADU5pdlVBLZ7I1va'
-
-    def __init__(self):
-        self._cohere = cohere.Client(self._api_key)
+    def __init__(self, cohere_client=None, backend='dbscan', drift_threshold=DRIFT_THRESHOLD, max_growth=MAX_GROWTH,
+                 states_bytes=VIDEO_STATES_BYTES, state_ttl=VIDEO_STATE_TTL, **backend_options):
+        """
+        :param cohere_client: CohereClient used to embed the comments, its embeddings are shared through the
+        embedding cache with the rest of the application
+        :param backend: clustering engine, one of comment_analysis.clustering_backends.CLUSTERING_BACKENDS
+        :param drift_threshold: share of unassigned new comments that triggers a full re-clustering of a video
+        :param max_growth: relative growth of a video that triggers a full re-clustering
+        :param states_bytes: memory held by the clustering states kept for incremental updates, the least recently
+        used videos are dropped first
+        :param state_ttl: seconds for which the clustering state of a video is kept, None keeps it until it is dropped
+        :param backend_options: keyword arguments of the clustering engine (memory_budget_mb, eps, n_clusters, ...)
+        """
+        self._cohere = cohere_client or CohereClient()
+        self._backend_name = backend
+        self._backend_options = backend_options
+        self._drift_threshold = drift_threshold
+        self._max_growth = max_growth
+        self._videos = LRUCache(max_size=states_bytes, sizeof=_VideoClusters.size, ttl=state_ttl)
         self._data = None
         self._data_frame = None
         self._all_comments = None
@@ -24,67 +86,133 @@ class ClusterIdentifier:
 
     def _identify_clusters(self):
         """
-        Identify clusters of comments using DBSCAN
+        Identify clusters of comments with the configured clustering backend
         :return:
         """
-        variable_eps = len(self._embedded_comments) / 500
-        variable_samples = round(len(self._embedded_comments) / 80)
+        self._clusters = create_backend(self._backend_name, **self._backend_options).fit(self._embedded_comments)
+        self._num_clusters = max(self._clusters.labels_.tolist(), default=-1)
 
-        self._clusters = DBSCAN(eps=variable_eps, min_samples=variable_samples, metric='cosine').fit(self._embedded_comments)
-        self._num_clusters = max(self._clusters.labels_.tolist())
-
-    def _determine_cluster_comments(self):
+    def _determine_cluster_comments(self, labels=None, comment_ids=None):
         """
         Determine which comments belong to which cluster
+        :param labels: cluster of every comment, defaults to the labels of the last clustering
+        :param comment_ids: ids of the comments, defaults to the comments of the last clustering
         :return:
         """
-        for cluster_id in set(self._clusters.labels_):
-            self._clustered_comments[str(cluster_id)] = []
-
-        for comment_cluster, comment_id in zip(self._clusters.labels_, self._all_comment_ids):
+        if labels is None:
+            labels, comment_ids = self._clusters.labels_, self._all_comment_ids
+        # results are rebuilt for every analysis, so they never leak from one video to the next
+        self._clustered_comments = {str(cluster_id): [] for cluster_id in sorted(set(labels))}
+        for comment_cluster, comment_id in zip(labels, comment_ids):
             self._clustered_comments[str(comment_cluster)].append(comment_id)
 
-    def analyze_comments(self, comments):
+    def analyze_comments(self, comments, video_id=None, embeddings=None):
+        """
+        Clusters all the comments of a video
+        :param comments: CommentStore or list of dictionaries with key = comment id and value the comment details
+        :param video_id: when given, the clustering is kept (within states_bytes) so that update_comments can extend
+        it incrementally
+        :param embeddings: embeddings of the comments (a matrix or a memory map), in the order of the comments;
+        the comments are embedded when they are not given
+        :return: dictionary of cluster id -> list of comment ids, noise is cluster "-1"
+        """
         self._process_comments(comments=comments)
-        self._generate_comments_embeddings()
+        if embeddings is None:
+            self._generate_comments_embeddings()
+        else:
+            self._embedded_comments = embeddings
         self._identify_clusters()
         self._determine_cluster_comments()
+        if video_id is not None:
+            # the store is not modified afterwards, update_comments replaces it
+            self._videos.put(video_id, _VideoClusters(CommentStore.from_comments(comments),
+                                                      np.array(self._clusters.labels_), self._clusters))
+        return self._clustered_comments
+
+    def update_comments(self, video_id, comments, embeddings=None):
+        """
+        Clusters the current comments of a video, reusing its last clustering instead of re-clustering all of them.
+
+        The comments that were already clustered keep their cluster and the deleted ones are dropped. Every new
+        comment joins the cluster of its nearest core point when it lies within the assignment radius of the
+        backend, and is noise otherwise. A full re-clustering only runs when the share of comments left unassigned
+        since the last one crosses the drift threshold, when the video grew too much, or when the clustering of the
+        video is no longer kept.
+        :param video_id: ID of the video
+        :param comments: CommentStore or list of dictionaries with all the current comments of the video
+        :param embeddings: embeddings of the comments (a matrix or a memory map), in the order of the comments;
+        only the rows of the new comments are read. The new comments are embedded when they are not given
+        :return: dictionary of cluster id -> list of comment ids for all the comments of the video
+        """
+        state = self._videos.get(video_id)
+        if state is None:
+            return self.analyze_comments(comments, video_id=video_id, embeddings=embeddings)
+
+        comments = CommentStore.from_comments(comments)
+        known_rows = [state.comments.row(comment_id) for comment_id in comments.ids]
+        new_rows = np.array([row is None for row in known_rows], dtype=bool)
+        labels = np.full(len(comments), -1, dtype=state.labels.dtype)
+        labels[~new_rows] = state.labels[[row for row in known_rows if row is not None]]
+
+        new_positions = np.flatnonzero(new_rows)
+        if len(new_positions):
+            if embeddings is None:
+                new_comments = CommentStore(capacity=len(new_positions))
+                new_comments.extend([{comments.ids[i]: comments.details(i)} for i in new_positions])
+                self._process_comments(comments=new_comments)
+                self._generate_comments_embeddings()
+            else:
+                self._embedded_comments = np.asarray(embeddings[new_positions], dtype=np.float32)
+            if state.core_index is not None:
+                distances, nearest = state.core_index.kneighbors(state.backend.transform(self._embedded_comments))
+                assigned = euclidean_to_cosine(distances[:, 0]) <= state.backend.assignment_radius_
+                new_labels = np.full(len(new_positions), -1, dtype=labels.dtype)
+                new_labels[assigned] = state.backend.core_labels_[nearest[assigned, 0]]
+                labels[new_positions] = new_labels
+            state.unassigned_since_fit += int((labels[new_positions] == -1).sum())
+
+        state.comments = comments
+        state.labels = labels
+        if state.drift() > self._drift_threshold or state.growth() > self._max_growth:
+            return self.analyze_comments(comments, video_id=video_id, embeddings=embeddings)
+
+        # cached again, so that its size is recomputed
+        self._videos.put(video_id, state)
+        self._determine_cluster_comments(state.labels, state.comments.ids)
         return self._clustered_comments
 
+    def forget_video(self, video_id):
+        """
+        Drops the clustering state kept for a video
+        :param video_id: ID of the video
+        :return:
+        """
+        self._videos.pop(video_id, None)
+
     def _process_comments(self, comments):
-        df = pd.DataFrame(columns=['author', 'text', 'comment_id', 'parent_comment_id', 'like_count'])
-
-        for comment in comments:
-            for k, v in comment.items():
-                row = {
-                    'author': v['author'],
-                    'text': v['text'],
-                    'comment_id': k
-                }
-                tdf = pd.DataFrame([row])
-                df = pd.concat([df, tdf], ignore_index=True, axis=0)
-
-                if 'replies' in v.keys():
-                    for kk, vv in v['replies'].items():
-                        comment_id = kk.replace(k, '').replace('.', '')
-                        row = {
-                            'author': vv['author'],
-                            'text': vv['text'],
-                            'comment_id': comment_id,
-                            'parent_comment_id': k,
-                            'like_count': vv['like_count']
-                        }
-                        tdf = pd.DataFrame([row])
-                        df = pd.concat([df, tdf], ignore_index=True, axis=0)
+        """
+        Loads the comments into a DataFrame
+        :param comments: CommentStore or list of dictionaries with key = comment id and value the comment details
+        :return:
+        """
+        comments = CommentStore.from_comments(comments)
+        # build the frame in one go from the store columns
+        df = pd.DataFrame({
+            'author': comments.authors,
+            'text': comments.texts,
+            'comment_id': comments.ids,
+            'parent_comment_id': comments.parent_ids,
+            'like_count': comments.like_counts
+        })
 
         # truncate very large texts to the max length of 4096
-        df['text'] = df['text'].apply(lambda x: x[:4096])
+        df['text'] = df['text'].str.slice(0, 4096)
 
         # save attributes to object
         self._data_frame = df
         self._all_comments = self._data_frame['text'].tolist()
         self._all_comment_ids = self._data_frame['comment_id'].tolist()
-        self._top_level_comments = df[~df['comment_id'].isna()]
+        self._top_level_comments = df[df['parent_comment_id'].isna()]
         self._replies = df[~df['parent_comment_id'].isna()]
 
     def _generate_comments_embeddings(self):
@@ -92,7 +220,7 @@ class ClusterIdentifier:
         Embed comments using the cohere API
         :return:
         """
-        self._embedded_comments = self._cohere.embed(self._data_frame['text'].values.tolist()).embeddings
+        self._embedded_comments = self._cohere.embed(texts=self._data_frame['text'].values.tolist())
 
     def get_number_of_clusters(self):
         return self._num_clusters
@@ -0,0 +1,78 @@
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from apis.cohere.cohere_client import SUMMARY_GENERATION_PARAMS, SUMMARY_PROMPT_VERSION
+from common.instrumentation import instrumented, propagate_context
+from common.lru_cache import LRUCache
+
+# Number of summaries generated at the same time
+SUMMARY_MAX_WORKERS = 4
+# Number of cluster summaries kept in memory
+SUMMARY_CACHE_SIZE = 1024
+# Maximum number of comments of a cluster sent to the summarization prompt
+SUMMARY_MAX_COMMENTS = 15
+# Comments longer than this are left out of the summarization prompt
+SUMMARY_MAX_COMMENT_LENGTH = 100
+
+
+@instrumented("summaries", exclude=("summary_key",))
+class ClusterSummarizer:
+    """
+    This class is used to summarize the clusters of comments found by the ClusterIdentifier.
+
+    The summaries of all the clusters are generated concurrently. Every summary is cached under a hash of the
+    cluster member ids, the prompt version and the generation parameters, so a cluster whose members did not
+    change is never summarized twice.
+    """
+
+    def __init__(self, cohere_client, max_workers=SUMMARY_MAX_WORKERS, cache_size=SUMMARY_CACHE_SIZE):
+        """
+        :param cohere_client: CohereClient used to generate the summaries
+        :param max_workers: number of summaries generated at the same time
+        :param cache_size: number of summaries kept in memory
+        """
+        self._cohere = cohere_client
+        self.max_workers = max_workers
+        self._cache = LRUCache(max_size=cache_size)
+
+    @staticmethod
+    def summary_key(comment_ids):
+        """
+        Returns the cache key of the summary of a cluster
+        :param comment_ids: IDs of the comments of the cluster
+        :return: hex digest of the member ids, prompt version and generation parameters
+        """
+        digest = hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}\0".encode("utf-8"))
+        digest.update(json.dumps(SUMMARY_GENERATION_PARAMS, sort_keys=True).encode("utf-8"))
+        for comment_id in sorted(comment_ids):
+            digest.update(b"\0")
+            digest.update(comment_id.encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _prompt_comments(comment_ids, comments):
+        texts = (comments.text(comment_id) for comment_id in comment_ids if comment_id in comments)
+        short_texts = [text for text in texts if len(text) < SUMMARY_MAX_COMMENT_LENGTH]
+        return "\n".join(short_texts[:SUMMARY_MAX_COMMENTS])
+
+    def summarize(self, clusters, comments):
+        """
+        Summarizes clusters of comments
+        :param clusters: dictionary of cluster ID -> list of comment IDs
+        :param comments: CommentStore with the comments of the clusters
+        :return: dictionary of cluster ID -> summary
+        """
+        keys = {cluster_id: self.summary_key(comment_ids) for cluster_id, comment_ids in clusters.items()}
+        summaries = {cluster_id: self._cache.get(key) for cluster_id, key in keys.items()}
+        missing = [cluster_id for cluster_id, summary in summaries.items() if summary is None]
+
+        def summarize_cluster(cluster_id):
+            return self._cohere.summarize_comments(self._prompt_comments(clusters[cluster_id], comments))
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                for cluster_id, summary in zip(missing, executor.map(propagate_context(summarize_cluster), missing)):
+                    self._cache.put(keys[cluster_id], summary)
+                    summaries[cluster_id] = summary
+        return summaries
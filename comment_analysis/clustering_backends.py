@@ -0,0 +1,285 @@
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import DBSCAN, HDBSCAN, MiniBatchKMeans
+from sklearn.decomposition import PCA
+from sklearn.neighbors import NearestNeighbors
+
+from common.instrumentation import instrumented
+
+# Memory allowed for the intermediate arrays of a clustering run, in megabytes
+DEFAULT_MEMORY_BUDGET_MB = 2048
+# Number of dimensions the embeddings are projected to before looking for neighbors
+DEFAULT_N_COMPONENTS = 64
+# Maximum number of embeddings used to fit the projection
+PROJECTION_SAMPLE_SIZE = 10_000
+# Cosine distance under which two comments are neighbors for DBSCAN
+DEFAULT_EPS = 0.35
+# Quantile of the member -> centroid distances used as the assignment radius of centroid based backends
+ASSIGNMENT_RADIUS_QUANTILE = 0.95
+
+
+def chunk_rows(row_bytes, memory_budget_mb, minimum=1):
+    """
+    Returns how many rows of row_bytes bytes each fit in the memory budget
+    :param row_bytes: size of one row of the intermediate array, in bytes
+    :param memory_budget_mb: memory budget, in megabytes
+    :param minimum: lower bound of the result
+    :return: number of rows per chunk
+    """
+    return max(minimum, int(memory_budget_mb * 1024 * 1024 // max(row_bytes, 1)))
+
+
+def fit_projection(embeddings, n_components=DEFAULT_N_COMPONENTS, random_state=0):
+    """
+    Fits the PCA that projects normalized embeddings to n_components dimensions, on a sample of the embeddings
+    :param embeddings: matrix (or memory-mapped matrix) of embeddings, one row per comment
+    :param n_components: number of dimensions kept, None keeps all of them
+    :param random_state: seed of the sampling and of the PCA
+    :return: the fitted PCA, or None when no projection is needed
+    """
+    n_rows, n_dims = embeddings.shape
+    if n_components is None or n_dims <= n_components or n_rows <= n_components:
+        return None
+    sample = embeddings
+    if n_rows > PROJECTION_SAMPLE_SIZE:
+        rows = np.random.default_rng(random_state).choice(n_rows, PROJECTION_SAMPLE_SIZE, replace=False)
+        sample = embeddings[np.sort(rows)]
+    projection = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+    return projection.fit(_unit_rows(np.asarray(sample, dtype=np.float32)))
+
+
+def project_embeddings(embeddings, projection, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Normalizes and projects the embeddings to unit vectors, chunk by chunk.
+
+    On unit vectors the euclidean distance is a monotonic function of the cosine distance
+    (|a - b|^2 = 2 * cosine_distance), so tree and ANN neighbor indexes can be used instead of brute-force
+    cosine distances.
+    :param embeddings: matrix (or memory-mapped matrix) of embeddings, one row per comment
+    :param projection: PCA returned by fit_projection, or None
+    :param memory_budget_mb: memory budget of one chunk, in megabytes
+    :return: float32 matrix of unit vectors
+    """
+    n_rows, n_dims = embeddings.shape
+    out_dims = n_dims if projection is None else projection.n_components_
+    normalized = np.empty((n_rows, out_dims), dtype=np.float32)
+    step = chunk_rows(n_dims * 4 * 2, memory_budget_mb)
+    for start in range(0, n_rows, step):
+        chunk = _unit_rows(np.asarray(embeddings[start:start + step], dtype=np.float32))
+        if projection is not None:
+            chunk = _unit_rows(projection.transform(chunk).astype(np.float32))
+        normalized[start:start + step] = chunk
+    return normalized
+
+
+def _as_matrix(embeddings):
+    if not isinstance(embeddings, np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings
+
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def cosine_to_euclidean(distance):
+    """
+    Converts a cosine distance to the euclidean distance between the corresponding unit vectors
+    """
+    return float(np.sqrt(2 * distance))
+
+
+def euclidean_to_cosine(distance):
+    """
+    Converts the euclidean distance between two unit vectors to their cosine distance
+    """
+    return np.asarray(distance) ** 2 / 2
+
+
+@instrumented("clustering")
+class ClusteringBackend:
+    """
+    Base class of the clustering engines used by ClusterIdentifier.
+
+    fit works on the raw embeddings and sets:
+        labels_: cluster of every comment, -1 for noise
+        projection_: PCA applied to the normalized embeddings, None when they are used as they are
+        core_points_: unit vectors (in the normalized space) that represent the clusters
+        core_labels_: cluster of every core point
+        assignment_radius_: cosine distance within which a new comment joins the cluster of its nearest core point
+    """
+
+    def __init__(self, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, n_components=DEFAULT_N_COMPONENTS,
+                 random_state=0):
+        self.memory_budget_mb = memory_budget_mb
+        self.n_components = n_components
+        self.random_state = random_state
+        self.labels_ = None
+        self.projection_ = None
+        self.core_points_ = None
+        self.core_labels_ = None
+        self.assignment_radius_ = None
+
+    def transform(self, embeddings):
+        """
+        Maps embeddings to the normalized space of the fitted backend, where core_points_ live
+        :param embeddings: matrix of embeddings, one row per comment
+        :return: float32 matrix of unit vectors
+        """
+        return project_embeddings(_as_matrix(embeddings), self.projection_, self.memory_budget_mb)
+
+    def fit(self, embeddings):
+        """
+        Clusters the embeddings
+        :param embeddings: matrix of embeddings, one row per comment
+        :return: the backend
+        """
+        embeddings = _as_matrix(embeddings)
+        if len(embeddings) == 0:
+            self.labels_ = np.empty(0, dtype=int)
+            self.core_points_ = np.empty((0, 0), dtype=np.float32)
+            self.core_labels_ = np.empty(0, dtype=int)
+            self.assignment_radius_ = 0.0
+            return self
+        self.projection_ = fit_projection(embeddings, self.n_components, self.random_state)
+        self._fit_normalized(self.transform(embeddings))
+        return self
+
+    def _fit_normalized(self, normalized):
+        raise NotImplementedError
+
+    def _set_centroids(self, normalized, labels):
+        """
+        Uses the cluster centroids as core points, with a radius covering most of the cluster members
+        """
+        members = labels >= 0
+        cluster_ids, positions = np.unique(labels[members], return_inverse=True)
+        # sum the members of every cluster with one sparse product, the centroids are re-normalized anyway
+        membership = sparse.csr_matrix(
+            (np.ones(len(positions), dtype=np.float32), (positions, np.arange(len(positions)))),
+            shape=(len(cluster_ids), len(positions))
+        )
+        centroids = _unit_rows(np.asarray(membership @ normalized[members], dtype=np.float32))
+        self.core_points_ = centroids
+        self.core_labels_ = cluster_ids
+        if len(cluster_ids):
+            member_distances = 1 - np.einsum('ij,ij->i', normalized[members], centroids[positions])
+            self.assignment_radius_ = float(np.quantile(member_distances, ASSIGNMENT_RADIUS_QUANTILE))
+        else:
+            self.assignment_radius_ = 0.0
+
+
+@instrumented("dbscan")
+class DBSCANBackend(ClusteringBackend):
+    """
+    DBSCAN on normalized vectors with a euclidean neighbor index.
+
+    The eps-neighborhoods are computed chunk by chunk into a sparse distance graph, so memory grows with the number
+    of neighbors instead of with the square of the number of comments.
+    """
+
+    def __init__(self, eps=DEFAULT_EPS, min_samples=None, algorithm='auto', **kwargs):
+        """
+        :param eps: cosine distance under which two comments are neighbors
+        :param min_samples: neighbors needed by a core comment, defaults to 1 per 80 comments (between 2 and 50)
+        :param algorithm: neighbor index of sklearn.neighbors.NearestNeighbors (ball_tree, kd_tree, brute or auto)
+        """
+        super().__init__(**kwargs)
+        self.eps = eps
+        self.min_samples = min_samples
+        self.algorithm = algorithm
+
+    def _fit_normalized(self, normalized):
+        n_rows, n_dims = normalized.shape
+        min_samples = self.min_samples or min(max(2, round(n_rows / 80)), 50)
+        radius = cosine_to_euclidean(self.eps)
+
+        neighbors = NearestNeighbors(radius=radius, algorithm=self.algorithm).fit(normalized)
+        # a brute-force chunk holds chunk x n_rows distances, tree queries need less than that
+        step = chunk_rows(n_rows * 8, self.memory_budget_mb)
+        graph = sparse.vstack([
+            neighbors.radius_neighbors_graph(normalized[start:start + step], mode='distance')
+            for start in range(0, n_rows, step)
+        ]).tocsr()
+
+        dbscan = DBSCAN(eps=radius, min_samples=min_samples, metric='precomputed').fit(graph)
+        self.labels_ = dbscan.labels_
+        self.core_points_ = normalized[dbscan.core_sample_indices_]
+        self.core_labels_ = dbscan.labels_[dbscan.core_sample_indices_]
+        self.assignment_radius_ = self.eps
+
+
+@instrumented("hdbscan")
+class HDBSCANBackend(ClusteringBackend):
+    """
+    HDBSCAN on normalized vectors, with sklearn.cluster.HDBSCAN.
+    """
+
+    def __init__(self, min_cluster_size=None, min_samples=None, **kwargs):
+        """
+        :param min_cluster_size: smallest cluster, defaults to 1 per 100 comments (at least 5)
+        :param min_samples: neighbors needed by a core comment, defaults to min_cluster_size
+        """
+        super().__init__(**kwargs)
+        self.min_cluster_size = min_cluster_size
+        self.min_samples = min_samples
+
+    def _fit_normalized(self, normalized):
+        n_rows = len(normalized)
+        if n_rows < 2:
+            # HDBSCAN needs two samples, a single comment is noise
+            self.labels_ = np.full(n_rows, -1, dtype=int)
+        else:
+            # both parameters must be at most the number of samples, so tiny videos come out as noise
+            min_cluster_size = max(2, min(self.min_cluster_size or max(5, round(n_rows / 100)), n_rows))
+            min_samples = min(self.min_samples or min_cluster_size, n_rows)
+            hdbscan = HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples)
+            self.labels_ = hdbscan.fit(normalized).labels_
+        self._set_centroids(normalized, self.labels_)
+
+
+@instrumented("minibatch_kmeans")
+class MiniBatchKMeansBackend(ClusteringBackend):
+    """
+    Mini-batch k-means on normalized vectors. The normalized vectors are already in memory, so the model is fitted
+    on all of them, in mini-batches of batch_size until the centers converge. Every comment belongs to a cluster,
+    there is no noise.
+    """
+
+    def __init__(self, n_clusters=None, batch_size=1024, **kwargs):
+        """
+        :param n_clusters: number of clusters, defaults to sqrt(number of comments / 2) (between 2 and 100)
+        :param batch_size: comments per mini-batch
+        """
+        super().__init__(**kwargs)
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+
+    def _fit_normalized(self, normalized):
+        n_rows = len(normalized)
+        n_clusters = min(n_rows, self.n_clusters or min(max(2, int(np.sqrt(n_rows / 2))), 100))
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=self.batch_size, random_state=self.random_state,
+                                 n_init=3).fit(normalized)
+        self.labels_ = kmeans.labels_.astype(int)
+        self._set_centroids(normalized, self.labels_)
+
+
+CLUSTERING_BACKENDS = {
+    'dbscan': DBSCANBackend,
+    'hdbscan': HDBSCANBackend,
+    'minibatch_kmeans': MiniBatchKMeansBackend,
+}
+
+
+def create_backend(name, **options):
+    """
+    Creates a clustering backend by name
+    :param name: one of the keys of CLUSTERING_BACKENDS
+    :param options: keyword arguments of the backend
+    :return: a ClusteringBackend
+    """
+    if name not in CLUSTERING_BACKENDS:
+        raise ValueError(f"Unknown clustering backend {name}, expected one of {sorted(CLUSTERING_BACKENDS)}")
+    return CLUSTERING_BACKENDS[name](**options)
@@ -1,45 +1,359 @@
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import deque
+from itertools import chain, islice
+
 import gensim
-from gensim.utils import simple_preprocess
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from gensim.utils import grouper, simple_preprocess
 from gensim.parsing.preprocessing import STOPWORDS
 from gensim import corpora
+from gensim.models.ldamodel import LdaState
+
+from common.instrumentation import instrumented
+
+# Upper bound of the number of passes over the corpus when training a model
+MAX_PASSES = 50
+# Upper bound of the number of documents processed when training a model, across all the passes. Online LDA
+# updates the model once per chunk, so large corpora converge in fewer passes
+MAX_TRAINING_DOCUMENTS = 200_000
+# Training stops when a pass improves the per-word likelihood bound by less than this relative amount
+CONVERGENCE_TOLERANCE = 0.001
+# Maximum number of documents used to measure convergence after each pass
+CONVERGENCE_SAMPLE_SIZE = 2000
+# Number of topics used until identify_topics is called
+DEFAULT_NUM_TOPICS = 5
+# Directory where the dictionary, corpus and models of every video are persisted
+TOPIC_DATA_DIR = "cache/topics"
+# Number of texts tokenized by one worker process at a time
+PREPROCESSING_CHUNK_SIZE = 2000
+# Below this number of texts the tokenization runs in the current process
+PARALLEL_PREPROCESSING_MIN_TEXTS = 10_000
+# A model is retrained once the words it does not know make up this share of the tokens it was trained on
+VOCABULARY_DRIFT_THRESHOLD = 0.1
+# Number of documents inferred at once when computing the document-topic matrix
+INFERENCE_CHUNK_SIZE = 2000
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def _get_worker_pool():
+    """
+    Returns the worker processes shared by every TopicIdentifier of the process, created on first use. Analyses
+    running at the same time share them instead of starting one pool each and oversubscribing the cores
+    :return: a multiprocessing Pool
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = multiprocessing.Pool(TopicIdentifier._workers())
+            atexit.register(_worker_pool.terminate)
+        return _worker_pool
+
+
+def _e_step(model, chunk):
+    """
+    Infers the topics of a chunk of documents. Module level so that it can run in worker processes
+    :param model: LDA model, or the model pickled without its dictionary and training state
+    :param chunk: list of bag-of-words documents
+    :return: number of documents and their sufficient statistics
+    """
+    if isinstance(model, bytes):
+        model = pickle.loads(model)
+    gamma, sstats = model.inference(chunk, collect_sstats=True)
+    return len(gamma), sstats
+
+
+def _pickle_for_e_step(lda_model):
+    """
+    Pickles the part of a model needed by the E-step, leaving out the dictionary and the training state
+    """
+    inference_model = gensim.models.LdaModel.__new__(gensim.models.LdaModel)
+    inference_model.__dict__.update(lda_model.__dict__, id2word=None, state=None)
+    return pickle.dumps(inference_model, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _tokenize(texts):
+    """
+    Tokenizes texts, removing stopwords and punctuation. Module level so that it can run in worker processes
+    :param texts: list of texts
+    :return: list of lists of tokens
+    """
+    return [[word for word in simple_preprocess(text) if word not in STOPWORDS] for text in texts]
+
+
+def _text_hashes(texts):
+    """
+    Hashes every text, identifying the documents of a corpus independently of their order
+    :param texts: list of texts
+    :return: array of 64-bit hashes, one per text
+    """
+    return np.array([int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+                     for text in texts], dtype=np.uint64)
+
+
+def _corpus_rows(document_hashes, hashes):
+    """
+    Finds the corpus document of every text, the first one with the same text when it is repeated
+    :param document_hashes: hashes of the documents of the corpus, in the order of the corpus
+    :param hashes: hashes of the texts, all of them among the documents
+    :return: array of corpus positions, one per text
+    """
+    order = np.argsort(document_hashes, kind='stable')
+    return order[np.searchsorted(document_hashes[order], hashes)]
+
+
+class _ShardedCorpus:
+    """
+    Bag-of-words corpus made of serialized MmCorpus shards read one after the other. Texts added to a persisted
+    corpus are serialized into a new shard, so the documents already on disk are never rewritten
+    """
 
+    def __init__(self, paths):
+        self.shards = [corpora.MmCorpus(path) for path in paths]
 
+    def __iter__(self):
+        return chain.from_iterable(self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+def _chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class TopicResult:
+    """
+    Topics identified in a set of texts.
+
+    Attributes:
+        words: list with the top words of every topic, by decreasing weight
+        word_weights: array of shape (num_topics, num_words) with the probability of every top word in its topic
+        document_topics: array of shape (num_texts, num_topics) with the topic distribution of every text
+    """
+
+    def __init__(self, words, word_weights, document_topics):
+        self.words = words
+        self.word_weights = word_weights
+        self.document_topics = document_topics
+
+    @property
+    def num_topics(self):
+        return len(self.words)
+
+    def dominant_topics(self):
+        """
+        Returns the most likely topic of every text
+        :return: array of topic ids, one per text
+        """
+        return self.document_topics.argmax(axis=1)
+
+    def topic_documents(self, topic_id, min_weight=0.0, limit=None):
+        """
+        Returns the texts about a topic, most relevant first
+        :param topic_id: ID of the topic
+        :param min_weight: minimum weight of the topic in the texts
+        :param limit: maximum number of texts returned
+        :return: array of text positions
+        """
+        weights = self.document_topics[:, topic_id]
+        positions = np.flatnonzero(weights >= min_weight)
+        positions = positions[np.argsort(-weights[positions], kind='stable')]
+        return positions[:limit]
+
+    def topic_sizes(self):
+        """
+        Returns the number of texts whose most likely topic is each topic
+        :return: array of counts, one per topic
+        """
+        return np.bincount(self.dominant_topics(), minlength=self.num_topics)
+
+
+@instrumented("topics", exclude=("_corpus_paths", "_workers"))
 class TopicIdentifier:
     """
     This class is used to identify topics in a set of texts. It uses the LDA (Latent Dirichlet Allocation) model.
 
     Attributes:
         _texts: list of texts
-        _processed_texts: list of texts after processing
+        _processed_texts: list of texts after processing, None when the corpus is streamed from disk
         _dictionary: dictionary of words
-        _doc_term_matrix: list of tuples (word_id, word_count)
+        _doc_term_matrix: bag-of-words corpus, a list of lists of tuples (word_id, word_count) or a _ShardedCorpus
+        _video_id: ID of the video whose corpus is persisted under TOPIC_DATA_DIR
+        _document_hashes: hashes of the texts of the documents of the persisted corpus, in the order of the corpus
+        _text_rows: corpus position of every text, None when the texts are the documents of the corpus in order
+        _vocabulary_drift: by number of topics, [tokens unknown to the model, tokens the model was trained on]
         _num_topics: number of topics to identify
         _lda_model: LDA (Latent Dirichlet Allocation) model used to identify topics
+        _lda_models: models already trained on the texts, by number of topics
+        _document_topics: document-topic matrices of the current corpus, by number of topics
+
+    Models are trained lazily: setting the texts only prepares the corpus, and a model is trained the first time
+    topics are requested for a given number of topics.
+
+    When the texts belong to a video, the tokenization runs in chunks across a process pool, the dictionary and
+    the bag-of-words corpus are streamed to disk in gensim's serialized formats and training reads the corpus
+    back from disk. The persisted corpus is keyed on the set of its texts: setting texts of the video that only add
+    to that set, in any order, reuses the corpus and the models saved with it and adds the new texts only.
+
+    update_texts adds new texts incrementally: the dictionary is extended with their vocabulary, the new documents
+    are appended to the corpus as a new shard and the trained models are updated online with them only, keeping
+    their topic ids.
     """
 
     def __init__(self, texts=None):
+        self._num_topics = DEFAULT_NUM_TOPICS
+        self._lda_model = None
+        self._lda_models = {}
+        self._document_topics = {}
+        self._vocabulary_drift = {}
+        self._video_id = None
+        self._dictionary = None
+        self._document_hashes = None
+        self._text_rows = None
         if texts is not None:
-            self._texts = texts
-            self._processed_texts = self._process_clean_texts()
-            self._create_dictionary()
-            self._create_lda_model()
+            self.set_texts(texts)
 
-    def __call__(self, texts):
-        self._texts = texts
-        self._processed_texts = self._process_clean_texts()
-        self._create_dictionary()
-        self._create_lda_model()
+    def __call__(self, texts, video_id=None):
+        self.set_texts(texts, video_id=video_id)
 
     def _process_clean_texts(self):
         """
         Process and cleans the texts by removing stopwords and punctuation
         :returns list of processed texts
         """
-        processed_texts = []
-        for text in self._texts:
-            words = simple_preprocess(text)
-            processed_texts.append([word for word in words if word not in STOPWORDS])
-        return processed_texts
+        return [tokens for chunk in self._tokenize_chunks(self._texts) for tokens in chunk]
+
+    def _tokenize_chunks(self, texts):
+        """
+        Tokenizes texts chunk by chunk, across a process pool for large corpora
+        :param texts: list of texts
+        :return: generator of lists of processed texts, in the order of the texts
+        """
+        chunks = _chunks(texts, PREPROCESSING_CHUNK_SIZE)
+        if len(texts) < PARALLEL_PREPROCESSING_MIN_TEXTS:
+            yield from map(_tokenize, chunks)
+            return
+        workers = self._workers()
+        pool = _get_worker_pool()
+        # a bounded number of chunks in flight keeps the memory flat on large corpora
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_tokenize, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _corpus_paths(self):
+        directory = os.path.join(TOPIC_DATA_DIR, self._video_id)
+        return {
+            'directory': directory,
+            'dictionary': os.path.join(directory, 'dictionary.gensim'),
+            'corpus': os.path.join(directory, 'corpus-{shard}.mm'),
+            'hashes': os.path.join(directory, 'corpus-{shard}.hashes.npy'),
+            'metadata': os.path.join(directory, 'metadata.json'),
+            'model': os.path.join(directory, 'lda-{num_topics}.gensim'),
+        }
+
+    def _read_metadata(self):
+        with open(self._corpus_paths()['metadata']) as f:
+            return json.load(f)
+
+    def _write_metadata(self, metadata):
+        with open(self._corpus_paths()['metadata'], 'w') as f:
+            json.dump(metadata, f)
+
+    def _load_corpus(self):
+        """
+        Loads the dictionary and corpus persisted for the video
+        :return: hashes of the documents of the corpus, None when the video has no persisted corpus
+        """
+        paths = self._corpus_paths()
+        if not os.path.exists(paths['metadata']):
+            return None
+        metadata = self._read_metadata()
+        if 'shards' not in metadata:
+            # persisted by a version that kept the corpus in a single file, it is rebuilt
+            return None
+        self._vocabulary_drift = {int(num_topics): drift for num_topics, drift in metadata['models'].items()}
+        self._dictionary = corpora.Dictionary.load(paths['dictionary'])
+        shards = range(metadata['shards'])
+        self._doc_term_matrix = _ShardedCorpus([paths['corpus'].format(shard=shard) for shard in shards])
+        return np.concatenate([np.load(paths['hashes'].format(shard=shard)) for shard in shards])
+
+    def _build_corpus(self, hashes):
+        """
+        Streams the tokenized texts into the dictionary and then into a serialized corpus on disk. The tokens are
+        spilled to a temporary file between the two passes, so the texts never have to be all in memory at once.
+        Whatever was persisted for the video before, models included, is deleted
+        :param hashes: hashes of the texts, saved with the corpus
+        :return: None
+        """
+        paths = self._corpus_paths()
+        shutil.rmtree(paths['directory'], ignore_errors=True)
+        os.makedirs(paths['directory'])
+        corpus_path = paths['corpus'].format(shard=0)
+        self._dictionary = corpora.Dictionary()
+        with tempfile.TemporaryFile(mode='w+', dir=paths['directory']) as tokens_file:
+            for chunk in self._tokenize_chunks(self._texts):
+                self._dictionary.add_documents(chunk)
+                tokens_file.writelines(json.dumps(tokens) + '\n' for tokens in chunk)
+            tokens_file.seek(0)
+            corpora.MmCorpus.serialize(corpus_path,
+                                       (self._dictionary.doc2bow(json.loads(line)) for line in tokens_file),
+                                       id2word=self._dictionary)
+        np.save(paths['hashes'].format(shard=0), hashes)
+        self._dictionary.save(paths['dictionary'])
+        self._write_metadata({'num_docs': len(self._texts), 'shards': 1, 'models': {}})
+        self._doc_term_matrix = _ShardedCorpus([corpus_path])
+        self._document_hashes = hashes
+        self._vocabulary_drift = {}
+
+    def _append_to_corpus(self, new_texts, new_hashes):
+        """
+        Adds texts to the dictionary and to the corpus. The documents of a video are serialized into a new shard of
+        its corpus, the metadata is written last so that an interrupted append leaves the previous corpus intact
+        :param new_texts: list of texts
+        :param new_hashes: hashes of the texts, None when the corpus is not persisted
+        :return: bag-of-words of the new texts
+        """
+        new_tokens = [tokens for chunk in self._tokenize_chunks(new_texts) for tokens in chunk]
+        self._dictionary.add_documents(new_tokens)
+        new_bows = [self._dictionary.doc2bow(tokens) for tokens in new_tokens]
+        if self._video_id is None:
+            self._processed_texts.extend(new_tokens)
+            self._doc_term_matrix.extend(new_bows)
+            return new_bows
+
+        paths = self._corpus_paths()
+        metadata = self._read_metadata()
+        shard = metadata['shards']
+        corpus_path = paths['corpus'].format(shard=shard)
+        corpora.MmCorpus.serialize(corpus_path, new_bows, id2word=self._dictionary)
+        np.save(paths['hashes'].format(shard=shard), new_hashes)
+        self._dictionary.save(paths['dictionary'])
+        metadata.update({'num_docs': metadata['num_docs'] + len(new_texts), 'shards': shard + 1})
+        self._write_metadata(metadata)
+        self._doc_term_matrix.shards.append(corpora.MmCorpus(corpus_path))
+        self._document_hashes = np.concatenate([self._document_hashes, new_hashes])
+        return new_bows
 
     def _create_dictionary(self):
         """
@@ -49,41 +363,288 @@ class TopicIdentifier:
         self._dictionary = corpora.Dictionary(self._processed_texts)
         self._doc_term_matrix = [self._dictionary.doc2bow(text) for text in self._processed_texts]
 
-    def _create_lda_model(self, num_topics=5):
+    def _create_lda_model(self, num_topics=DEFAULT_NUM_TOPICS):
         """
-        Creates the LDA model with the specified number of topics
+        Trains the LDA model with the specified number of topics, one pass at a time until the likelihood bound
+        converges (at most MAX_PASSES passes, and at most MAX_TRAINING_DOCUMENTS documents)
         :param num_topics: number of topics to identify in the texts
+        :return: the trained model
+        """
+        lda_model = gensim.models.LdaModel(num_topics=num_topics, id2word=self._dictionary)
+        max_passes = min(MAX_PASSES, max(1, MAX_TRAINING_DOCUMENTS // max(1, len(self._doc_term_matrix))))
+        self._train_until_converged(lda_model, max_passes, self._workers())
+        return lda_model
+
+    def _train_until_converged(self, lda_model, max_passes, workers):
+        """
+        Runs online passes over the corpus until a pass improves the per-word likelihood bound of a sample of
+        documents by less than CONVERGENCE_TOLERANCE. Like LdaMulticore.update, the E-steps of the chunks run in
+        worker processes and their statistics are merged into one M-step every `workers` chunks, but the workers
+        are the process-wide pool, shared with the other trainings, and convergence is checked after every pass
+        :param lda_model: model to train, created without a corpus
+        :param max_passes: maximum number of passes
+        :param workers: number of worker processes, with 1 the E-steps run in the current process
         :return: None
         """
-        self._num_topics = num_topics
-        self._lda_model = gensim.models.LdaMulticore(self._doc_term_matrix
-                                                         , num_topics=num_topics
-                                                         , id2word=self._dictionary
-                                                         , passes=50
-                                                         , workers=2
-                                                     )
-
-    def set_texts(self, texts):
+        corpus = self._doc_term_matrix
+        if len(corpus) == 0:
+            return
+        sample = list(islice(corpus, CONVERGENCE_SAMPLE_SIZE))
+        update_after = lda_model.chunksize * workers
+        lda_model.state.numdocs += len(corpus)
+        pool = _get_worker_pool() if workers > 1 else None
+        other = LdaState(lda_model.eta, lda_model.state.sstats.shape, lda_model.dtype)
+        model = lda_model if pool is None else _pickle_for_e_step(lda_model)
+
+        def merge(result, pass_):
+            nonlocal model
+            numdocs, sstats = result
+            other.sstats += sstats
+            other.numdocs += numdocs
+            if other.numdocs >= update_after:
+                m_step(pass_)
+                if pool is not None:
+                    model = _pickle_for_e_step(lda_model)
+
+        def m_step(pass_):
+            rho = pow(lda_model.offset + pass_ + lda_model.num_updates / lda_model.chunksize, -lda_model.decay)
+            lda_model.do_mstep(rho, other, pass_ > 0)
+            other.reset()
+
+        bound = None
+        for pass_ in range(max_passes):
+            pending = deque()
+            for chunk in grouper(corpus, lda_model.chunksize):
+                if pool is None:
+                    merge(_e_step(model, chunk), pass_)
+                    continue
+                pending.append(pool.apply_async(_e_step, (model, chunk)))
+                # results are merged in order, the oldest one as soon as it is ready
+                while pending and (pending[0].ready() or len(pending) >= 2 * workers):
+                    merge(pending.popleft().get(), pass_)
+            while pending:
+                merge(pending.popleft().get(), pass_)
+            if other.numdocs:
+                m_step(pass_)
+                if pool is not None:
+                    model = _pickle_for_e_step(lda_model)
+
+            previous_bound, bound = bound, lda_model.log_perplexity(sample)
+            if previous_bound is not None and \
+                    abs(bound - previous_bound) <= CONVERGENCE_TOLERANCE * abs(previous_bound):
+                break
+
+    @staticmethod
+    def _workers():
+        """
+        Number of LDA worker processes, one core is left for the master process that merges their results
+        :return: number of workers
+        """
+        return max(1, (os.cpu_count() or 2) - 1)
+
+    def _get_lda_model(self):
+        """
+        Returns the model for the current number of topics, loading it from the video data or training it on
+        first use
+        :return: the LDA model
+        """
+        if self._num_topics not in self._lda_models:
+            lda_model = self._load_lda_model(self._num_topics)
+            if lda_model is None:
+                lda_model = self._create_lda_model(self._num_topics)
+                self._vocabulary_drift[self._num_topics] = [0, self._dictionary.num_pos]
+                self._save_lda_model(self._num_topics, lda_model)
+            self._lda_models[self._num_topics] = lda_model
+        self._lda_model = self._lda_models[self._num_topics]
+        return self._lda_model
+
+    def _load_lda_model(self, num_topics):
+        if self._video_id is None or num_topics not in self._vocabulary_drift:
+            return None
+        lda_model = gensim.models.LdaModel.load(self._corpus_paths()['model'].format(num_topics=num_topics))
+        # share the dictionary, so that vocabulary added later is visible to the model
+        lda_model.id2word = self._dictionary
+        return lda_model
+
+    def _load_lda_models(self):
+        for num_topics in self._vocabulary_drift:
+            self._lda_models[num_topics] = self._load_lda_model(num_topics)
+
+    def _save_lda_model(self, num_topics, lda_model):
+        if self._video_id is None:
+            return
+        lda_model.save(self._corpus_paths()['model'].format(num_topics=num_topics))
+        metadata = self._read_metadata()
+        metadata.setdefault('models', {})[str(num_topics)] = self._vocabulary_drift[num_topics]
+        self._write_metadata(metadata)
+
+    def _update_lda_model(self, num_topics, new_bows):
+        """
+        Updates a trained model with new documents. Words added to the dictionary after the model was trained are
+        unknown to it, so they are left out of the update; once they make up too large a share of the corpus the
+        model is retrained and its topics are aligned with the previous ones
+        :param num_topics: number of topics of the model
+        :param new_bows: bag-of-words of the new documents
+        :return: None
+        """
+        lda_model = self._lda_models[num_topics]
+        known_bows = [[(word_id, count) for word_id, count in bow if word_id < lda_model.num_terms] for bow in new_bows]
+        drift = self._vocabulary_drift.setdefault(num_topics, [0, self._dictionary.num_pos])
+        drift[0] += sum(count for bow in new_bows for word_id, count in bow if word_id >= lda_model.num_terms)
+
+        if drift[0] > VOCABULARY_DRIFT_THRESHOLD * drift[1]:
+            retrained_model = self._create_lda_model(num_topics)
+            self._align_topics(retrained_model, lda_model)
+            self._lda_models[num_topics] = retrained_model
+            self._vocabulary_drift[num_topics] = [0, self._dictionary.num_pos]
+        elif any(known_bows):
+            lda_model.update([bow for bow in known_bows if bow])
+        self._save_lda_model(num_topics, self._lda_models[num_topics])
+
+    @staticmethod
+    def _align_topics(lda_model, previous_model):
+        """
+        Reorders the topics of a retrained model so that each one keeps the id of the most similar previous topic
+        :param lda_model: the retrained model, reordered in place
+        :param previous_model: the model it replaces
+        :return: None
+        """
+        num_terms = previous_model.num_terms
+        topics = lda_model.get_topics()[:, :num_terms]
+        previous_topics = previous_model.get_topics()
+        similarity = (topics / np.linalg.norm(topics, axis=1, keepdims=True)) @ \
+                     (previous_topics / np.linalg.norm(previous_topics, axis=1, keepdims=True)).T
+        # order[i] is the retrained topic that takes the id i of the previous model
+        _, order = linear_sum_assignment(-similarity.T)
+        lda_model.state.sstats = lda_model.state.sstats[order]
+        if np.ndim(lda_model.alpha):
+            lda_model.alpha = lda_model.alpha[order]
+        lda_model.sync_state()
+
+    def set_texts(self, texts, video_id=None):
+        """
+        Prepares the corpus of the texts, the models trained on previous texts are discarded. When the texts of a
+        video only add to its persisted corpus, the corpus and its models are kept and updated with the new texts
+        :param texts: list of texts
+        :param video_id: ID of the video the texts belong to, its corpus is persisted and reused
+        :return: None
+        """
+        self._video_id = video_id
+        self._vocabulary_drift = {}
+        self._lda_model = None
+        self._lda_models = {}
+        self._document_topics = {}
+        self._text_rows = None
+        if video_id is None:
+            self._texts = texts
+            self._processed_texts = self._process_clean_texts()
+            self._create_dictionary()
+            return
+
+        self._processed_texts = None
+        hashes = _text_hashes(texts)
+        stored_hashes = self._load_corpus()
+        if stored_hashes is None or not np.isin(stored_hashes, hashes).all():
+            # documents cannot be removed from trained models, so texts that were deleted rebuild everything
+            self._texts = texts
+            self._build_corpus(hashes)
+            return
+
+        self._document_hashes = stored_hashes
+        self._load_lda_models()
+        new_positions = np.flatnonzero(~np.isin(hashes, stored_hashes))
+        # a text repeated among the new ones is added once, like the texts already in the corpus
+        _, first_positions = np.unique(hashes[new_positions], return_index=True)
+        new_positions = np.sort(new_positions[first_positions])
+        if len(new_positions):
+            self._add_texts([texts[position] for position in new_positions], hashes[new_positions])
         self._texts = texts
-        self._processed_texts = self._process_clean_texts()
-        self._create_dictionary()
-        self._create_lda_model()
+        rows = _corpus_rows(self._document_hashes, hashes)
+        if not np.array_equal(rows, np.arange(len(self._document_hashes))):
+            self._text_rows = rows
+
+    def update_texts(self, new_texts, video_id=None):
+        """
+        Adds new texts to the corpus and updates the models already trained with them, instead of retraining from
+        scratch. The work is proportional to the number of new texts
+        :param new_texts: list of texts that were not part of the corpus yet
+        :param video_id: ID of the video; when the texts of the video were not set in this instance, its persisted
+        dictionary, corpus and models are loaded
+        :return: None
+        """
+        if video_id is not None and video_id != self._video_id:
+            self._video_id = video_id
+            self._texts = []
+            self._lda_model = None
+            self._lda_models = {}
+            self._document_topics = {}
+            self._text_rows = None
+            self._document_hashes = self._load_corpus()
+            if self._document_hashes is None:
+                self.set_texts(new_texts, video_id=video_id)
+                return
+            self._load_lda_models()
+        elif self._dictionary is None:
+            self.set_texts(new_texts, video_id=video_id)
+            return
+
+        num_docs = len(self._doc_term_matrix)
+        self._add_texts(new_texts, _text_hashes(new_texts) if self._video_id is not None else None)
+        self._texts = list(self._texts) + list(new_texts)
+        if self._text_rows is not None:
+            self._text_rows = np.concatenate([self._text_rows, np.arange(num_docs, num_docs + len(new_texts))])
+
+    def _add_texts(self, new_texts, new_hashes):
+        """
+        Appends texts to the corpus and updates the models already trained with them
+        :param new_texts: list of texts
+        :param new_hashes: hashes of the texts, None when the corpus is not persisted
+        :return: None
+        """
+        self._document_topics = {}
+        new_bows = self._append_to_corpus(new_texts, new_hashes)
+        for num_topics in list(self._lda_models):
+            self._update_lda_model(num_topics, new_bows)
+        self._lda_model = self._lda_models.get(self._num_topics)
 
-    def identify_topics(self, num_topics=5):
+    def identify_topics(self, num_topics=DEFAULT_NUM_TOPICS):
         """
-        Re-creates the LDA model with the specified number of topics
+        Sets the number of topics to identify, the model is trained when the topics are extracted
         :param num_topics: number of topics to identify in the texts
         :return: None
         """
-        self._create_lda_model(num_topics)
+        self._num_topics = num_topics
+
+    def _infer_document_topics(self, lda_model):
+        """
+        Computes the topic distribution of every document of the corpus, inferring chunks of documents at once
+        :param lda_model: the LDA model
+        :return: array of shape (num_documents, num_topics)
+        """
+        blocks = []
+        for chunk in _chunks(self._doc_term_matrix, INFERENCE_CHUNK_SIZE):
+            gamma, _ = lda_model.inference(chunk)
+            blocks.append(gamma / gamma.sum(axis=1, keepdims=True))
+        if not blocks:
+            return np.empty((0, lda_model.num_topics), dtype=np.float32)
+        return np.vstack(blocks).astype(np.float32, copy=False)
 
     def extract_topics(self, num_words=5):
         """
         Extracts a number of topics which is specified by the num_topics parameter
         :param num_words: number of words to extract for each topic
-        :return: dictionary of topics
+        :return: TopicResult with the top words of every topic and the topic distribution of every text
         """
-        topics = {}
-        for topic_id, topic in self._lda_model.print_topics(num_topics=self._num_topics, num_words=num_words):
-            topics[topic_id] = topic
-        return topics
+        lda_model = self._get_lda_model()
+        topic_words = lda_model.get_topics()
+        num_words = min(num_words, topic_words.shape[1])
+        top_word_ids = np.argsort(-topic_words, axis=1)[:, :num_words]
+        word_weights = np.take_along_axis(topic_words, top_word_ids, axis=1)
+        words = [[lda_model.id2word[word_id] for word_id in word_ids] for word_ids in top_word_ids.tolist()]
+
+        if self._num_topics not in self._document_topics:
+            self._document_topics[self._num_topics] = self._infer_document_topics(lda_model)
+        document_topics = self._document_topics[self._num_topics]
+        if self._text_rows is not None:
+            document_topics = document_topics[self._text_rows]
+        return TopicResult(words, word_weights, document_topics)
@@ -0,0 +1,6 @@
+from .comment_store import CommentStore, iter_documents
+from .embedding_cache import EmbeddingCache, get_embedding_cache
+from .instrumentation import get_metrics, instrumented, propagate_context, scope
+from .lru_cache import LRUCache
+from .rate_limiter import RateLimiter
+from .retry import retry_call
@@ -0,0 +1,407 @@
+import numpy as np
+
+# Number of rows allocated by an empty store on the first insert
+INITIAL_CAPACITY = 256
+
+
+class CommentStore:
+    """
+    Columnar container for the comments of a video.
+
+    The comments are kept in parallel NumPy columns (id, parent row, author, text, like count, publish date and
+    reply count) instead of one dictionary per comment. Authors are dictionary-encoded, an id -> row hash index
+    gives O(1) lookups and a parent -> children offset index (CSR layout) gives the replies of a comment
+    without scanning the store.
+
+    The store also behaves like a read-only mapping of comment id -> comment details, which is the document
+    format used by the Firestore client.
+
+    Attributes:
+        _size: number of comments in the store
+        _ids: comment ids
+        _parent_rows: row of the parent comment, -1 for top-level comments and replies to unknown parents
+        _author_codes: index of the author in _author_names
+        _texts: comment texts
+        _like_counts: number of likes
+        _published_at: publish date, with second precision
+        _total_reply_counts: number of replies of top-level comments, -1 for replies
+        _moderation: moderation label of the comment, None when it was not classified
+        _row_index: comment id -> row
+        _pending_parents: row -> parent id, for replies whose parent is not in the store (yet)
+        _orphans: parent id -> rows of the replies waiting for that parent
+    """
+
+    def __init__(self, capacity=0):
+        self._size = 0
+        self._capacity = 0
+        self._ids = np.empty(0, dtype=object)
+        self._parent_rows = np.empty(0, dtype=np.int32)
+        self._author_codes = np.empty(0, dtype=np.int32)
+        self._texts = np.empty(0, dtype=object)
+        self._like_counts = np.empty(0, dtype=np.int64)
+        self._published_at = np.empty(0, dtype="datetime64[s]")
+        self._total_reply_counts = np.empty(0, dtype=np.int32)
+        self._moderation = np.empty(0, dtype=object)
+        self._author_names = []
+        self._author_lookup = {}
+        self._row_index = {}
+        self._pending_parents = {}
+        self._orphans = {}
+        self._children_offsets = None
+        self._children_rows = None
+        if capacity:
+            self._grow(capacity)
+
+    @classmethod
+    def from_comments(cls, comments):
+        """
+        Builds a store from comments in the list-of-dictionaries format.
+
+        Parameters:
+            comments (list[dict] | CommentStore): a list of dictionaries with key = comment id and value a
+                dictionary with the comment details. A CommentStore is returned unchanged.
+
+        Returns:
+            a CommentStore
+        """
+        if isinstance(comments, cls):
+            return comments
+        store = cls(capacity=len(comments))
+        store.extend(comments)
+        return store
+
+    def _grow(self, capacity):
+        """
+        Re-allocates the columns so that they can hold at least capacity rows.
+
+        Parameters:
+            capacity (int): minimum number of rows
+        """
+        capacity = max(capacity, INITIAL_CAPACITY, self._capacity * 2)
+        for name in ("_ids", "_parent_rows", "_author_codes", "_texts", "_like_counts",
+                     "_published_at", "_total_reply_counts", "_moderation"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            setattr(self, name, grown)
+        self._capacity = capacity
+
+    def add(self, comment_id, author, text, like_count=0, published_at=None, parent_id=None,
+            total_reply_count=None, moderation=None):
+        """
+        Adds a comment to the store. Adding an id that is already stored overwrites it.
+
+        Parameters:
+            comment_id (str): ID of the comment
+            author (str): display name of the author
+            text (str): text of the comment
+            like_count (int): number of likes
+            published_at (str | None): ISO 8601 publish date
+            parent_id (str | None): ID of the top-level comment, for replies
+            total_reply_count (int | None): number of replies, for top-level comments
+            moderation (str | None): moderation label of the comment
+
+        Returns:
+            the row of the comment
+        """
+        row = self._row_index.get(comment_id)
+        if row is None:
+            if self._size == self._capacity:
+                self._grow(self._size + 1)
+            row = self._size
+            self._size += 1
+            self._row_index[comment_id] = row
+            # replies added before this comment can now point to it
+            for child_row in self._orphans.pop(comment_id, ()):
+                if self._pending_parents.get(child_row) == comment_id:
+                    del self._pending_parents[child_row]
+                    self._parent_rows[child_row] = row
+
+        author_code = self._author_lookup.get(author)
+        if author_code is None:
+            author_code = len(self._author_names)
+            self._author_names.append(author)
+            self._author_lookup[author] = author_code
+
+        self._pending_parents.pop(row, None)
+        parent_row = -1
+        if parent_id is not None:
+            parent_row = self._row_index.get(parent_id, -1)
+            if parent_row == -1:
+                self._pending_parents[row] = parent_id
+                self._orphans.setdefault(parent_id, []).append(row)
+
+        self._ids[row] = comment_id
+        self._parent_rows[row] = parent_row
+        self._author_codes[row] = author_code
+        self._texts[row] = text
+        self._like_counts[row] = like_count
+        self._published_at[row] = _parse_timestamp(published_at)
+        self._total_reply_counts[row] = -1 if total_reply_count is None else total_reply_count
+        self._moderation[row] = moderation
+        self._children_offsets = None
+        return row
+
+    def extend(self, comments):
+        """
+        Adds several comments to the store.
+
+        Parameters:
+            comments (list[dict] | CommentStore): comments in the list-of-dictionaries format or another store
+        """
+        if isinstance(comments, CommentStore):
+            items = comments.items()
+        else:
+            items = (item for comment in comments for item in comment.items())
+        for comment_id, comment_details in items:
+            self.add(
+                comment_id,
+                author=comment_details["author"],
+                text=comment_details["text"],
+                like_count=comment_details.get("likeCount", 0),
+                published_at=comment_details.get("publishedAt"),
+                parent_id=comment_details.get("parentId"),
+                total_reply_count=comment_details.get("totalReplyCount"),
+                moderation=comment_details.get("moderation"),
+            )
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, comment_id):
+        return comment_id in self._row_index
+
+    def __iter__(self):
+        return iter(self._ids[: self._size])
+
+    def __getitem__(self, comment_id):
+        return self.details(self._row_index[comment_id])
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        """
+        Iterates over the comments in the document format used by the Firestore client.
+
+        Returns:
+            an iterator of (comment id, comment details) tuples
+        """
+        return ((self._ids[row], self.details(row)) for row in range(self._size))
+
+    def details(self, row):
+        """
+        Returns the details of the comment stored at a row.
+
+        Parameters:
+            row (int): row of the comment
+
+        Returns:
+            a dictionary with the comment details
+        """
+        comment_details = {
+            "author": self._author_names[self._author_codes[row]],
+            "text": self._texts[row],
+            "likeCount": int(self._like_counts[row]),
+            "publishedAt": _format_timestamp(self._published_at[row]),
+        }
+        parent_id = self.parent_id(row)
+        if parent_id is not None:
+            comment_details["parentId"] = parent_id
+        if self._total_reply_counts[row] >= 0:
+            comment_details["totalReplyCount"] = int(self._total_reply_counts[row])
+        if self._moderation[row] is not None:
+            comment_details["moderation"] = self._moderation[row]
+        return comment_details
+
+    def row(self, comment_id):
+        """
+        Returns the row of a comment.
+
+        Parameters:
+            comment_id (str): ID of the comment
+
+        Returns:
+            the row of the comment, or None if the comment is not in the store
+        """
+        return self._row_index.get(comment_id)
+
+    def author(self, comment_id):
+        return self._author_names[self._author_codes[self._row_index[comment_id]]]
+
+    def text(self, comment_id):
+        return self._texts[self._row_index[comment_id]]
+
+    def parent_id(self, row):
+        """
+        Returns the ID of the parent of the comment stored at a row.
+
+        Parameters:
+            row (int): row of the comment
+
+        Returns:
+            the ID of the top-level comment, or None for top-level comments
+        """
+        parent_row = self._parent_rows[row]
+        if parent_row >= 0:
+            return self._ids[parent_row]
+        return self._pending_parents.get(row)
+
+    def _build_children_index(self):
+        """
+        Builds the parent -> children offset index: the replies of the comment at row r are
+        _children_rows[_children_offsets[r]:_children_offsets[r + 1]].
+        """
+        parent_rows = self._parent_rows[: self._size]
+        reply_rows = np.flatnonzero(parent_rows >= 0)
+        # stable sort keeps the replies of a comment in insertion order
+        self._children_rows = reply_rows[np.argsort(parent_rows[reply_rows], kind="stable")].astype(np.int32)
+        counts = np.bincount(parent_rows[reply_rows], minlength=self._size)
+        self._children_offsets = np.zeros(self._size + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._children_offsets[1:])
+
+    def children(self, comment_id):
+        """
+        Returns the rows of the replies to a comment.
+
+        Parameters:
+            comment_id (str): ID of the comment
+
+        Returns:
+            a NumPy array with the rows of the replies
+        """
+        if self._children_offsets is None:
+            self._build_children_index()
+        row = self._row_index[comment_id]
+        return self._children_rows[self._children_offsets[row] : self._children_offsets[row + 1]]
+
+    def replies(self, comment_id):
+        return self._ids[self.children(comment_id)]
+
+    @property
+    def ids(self):
+        return self._ids[: self._size]
+
+    @property
+    def texts(self):
+        return self._texts[: self._size]
+
+    @property
+    def like_counts(self):
+        return self._like_counts[: self._size]
+
+    @property
+    def published_at(self):
+        return self._published_at[: self._size]
+
+    @property
+    def moderation(self):
+        return self._moderation[: self._size]
+
+    def set_moderation(self, labels):
+        """
+        Sets the moderation label of every comment.
+
+        Parameters:
+            labels (list[str]): one label per comment, in the order of the store
+        """
+        if len(labels) != self._size:
+            raise ValueError(f"Expected {self._size} moderation labels, got {len(labels)}")
+        self._moderation[: self._size] = labels
+
+    @property
+    def parent_rows(self):
+        return self._parent_rows[: self._size]
+
+    @property
+    def author_codes(self):
+        return self._author_codes[: self._size]
+
+    @property
+    def author_names(self):
+        return self._author_names
+
+    @property
+    def authors(self):
+        return np.asarray(self._author_names, dtype=object)[self.author_codes]
+
+    @property
+    def parent_ids(self):
+        """
+        Returns the ID of the parent of every comment, None for top-level comments.
+        """
+        parent_rows = self.parent_rows
+        parent_ids = np.full(self._size, None, dtype=object)
+        has_parent = parent_rows >= 0
+        parent_ids[has_parent] = self._ids[parent_rows[has_parent]]
+        for row, parent_id in self._pending_parents.items():
+            parent_ids[row] = parent_id
+        return parent_ids
+
+    def to_numpy(self):
+        """
+        Returns the columns of the store as NumPy arrays. The arrays are views on the store, not copies.
+
+        Returns:
+            a dictionary of column name -> NumPy array
+        """
+        return {
+            "comment_id": self.ids,
+            "parent_row": self.parent_rows,
+            "author_code": self.author_codes,
+            "text": self.texts,
+            "like_count": self.like_counts,
+            "published_at": self.published_at,
+            "moderation": self.moderation,
+        }
+
+    def to_frame(self):
+        """
+        Returns the store as a pandas DataFrame. The columns are passed to pandas without copying them and the
+        authors become a categorical column built on the author codes.
+
+        Returns:
+            a pandas DataFrame with one row per comment
+        """
+        import pandas as pd
+
+        columns = self.to_numpy()
+        columns["author"] = pd.Categorical.from_codes(columns.pop("author_code"), categories=self._author_names)
+        return pd.DataFrame(columns, copy=False)
+
+    def to_comments(self):
+        """
+        Returns the comments in the list-of-dictionaries format.
+
+        Returns:
+            a list of dictionaries with key = comment id and value a dictionary with the comment details
+        """
+        return [{comment_id: comment_details} for comment_id, comment_details in self.items()]
+
+
+def _parse_timestamp(published_at):
+    if not published_at:
+        return np.datetime64("NaT")
+    # numpy datetimes are timezone naive, the API always returns UTC dates
+    return np.datetime64(published_at.rstrip("Z"), "s")
+
+
+def _format_timestamp(timestamp):
+    if np.isnat(timestamp):
+        return None
+    return f"{np.datetime_as_string(timestamp, unit='s')}Z"
+
+
+def iter_documents(documents):
+    """
+    Iterates over documents given either as a CommentStore or as a list of single-key dictionaries.
+
+    Parameters:
+        documents (list[dict] | CommentStore): the documents to iterate over
+
+    Returns:
+        an iterator of (document id, document details) tuples
+    """
+    if isinstance(documents, CommentStore):
+        return documents.items()
+    return (list(document.items())[0] for document in documents)
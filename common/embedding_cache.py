@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from .lru_cache import LRUCache
+
+# Directory of the persistent tier of the shared embedding cache
+EMBEDDING_CACHE_DIR = "cache/embeddings"
+# Maximum number of bytes of embeddings kept in memory
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of text embeddings, keyed by (model, truncate, text hash).
+
+    Lookups go through an in-memory LRU tier first and then through a persistent tier that keeps, for every
+    (model, truncate) pair, a float32 matrix memory-mapped from disk and the index of the text hash stored on each
+    row. Only the texts found in neither tier are sent to the embedding function, once per distinct text.
+    """
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, memory_bytes=MEMORY_CACHE_BYTES):
+        """
+        Initializes the cache.
+
+        Parameters:
+            cache_dir (str | None): directory of the persistent tier, None keeps the cache in memory only
+            memory_bytes (int): maximum number of bytes of embeddings kept in memory
+        """
+        self.cache_dir = cache_dir
+        self._memory = LRUCache(max_size=memory_bytes, sizeof=lambda vector: vector.nbytes)
+        self._disk = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, truncate, text):
+        """
+        Returns the cache key of a text.
+
+        Parameters:
+            model (str): embedding model
+            truncate (str): truncation mode of the embedding request
+            text (str): embedded text
+
+        Returns:
+            the hex digest identifying the embedding
+        """
+        return hashlib.sha256(f"{model}\0{truncate}\0{text}".encode("utf-8")).hexdigest()
+
+    def _disk_tier(self, model, truncate):
+        if self.cache_dir is None:
+            return None
+        with self._lock:
+            disk_tier = self._disk.get((model, truncate))
+            if disk_tier is None:
+                directory = os.path.join(self.cache_dir, _safe_name(f"{model}-{truncate}"))
+                disk_tier = _DiskTier(directory)
+                self._disk[(model, truncate)] = disk_tier
+            return disk_tier
+
+    def embed(self, texts, model, truncate, embed_fn):
+        """
+        Returns the embeddings of texts, calling embed_fn only for the texts that are not cached.
+
+        Parameters:
+            texts (list[str]): texts to embed
+            model (str): embedding model
+            truncate (str): truncation mode of the embedding request
+            embed_fn (callable): embeds a list of distinct texts and returns their vectors in the same order
+
+        Returns:
+            a float32 NumPy matrix with one row per text
+        """
+        disk_tier = self._disk_tier(model, truncate)
+        keys = [self.key(model, truncate, text) for text in texts]
+        vectors = [None] * len(texts)
+        missing = {}
+        for i, key in enumerate(keys):
+            vector = self._memory.get(key)
+            if vector is None and disk_tier is not None:
+                vector = disk_tier.get(key)
+                if vector is not None:
+                    self._memory.put(key, vector)
+            if vector is None:
+                missing.setdefault(key, texts[i])
+            vectors[i] = vector
+
+        if missing:
+            embedded = np.asarray(embed_fn(list(missing.values())), dtype=np.float32)
+            computed = dict(zip(missing.keys(), embedded))
+            if disk_tier is not None:
+                disk_tier.put_many(list(computed.keys()), embedded)
+            for key, vector in computed.items():
+                self._memory.put(key, vector)
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(vectors)
+
+
+class _DiskTier:
+    """
+    Append-only store of the embeddings of one (model, truncate) pair. The vectors are appended to a raw float32
+    file that is memory-mapped for reads, and the key of every row is appended to a text file.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._keys_path = os.path.join(directory, "keys.txt")
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._index = {}
+        self._dimension = None
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path) as f:
+            self._dimension = json.load(f)["dimension"]
+        with open(self._keys_path) as f:
+            keys = f.read().split()
+        row_bytes = self._dimension * 4
+        rows = min(len(keys), os.path.getsize(self._vectors_path) // row_bytes)
+        # drop a partially written tail, so that the next append stays aligned with the keys
+        os.truncate(self._vectors_path, rows * row_bytes)
+        if rows < len(keys):
+            with open(self._keys_path, "w") as f:
+                f.writelines(f"{key}\n" for key in keys[:rows])
+        self._index = {key: row for row, key in enumerate(keys[:rows])}
+        if rows:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self._dimension))
+
+    def get(self, key):
+        row = self._index.get(key)
+        if row is None:
+            return None
+        return np.array(self._matrix[row])
+
+    def put_many(self, keys, vectors):
+        with self._lock:
+            new_rows = [(key, vector) for key, vector in zip(keys, vectors) if key not in self._index]
+            if not new_rows:
+                return
+            if self._dimension is None:
+                os.makedirs(self._directory, exist_ok=True)
+                self._dimension = vectors.shape[1]
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dimension": self._dimension}, f)
+            # vectors are written before their keys, so a key always points to a complete row
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.stack([vector for _, vector in new_rows]).astype(np.float32).tobytes())
+            with open(self._keys_path, "a") as f:
+                f.writelines(f"{key}\n" for key, _ in new_rows)
+            # the matrix is re-mapped before the new keys become visible to get
+            first_row = len(self._index)
+            self._matrix = np.memmap(
+                self._vectors_path, dtype=np.float32, mode="r", shape=(first_row + len(new_rows), self._dimension)
+            )
+            for offset, (key, _) in enumerate(new_rows):
+                self._index[key] = first_row + offset
+
+
+def _safe_name(name):
+    return "".join(char if char.isalnum() or char in "-_." else "_" for char in name)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Returns the process-wide embedding cache shared by every component.
+
+    Returns:
+        the shared EmbeddingCache
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
@@ -0,0 +1,357 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+import numpy as np
+
+from .comment_store import CommentStore
+
+# Analysis the calls are attributed to when they don't run within an analysis scope
+GLOBAL_SCOPE = "global"
+# Number of analyses whose metrics are kept, the oldest ones are dropped first
+MAX_SCOPES = 100
+# Number of elements of a collection measured to estimate the size of the whole collection
+PAYLOAD_SAMPLE_SIZE = 10
+# Prefix of the names of the exported Prometheus metrics
+PROMETHEUS_PREFIX = "tubetalk"
+
+_current_scope = contextvars.ContextVar("instrumentation_scope", default=GLOBAL_SCOPE)
+_current_operation = contextvars.ContextVar("instrumentation_operation", default=None)
+
+
+class OperationStats:
+    """
+    Aggregated measures of the calls of one operation (a method of an instrumented class) within one analysis.
+    """
+
+    FIELDS = ("calls", "errors", "seconds", "max_seconds", "items", "bytes_sent", "bytes_received", "retries")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.items = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class Metrics:
+    """
+    Thread-safe registry of the operation measures, grouped by analysis scope (the ID of the analyzed video).
+    """
+
+    def __init__(self, max_scopes=MAX_SCOPES):
+        """
+        Initializes an empty registry.
+
+        Parameters:
+            max_scopes (int): number of analyses whose metrics are kept
+        """
+        self.max_scopes = max_scopes
+        self.enabled = True
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _stats(self, scope, operation):
+        operations = self._scopes.get(scope)
+        if operations is None:
+            operations = self._scopes[scope] = {}
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+        stats = operations.get(operation)
+        if stats is None:
+            stats = operations[operation] = OperationStats()
+        return stats
+
+    def record(self, operation, seconds, items=0, bytes_sent=0, bytes_received=0, error=False, scope=None):
+        """
+        Records one call of an operation.
+
+        Parameters:
+            operation (str): name of the operation, component.method
+            seconds (float): wall time of the call
+            items (int): number of items the call processed
+            bytes_sent (int): estimated size of the arguments
+            bytes_received (int): estimated size of the returned value
+            error (bool): whether the call raised an exception
+            scope (str | None): analysis the call belongs to, defaults to the current scope
+        """
+        with self._lock:
+            stats = self._stats(scope or _current_scope.get(), operation)
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.items += items
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+    def record_retry(self, operation=None, scope=None):
+        """
+        Records a retry of an operation.
+
+        Parameters:
+            operation (str | None): name of the operation, defaults to the innermost running operation
+            scope (str | None): analysis the retry belongs to, defaults to the current scope
+        """
+        operation = operation or _current_operation.get() or "unknown"
+        with self._lock:
+            self._stats(scope or _current_scope.get(), operation).retries += 1
+
+    def scopes(self):
+        with self._lock:
+            return list(self._scopes)
+
+    def snapshot(self, scope=None):
+        """
+        Returns the measures of one analysis, or of all of them.
+
+        Parameters:
+            scope (str | None): analysis scope, None returns every scope
+
+        Returns:
+            a dictionary of operation -> measures, or of scope -> operation -> measures when scope is None
+        """
+        with self._lock:
+            if scope is not None:
+                return {operation: stats.to_dict() for operation, stats in self._scopes.get(scope, {}).items()}
+            return {
+                scope_name: {operation: stats.to_dict() for operation, stats in operations.items()}
+                for scope_name, operations in self._scopes.items()
+            }
+
+    def reset(self, scope=None):
+        """
+        Drops the measures of one analysis, or of all of them when scope is None.
+        """
+        with self._lock:
+            if scope is None:
+                self._scopes.clear()
+            else:
+                self._scopes.pop(scope, None)
+
+    def to_json(self, scope=None):
+        """
+        Returns the measures as a JSON document.
+
+        Parameters:
+            scope (str | None): analysis scope, None exports every scope
+
+        Returns:
+            a JSON string with a "scopes" object of scope -> operation -> measures
+        """
+        scopes = {scope: self.snapshot(scope)} if scope is not None else self.snapshot()
+        return json.dumps({"scopes": scopes}, indent=2, sort_keys=True)
+
+    def to_prometheus(self, scope=None):
+        """
+        Returns the measures in the Prometheus text exposition format, one sample per analysis and operation.
+
+        Parameters:
+            scope (str | None): analysis scope, None exports every scope
+
+        Returns:
+            a string
+        """
+        scopes = {scope: self.snapshot(scope)} if scope is not None else self.snapshot()
+        families = [
+            ("calls", "operation_calls_total", "counter", "Calls of an instrumented operation"),
+            ("errors", "operation_errors_total", "counter", "Calls of an instrumented operation that raised"),
+            ("seconds", "operation_seconds_total", "counter", "Wall time spent in an instrumented operation"),
+            ("max_seconds", "operation_max_seconds", "gauge", "Slowest call of an instrumented operation"),
+            ("items", "operation_items_total", "counter", "Items processed by an instrumented operation"),
+            ("bytes_sent", "operation_sent_bytes_total", "counter", "Estimated size of the operation arguments"),
+            ("bytes_received", "operation_received_bytes_total", "counter",
+             "Estimated size of the operation results"),
+            ("retries", "operation_retries_total", "counter", "Retries of an instrumented operation"),
+        ]
+        lines = []
+        for field, name, metric_type, description in families:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}")
+            for scope_name, operations in scopes.items():
+                for operation, stats in sorted(operations.items()):
+                    component, _, method = operation.partition(".")
+                    labels = ",".join(
+                        f'{label}="{_escape_label(value)}"'
+                        for label, value in (("analysis", scope_name), ("component", component), ("method", method))
+                    )
+                    lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{labels}}} {stats[field]}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Returns the process-wide metrics registry the instrumented classes record to.
+
+    Returns:
+        the shared Metrics
+    """
+    return _metrics
+
+
+@contextlib.contextmanager
+def scope(name):
+    """
+    Attributes the calls made within the block, and in the threads started through propagate_context, to an
+    analysis.
+
+    Parameters:
+        name (str): analysis scope, usually the ID of the analyzed video
+    """
+    token = _current_scope.set(name)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+
+
+def propagate_context(fn):
+    """
+    Returns a function that runs fn in the instrumentation context of the caller, so the calls fn makes from worker
+    threads are attributed to the caller's analysis.
+
+    Parameters:
+        fn (callable): function that will run in another thread
+
+    Returns:
+        a callable with the signature of fn
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a context can only be entered by one thread at a time
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def instrumented(component, exclude=()):
+    """
+    Class decorator recording the wall time, calls, items, payload sizes and errors of every method of the class.
+
+    Generator methods, properties and special methods are left as they are.
+
+    Parameters:
+        component (str): name of the component in the operation names (component.method)
+        exclude (tuple[str]): names of methods that are not instrumented, e.g. cheap helpers called per comment
+    """
+    def decorate(cls):
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith("__") or name in exclude:
+                continue
+            if isinstance(attribute, staticmethod):
+                if not inspect.isgeneratorfunction(attribute.__func__):
+                    setattr(cls, name, staticmethod(_instrument(attribute.__func__, f"{component}.{name}")))
+            elif isinstance(attribute, classmethod):
+                if not inspect.isgeneratorfunction(attribute.__func__):
+                    setattr(cls, name, classmethod(_instrument(attribute.__func__, f"{component}.{name}", 1)))
+            elif inspect.isfunction(attribute) and not inspect.isgeneratorfunction(attribute):
+                setattr(cls, name, _instrument(attribute, f"{component}.{name}", 1))
+        return cls
+
+    return decorate
+
+
+def _instrument(fn, operation, skipped_arguments=0):
+    """
+    Wraps a function to record its calls as operation. skipped_arguments leading positional arguments (self or cls)
+    are not part of the payload
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _metrics.enabled:
+            return fn(*args, **kwargs)
+        arguments = args[skipped_arguments:] + tuple(kwargs.values())
+        token = _current_operation.set(operation)
+        start = time.perf_counter()
+        error = True
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            _current_operation.reset(token)
+            items = _count_items(arguments)
+            if items is None:
+                items = _count_items((result,)) or 0
+            _metrics.record(operation, seconds, items=items, bytes_sent=sum(map(_payload_size, arguments)),
+                            bytes_received=0 if error else _payload_size(result), error=error)
+
+    return wrapper
+
+
+def _count_items(values):
+    """
+    Returns the length of the first collection among values, None when there is none
+    """
+    for value in values:
+        if isinstance(value, (list, tuple, dict, np.ndarray, CommentStore)):
+            return len(value)
+    return None
+
+
+def _payload_size(value, depth=0):
+    """
+    Estimates the size of a value in bytes, as it would be serialized to be sent over the network. Large
+    collections are estimated from a sample of their elements
+    """
+    if value is None or isinstance(value, bool):
+        return 0
+    if isinstance(value, (int, float, np.number)):
+        return 8
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return value.nbytes
+    if isinstance(value, CommentStore):
+        # texts plus the other fields of every comment
+        return _sampled_size(value.texts, len) + len(value) * 64
+    if depth > 3:
+        return 0
+    if isinstance(value, dict):
+        return _sampled_size(
+            list(islice(value.items(), PAYLOAD_SAMPLE_SIZE)),
+            lambda item: _payload_size(item[0], depth + 1) + _payload_size(item[1], depth + 1),
+            count=len(value),
+        )
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return _sampled_size(value, lambda element: _payload_size(element, depth + 1))
+    if isinstance(value, (set, frozenset)):
+        return _sampled_size(list(islice(value, PAYLOAD_SAMPLE_SIZE)),
+                             lambda element: _payload_size(element, depth + 1), count=len(value))
+    return 0
+
+
+def _sampled_size(elements, sizeof, count=None):
+    """
+    Sums sizeof over elements, or over PAYLOAD_SAMPLE_SIZE evenly spaced elements scaled to count elements
+    """
+    count = len(elements) if count is None else count
+    if len(elements) <= PAYLOAD_SAMPLE_SIZE and count == len(elements):
+        return sum(sizeof(element) for element in elements)
+    if not len(elements):
+        return 0
+    step = len(elements) / PAYLOAD_SAMPLE_SIZE
+    sample = [elements[int(i * step)] for i in range(min(PAYLOAD_SAMPLE_SIZE, len(elements)))]
+    return int(sum(sizeof(element) for element in sample) * count / len(sample))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its values.
+
+    By default every value has a size of 1, so max_size is the number of entries. Passing a sizeof function
+    (for example the number of bytes of a value) bounds the cache by the sum of the value sizes instead. With a ttl,
+    values expire that many seconds after they were cached.
+    """
+
+    def __init__(self, max_size, sizeof=None, ttl=None):
+        """
+        Initializes an empty cache.
+
+        Parameters:
+            max_size (int): maximum total size of the cached values
+            sizeof (callable | None): returns the size of a value, defaults to 1 per value
+            ttl (float | None): seconds after which a cached value expires, None keeps values until they are evicted
+        """
+        self.max_size = max_size
+        self._sizeof = sizeof or (lambda value: 1)
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key and marks it as the most recently used.
+
+        Parameters:
+            key: key of the value
+            default: value returned when the key is not cached
+
+        Returns:
+            the cached value or default
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[2] is not None and item[2] <= time.monotonic():
+                del self._items[key]
+                self._size -= item[1]
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        """
+        Caches a value, evicting the least recently used values when the cache is full. Values larger than the
+        whole cache are not cached.
+
+        Parameters:
+            key: key of the value
+            value: value to cache
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            if size > self.max_size:
+                return
+            expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+            self._items[key] = (value, size, expires_at)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size, _) = self._items.popitem(last=False)
+                self._size -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self._size -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting how many units (requests, documents, ...) are used per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Initializes a full bucket.
+
+        Parameters:
+            rate (float | None): units allowed per second, None disables the limit
+            burst (float | None): maximum number of units that can be used at once, defaults to rate
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """
+        Blocks until amount units can be used. Requests larger than the burst are let through once the bucket is
+        full and are paid back before the next ones.
+
+        Parameters:
+            amount (float): number of units used
+        """
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= min(amount, self.burst):
+                    self._tokens -= amount
+                    return
+                wait = (min(amount, self.burst) - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,39 @@
+import random
+import time
+
+from .instrumentation import get_metrics
+
+# Number of attempts made by retry_call before giving up
+RETRY_ATTEMPTS = 4
+# Delay before the first retry, in seconds, doubled after every failed attempt
+RETRY_BASE_DELAY = 0.5
+# Upper bound of the delay between two attempts, in seconds
+RETRY_MAX_DELAY = 8.0
+
+
+def retry_call(fn, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, retryable=None):
+    """
+    Calls fn until it succeeds, waiting with exponential backoff and jitter between the attempts.
+
+    Parameters:
+        fn (callable): function called without arguments
+        attempts (int): maximum number of calls
+        base_delay (float): delay before the first retry, in seconds
+        max_delay (float): upper bound of the delay between two attempts, in seconds
+        retryable (callable | None): returns False for exceptions that should not be retried
+
+    Returns:
+        the value returned by fn
+
+    Raises:
+        the exception of the last attempt, or the first exception that is not retryable
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1 or (retryable is not None and not retryable(e)):
+                raise
+            get_metrics().record_retry()
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.0))
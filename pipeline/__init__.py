@@ -0,0 +1,2 @@
+from .ingestion import CommentIngestionPipeline, CommentLimitExceeded
+from .jobs import AnalysisJob, AnalysisJobRunner
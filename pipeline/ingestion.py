@@ -0,0 +1,240 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+from common.comment_store import CommentStore
+from common.instrumentation import propagate_context
+
+# Number of comment pages buffered between two pipeline stages
+QUEUE_SIZE = 8
+# Number of embeddings copied at once from the spill file to the embeddings file
+SPILL_COPY_ROWS = 10_000
+
+# Marks the end of the stream of pages going through a stage
+_END_OF_STREAM = object()
+
+
+class CommentLimitExceeded(Exception):
+    """
+    Raised when a video has more comments than the pipeline was allowed to ingest.
+    """
+
+
+class CommentIngestionPipeline:
+    """
+    Streams the comments of a video from YouTube into Firestore, Cohere and Pinecone.
+
+    Every page of comments is handed to the next stages as soon as it is fetched: one thread classifies the
+    comments with the moderation classifier, then one thread saves the pages in Firestore while another one
+    embeds them and a third one upserts the embeddings in Pinecone, so the network waits of the different
+    services overlap instead of adding up. The moderation labels are saved with the comments and in the
+    Pinecone metadata, so they never have to be computed again.
+    """
+
+    def __init__(self, youtube, firestore, cohere, pinecone, queue_size=QUEUE_SIZE, moderate=True):
+        """
+        Initializes the pipeline with the API clients used by each stage.
+
+        Parameters:
+            youtube (YouTubeAPI): client used to fetch the comments
+            firestore (FirestoreClient): client used to persist the comments
+            cohere (CohereClient): client used to embed the comments
+            pinecone (PineconeClient): client used to save the embeddings
+            queue_size (int): number of pages buffered between two stages
+            moderate (bool): whether the comments are classified with the moderation classifier
+        """
+        self.youtube = youtube
+        self.firestore = firestore
+        self.cohere = cohere
+        self.pinecone = pinecone
+        self.queue_size = queue_size
+        self.moderate = moderate
+
+    def run(self, video_id, comment_limit=None, embeddings_file=None):
+        """
+        Fetches, persists, embeds and indexes all the comments of a video.
+
+        Parameters:
+            video_id (str): ID of the video, also used as Firestore collection and Pinecone namespace
+            comment_limit (int | None): videos with this many comments or more are rejected. Nothing is saved,
+                embedded or indexed for a rejected video: its comment count is checked before fetching, and its
+                pages are only handed to the stages once all of them were fetched
+            embeddings_file (str | None): when given, the embeddings are spilled to this .npy file page by page
+                instead of being kept in memory, and returned as a read-only memory map of it
+
+        Returns:
+            a tuple with the CommentStore of the video and the matrix of embeddings, in the same order as the store
+
+        Raises:
+            CommentLimitExceeded: if the video has at least comment_limit comments
+        """
+        if comment_limit is not None:
+            declared_count = self.youtube.get_comment_count(video_id)
+            if declared_count is not None and declared_count >= comment_limit:
+                raise CommentLimitExceeded(f"Video {video_id} has {comment_limit} comments or more")
+
+        moderate_queue = queue.Queue(maxsize=self.queue_size)
+        persist_queue = queue.Queue(maxsize=self.queue_size)
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        upsert_queue = queue.Queue(maxsize=self.queue_size)
+        failed = threading.Event()
+        errors = []
+        pages = []
+        embeddings = {}
+        spill = None if embeddings_file is None else open(embeddings_file + ".part", "wb")
+
+        def forward(page_index, page):
+            persist_queue.put((page_index, page))
+            embed_queue.put((page_index, page))
+
+        def dispatch(page):
+            if self.moderate:
+                moderate_queue.put((len(pages), page))
+            else:
+                forward(len(pages), page)
+            pages.append(page)
+
+        def moderate(page_index, page):
+            page.set_moderation(self.cohere.classify_comments(page.texts.tolist()))
+            forward(page_index, page)
+
+        def persist(page_index, page):
+            self.firestore.save_documents(collection=video_id, documents=page)
+
+        def embed(page_index, page):
+            embeddings[page_index] = self.cohere.embed(texts=page.texts.tolist())
+            if spill is not None:
+                # pages are embedded in order, so the spill file has the rows in the order of the store
+                embeddings[page_index].tofile(spill)
+            upsert_queue.put((page_index, page))
+
+        def upsert(page_index, page):
+            # spilled embeddings are only kept in memory until they are indexed
+            page_embeddings = embeddings[page_index] if spill is None else embeddings.pop(page_index)
+            vectors = [
+                (comment_id, embedding, _vector_metadata(parent_id, moderation))
+                for comment_id, embedding, parent_id, moderation
+                in zip(page.ids, page_embeddings, page.parent_ids, page.moderation)
+            ]
+            self.pinecone.save(vectors=vectors, namespace=video_id)
+
+        # the stage threads record their calls in the analysis of the caller
+        run_stage = propagate_context(self._run_stage)
+        stages = [
+            threading.Thread(target=run_stage, args=(moderate_queue, moderate, failed, errors), daemon=True),
+            threading.Thread(target=run_stage, args=(persist_queue, persist, failed, errors), daemon=True),
+            threading.Thread(target=run_stage, args=(embed_queue, embed, failed, errors), daemon=True),
+            threading.Thread(target=run_stage, args=(upsert_queue, upsert, failed, errors), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        comment_count = 0
+        # with a limit, the pages are held back until the whole video is fetched, so the statistics being stale
+        # can't leave a rejected video partially saved; the held pages are bounded by the limit
+        held_pages = []
+        fetched = False
+        try:
+            for page in self.youtube.stream_comment_threads(video_id):
+                if failed.is_set():
+                    break
+                comment_count += len(page)
+                if comment_limit is not None and comment_count >= comment_limit:
+                    raise CommentLimitExceeded(
+                        f"Video {video_id} has {comment_limit} comments or more"
+                    )
+                if not page:
+                    continue
+                if comment_limit is None:
+                    dispatch(page)
+                else:
+                    held_pages.append(page)
+            for page in held_pages:
+                dispatch(page)
+            fetched = True
+        finally:
+            # every stage is closed once the stages feeding it are done
+            moderate_queue.put(_END_OF_STREAM)
+            stages[0].join()
+            persist_queue.put(_END_OF_STREAM)
+            embed_queue.put(_END_OF_STREAM)
+            stages[1].join()
+            stages[2].join()
+            upsert_queue.put(_END_OF_STREAM)
+            stages[3].join()
+            if spill is not None:
+                spill.close()
+                if errors or not fetched:
+                    os.remove(spill.name)
+
+        if errors:
+            raise errors[0]
+
+        comments = CommentStore(capacity=comment_count)
+        for page in pages:
+            comments.extend(page)
+        if spill is not None:
+            embedded_comments = _load_spilled_embeddings(spill.name, embeddings_file, len(comments))
+        elif pages:
+            embedded_comments = np.concatenate([embeddings[page_index] for page_index in range(len(pages))])
+        else:
+            embedded_comments = np.empty((0, 0), dtype=np.float32)
+        return comments, embedded_comments
+
+    @staticmethod
+    def _run_stage(stage_queue, handler, failed, errors):
+        """
+        Consumes the pages of a stage queue until the end of the stream.
+
+        After a failure the remaining pages are drained without being processed, so the stages feeding this
+        queue are never blocked.
+
+        Parameters:
+            stage_queue (queue.Queue): queue with (page index, page) tuples
+            handler (callable): function called with the page index and the page
+            failed (threading.Event): set by the first stage that fails
+            errors (list): collects the exception that made the pipeline fail
+        """
+        while True:
+            item = stage_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            if failed.is_set():
+                continue
+            try:
+                handler(*item)
+            except Exception as e:
+                errors.append(e)
+                failed.set()
+
+
+def _load_spilled_embeddings(spill_file, embeddings_file, num_rows):
+    """
+    Copies the raw float32 rows of a spill file to a .npy file, chunk by chunk, and memory maps it
+    """
+    if num_rows == 0:
+        np.save(embeddings_file, np.empty((0, 0), dtype=np.float32))
+    else:
+        num_dims = os.path.getsize(spill_file) // (4 * num_rows)
+        spilled = np.memmap(spill_file, dtype=np.float32, mode="r", shape=(num_rows, num_dims))
+        embeddings = np.lib.format.open_memmap(embeddings_file, mode="w+", dtype=np.float32,
+                                               shape=(num_rows, num_dims))
+        for start in range(0, num_rows, SPILL_COPY_ROWS):
+            embeddings[start:start + SPILL_COPY_ROWS] = spilled[start:start + SPILL_COPY_ROWS]
+        embeddings.flush()
+        del spilled, embeddings
+    os.remove(spill_file)
+    return np.load(embeddings_file, mmap_mode="r")
+
+
+def _vector_metadata(parent_id, moderation):
+    """
+    Returns the Pinecone metadata of a comment. The moderation label lets searches filter out inappropriate
+    comments.
+    """
+    metadata = {"parentId": "None" if parent_id is None else parent_id}
+    if moderation is not None:
+        metadata["moderation"] = moderation
+    return metadata
@@ -0,0 +1,321 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from comment_analysis.topic_identifier import TopicIdentifier, TopicResult
+from common.comment_store import CommentStore
+from common.instrumentation import instrumented, scope
+from common.lru_cache import LRUCache
+
+# Number of videos analyzed at the same time
+JOB_MAX_WORKERS = 2
+# Directory where the outputs of the analysis stages are persisted, one subdirectory per video
+JOB_DATA_DIR = "cache/jobs"
+# Videos with this many comments or more are rejected, None accepts all the videos
+COMMENT_LIMIT = None
+# Videos with this many comments or more are analyzed in large-video mode
+LARGE_VIDEO_MIN_COMMENTS = 500
+# Number of topics identified in the comments of a video
+NUM_TOPICS = 4
+# Number of words describing every topic
+NUM_WORDS = 4
+# Seconds for which the results of an analysis are served from memory
+JOB_CACHE_TTL = 6 * 60 * 60
+# Memory held by the results of the cached analyses, in bytes
+JOB_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Stages of an analysis, in the order they run
+STAGES = ("ingest", "topics", "clusters", "summaries")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class AnalysisJob:
+    """
+    State of the analysis of one video, shared between the worker running it and the Streamlit script polling it.
+
+    Attributes:
+        video_id: ID of the analyzed video
+        fingerprint: fingerprint of the comments of the video when the job was submitted
+        large: whether the video is analyzed in large-video mode
+        state: pending, running, done or failed
+        stage: stage running at the moment, None when no stage is running
+        completed_stages: stages whose output is available in results
+        results: outputs of the completed stages, by stage
+        error: exception that made the job fail
+    """
+
+    def __init__(self, video_id, fingerprint, large=False):
+        self.video_id = video_id
+        self.fingerprint = fingerprint
+        self.large = large
+        self.state = PENDING
+        self.stage = None
+        self.completed_stages = []
+        self.results = {}
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def progress(self):
+        """
+        Returns the share of the stages that are completed, between 0 and 1
+        """
+        return len(self.completed_stages) / len(STAGES)
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+
+@instrumented("jobs", exclude=("submit", "get", "_run", "_stage_path", "_topic_lock"))
+class AnalysisJobRunner:
+    """
+    Runs the analysis of videos in a worker pool, outside the Streamlit script thread.
+
+    An analysis goes through STAGES: ingestion (fetching, saving, embedding and indexing the comments), topic
+    identification, clustering and cluster summarization. The output of every stage is persisted under
+    JOB_DATA_DIR as soon as it completes, so a video that was analyzed before is loaded instead of analyzed
+    again, and an interrupted analysis resumes from its first missing stage. The Streamlit script submits
+    videos and polls the state and progress of their jobs.
+
+    Jobs are keyed by video ID and by the fingerprint of the comments of the video, made of its comment count and
+    of the ID of its most recent top-level comment, and kept in memory for JOB_CACHE_TTL seconds within
+    JOB_CACHE_BYTES, after which they are loaded from JOB_DATA_DIR again. The runner is shared by all the sessions
+    of the application, so a video opened by many users at the same time is analyzed once, and analyzed again only
+    when its comments change. The fingerprint is cheap rather than exact: it misses changes that neither alter the
+    count nor the newest comment, such as a reply posted while another comment is deleted.
+
+    Videos with LARGE_VIDEO_MIN_COMMENTS comments or more are analyzed in large-video mode: their embeddings are
+    spilled to a memory-mapped file in the job directory instead of being kept in memory, and they are clustered
+    with large_cluster_model (a memory-bounded backend such as minibatch_kmeans). Topics are always identified on
+    a corpus streamed to disk.
+
+    The calls made by a job are recorded in the metrics of common.instrumentation under the ID of its video, with
+    the time of every stage as jobs._run_<stage>.
+    """
+
+    def __init__(self, ingestion, cluster_model, summarizer, topic_model_factory=TopicIdentifier,
+                 max_workers=JOB_MAX_WORKERS, data_dir=JOB_DATA_DIR, comment_limit=COMMENT_LIMIT,
+                 cache_ttl=JOB_CACHE_TTL, cache_bytes=JOB_CACHE_BYTES, large_cluster_model=None,
+                 large_video_min_comments=LARGE_VIDEO_MIN_COMMENTS):
+        """
+        Initializes the runner.
+
+        Parameters:
+            ingestion (CommentIngestionPipeline): pipeline that ingests the comments of a video
+            cluster_model (ClusterIdentifier): identifies the clusters of comments
+            summarizer (ClusterSummarizer): summarizes the clusters
+            topic_model_factory (callable): creates the TopicIdentifier of a job, topic models are not shared
+                between jobs running in parallel
+            max_workers (int): number of videos analyzed at the same time
+            data_dir (str): directory where the stage outputs are persisted
+            comment_limit (int | None): videos with this many comments or more are rejected
+            cache_ttl (float | None): seconds for which the jobs are kept in memory
+            cache_bytes (int): memory held by the results of the jobs kept in memory
+            large_cluster_model (ClusterIdentifier | None): identifies the clusters of large videos, defaults to
+                cluster_model
+            large_video_min_comments (int): videos with this many comments or more are analyzed in large-video mode
+        """
+        self.ingestion = ingestion
+        self.cluster_model = cluster_model
+        self.summarizer = summarizer
+        self.topic_model_factory = topic_model_factory
+        self.data_dir = data_dir
+        self.comment_limit = comment_limit
+        self.large_cluster_model = large_cluster_model or cluster_model
+        self.large_video_min_comments = large_video_min_comments
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._jobs = LRUCache(max_size=cache_bytes, sizeof=_job_size, ttl=cache_ttl)
+        self._lock = threading.Lock()
+        # the cluster identifiers keep the state of their last analysis, so clusterings don't run in parallel
+        self._cluster_lock = threading.Lock()
+        # video ID -> [lock, number of jobs holding or waiting for it]
+        self._topic_locks = {}
+
+    def submit(self, video_id):
+        """
+        Starts the analysis of a video, unless the analysis of its current comments is already running or done.
+
+        Parameters:
+            video_id (str): ID of the video
+
+        Returns:
+            the AnalysisJob of the video
+        """
+        # the comment count changes when comments are added or removed, and the newest comment when a comment is
+        # posted while another one is removed
+        youtube = self.ingestion.youtube
+        comment_count = youtube.get_comment_count(video_id)
+        latest_comment_id = None if comment_count is None else youtube.get_latest_comment_id(video_id)
+        fingerprint = f"{comment_count}-{latest_comment_id}"
+        with self._lock:
+            job = self._jobs.get((video_id, fingerprint))
+            if job is None or job.state == FAILED:
+                large = comment_count is not None and comment_count >= self.large_video_min_comments
+                job = AnalysisJob(video_id, fingerprint, large=large)
+                self._jobs.put((video_id, fingerprint), job)
+                self._executor.submit(self._run, job)
+            return job
+
+    def get(self, video_id, fingerprint):
+        """
+        Returns the job of a video, None when the video was not submitted or its job expired.
+
+        Parameters:
+            video_id (str): ID of the video
+            fingerprint (str): fingerprint of the comments of the video
+
+        Returns:
+            an AnalysisJob or None
+        """
+        with self._lock:
+            return self._jobs.get((video_id, fingerprint))
+
+    def _run(self, job):
+        job.state = RUNNING
+        job.started_at = time.time()
+        job_dir = os.path.join(job.video_id, job.fingerprint)
+        try:
+            os.makedirs(os.path.join(self.data_dir, job_dir), exist_ok=True)
+            with scope(job.video_id):
+                for stage in STAGES:
+                    job.stage = stage
+                    result = self._load(job_dir, stage)
+                    if result is None:
+                        result = getattr(self, f"_run_{stage}")(job, job_dir)
+                        self._save(job_dir, stage, result)
+                    job.results[stage] = result
+                    job.completed_stages.append(stage)
+            job.state = DONE
+        except Exception as e:
+            job.error = e
+            job.state = FAILED
+        finally:
+            job.stage = None
+            job.finished_at = time.time()
+            # cache the job again, now that the size of its results is known
+            with self._lock:
+                if self._jobs.get((job.video_id, job.fingerprint)) is job:
+                    self._jobs.put((job.video_id, job.fingerprint), job)
+
+    def _run_ingest(self, job, job_dir):
+        embeddings_file = self._stage_path(job_dir, "ingest", "embeddings.npy") if job.large else None
+        comments, embeddings = self.ingestion.run(job.video_id, comment_limit=self.comment_limit,
+                                                  embeddings_file=embeddings_file)
+        return {"comments": comments, "embeddings": embeddings}
+
+    @contextlib.contextmanager
+    def _topic_lock(self, video_id):
+        """
+        Serializes the topics stages of the jobs of a video, which share the corpus and models persisted for it
+        """
+        with self._lock:
+            entry = self._topic_locks.setdefault(video_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._topic_locks[video_id]
+
+    def _run_topics(self, job, job_dir):
+        topic_model = self.topic_model_factory()
+        with self._topic_lock(job.video_id):
+            # a video analyzed before only adds its new comments to its persisted corpus and models
+            topic_model(texts=job.results["ingest"]["comments"].texts.tolist(), video_id=job.video_id)
+            topic_model.identify_topics(num_topics=NUM_TOPICS)
+            return topic_model.extract_topics(num_words=NUM_WORDS)
+
+    def _run_clusters(self, job, job_dir):
+        cluster_model = self.large_cluster_model if job.large else self.cluster_model
+        with self._cluster_lock:
+            # when the video was clustered before, only its new comments are assigned to the existing clusters
+            clusters = cluster_model.update_comments(video_id=job.video_id,
+                                                     comments=job.results["ingest"]["comments"],
+                                                     embeddings=job.results["ingest"]["embeddings"])
+            return {
+                str(cluster_id): [str(comment_id) for comment_id in comment_ids]
+                for cluster_id, comment_ids in clusters.items()
+            }
+
+    def _run_summaries(self, job, job_dir):
+        clusters = {cluster_id: comment_ids for cluster_id, comment_ids in job.results["clusters"].items()
+                    if cluster_id != "-1"}
+        return self.summarizer.summarize(clusters, job.results["ingest"]["comments"])
+
+    def _stage_path(self, job_dir, stage, name):
+        return os.path.join(self.data_dir, job_dir, f"{stage}.{name}")
+
+    def _load(self, job_dir, stage):
+        """
+        Returns the persisted output of a stage, None when the stage did not complete
+        """
+        done_path = self._stage_path(job_dir, stage, "done")
+        if not os.path.exists(done_path):
+            return None
+        if stage == "ingest":
+            with open(self._stage_path(job_dir, stage, "comments.json")) as f:
+                comments = CommentStore.from_comments(json.load(f))
+            embeddings = np.load(self._stage_path(job_dir, stage, "embeddings.npy"), mmap_mode="r")
+            return {"comments": comments, "embeddings": embeddings}
+        if stage == "topics":
+            with open(self._stage_path(job_dir, stage, "words.json")) as f:
+                words = json.load(f)
+            arrays = np.load(self._stage_path(job_dir, stage, "arrays.npz"))
+            return TopicResult(words, arrays["word_weights"], arrays["document_topics"])
+        with open(self._stage_path(job_dir, stage, "json")) as f:
+            return json.load(f)
+
+    def _save(self, job_dir, stage, result):
+        """
+        Persists the output of a stage. The marker file is written last, so a stage is only loaded when all its
+        files are complete
+        """
+        if stage == "ingest":
+            _write_json(self._stage_path(job_dir, stage, "comments.json"), result["comments"].to_comments())
+            # spilled embeddings are already in their file
+            if not isinstance(result["embeddings"], np.memmap):
+                with open(self._stage_path(job_dir, stage, "embeddings.npy"), "wb") as f:
+                    np.save(f, result["embeddings"])
+        elif stage == "topics":
+            _write_json(self._stage_path(job_dir, stage, "words.json"), result.words)
+            with open(self._stage_path(job_dir, stage, "arrays.npz"), "wb") as f:
+                np.savez(f, word_weights=result.word_weights, document_topics=result.document_topics)
+        else:
+            _write_json(self._stage_path(job_dir, stage, "json"), result)
+        _write_json(self._stage_path(job_dir, stage, "done"), {"completed_at": time.time()})
+
+
+def _write_json(path, content):
+    with open(path + ".tmp", "w") as f:
+        json.dump(content, f)
+    os.replace(path + ".tmp", path)
+
+
+def _job_size(job):
+    """
+    Returns an estimate of the memory held by the results of a job, in bytes
+    """
+    size = 1
+    if "ingest" in job.results:
+        comments = job.results["ingest"]["comments"]
+        size += sum(len(text) for text in comments.texts) * 4
+        # memory-mapped embeddings live in the page cache, not in the memory of the process
+        if not isinstance(job.results["ingest"]["embeddings"], np.memmap):
+            size += job.results["ingest"]["embeddings"].nbytes
+    if "topics" in job.results:
+        size += job.results["topics"].document_topics.nbytes
+    return size
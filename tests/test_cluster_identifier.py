@@ -0,0 +1,120 @@
+import numpy as np
+
+from comment_analysis.cluster_identifier import ClusterIdentifier
+from common.comment_store import CommentStore
+
+CENTERS = np.eye(8, dtype=np.float32)[:3] * 10
+
+
+class FakeCohere:
+    """
+    Embeds "topic<k> ..." texts around the k-th center
+    """
+
+    def __init__(self):
+        self.embedded_texts = []
+
+    def embed(self, texts):
+        self.embedded_texts.extend(texts)
+        return np.stack([embed_text(text) for text in texts])
+
+
+def embed_text(text):
+    topic, number = text.split()
+    noise = np.random.default_rng(int(number)).standard_normal(8).astype(np.float32) * 0.3
+    return CENTERS[int(topic[len("topic"):])] + noise
+
+
+def make_comments(ids):
+    comments = CommentStore()
+    for comment_id in ids:
+        comments.add(comment_id, author="author", text=text_of(comment_id))
+    return comments
+
+
+def text_of(comment_id):
+    number = int(comment_id[1:])
+    return f"topic{number % 3} {number}"
+
+
+def identifier(**kwargs):
+    return ClusterIdentifier(FakeCohere(), backend="dbscan", n_components=None, min_samples=3, **kwargs)
+
+
+def cluster_of(clusters, comment_id):
+    return next(cluster_id for cluster_id, ids in clusters.items() if comment_id in ids)
+
+
+def test_analyze_comments_groups_similar_comments():
+    clusters = identifier().analyze_comments(make_comments([f"c{i}" for i in range(60)]))
+
+    assert len([cluster_id for cluster_id in clusters if cluster_id != "-1"]) == 3
+    for cluster_id, ids in clusters.items():
+        assert len({int(comment_id[1:]) % 3 for comment_id in ids}) == 1
+
+
+def test_update_comments_assigns_new_comments_without_reclustering():
+    model = identifier()
+    ids = [f"c{i}" for i in range(60)]
+    before = model.analyze_comments(make_comments(ids), video_id="video")
+    model._cohere.embedded_texts.clear()
+
+    after = model.update_comments("video", make_comments(ids + ["c60", "c61"]))
+
+    # only the new comments are embedded, and they join the clusters of their topics
+    assert model._cohere.embedded_texts == [text_of("c60"), text_of("c61")]
+    assert cluster_of(after, "c60") == cluster_of(before, "c0")
+    assert cluster_of(after, "c61") == cluster_of(before, "c1")
+    assert cluster_of(after, "c5") == cluster_of(before, "c5")
+
+
+def test_update_comments_reads_only_the_new_rows_of_given_embeddings():
+    model = identifier()
+    ids = [f"c{i}" for i in range(60)]
+    model.analyze_comments(make_comments(ids), video_id="video")
+    model._cohere.embedded_texts.clear()
+    comments = make_comments(ids + ["c62"])
+    embeddings = np.stack([embed_text(text) for text in comments.texts])
+
+    after = model.update_comments("video", comments, embeddings=embeddings)
+
+    assert model._cohere.embedded_texts == []
+    assert cluster_of(after, "c62") == cluster_of(after, "c2")
+
+
+def test_update_comments_drops_deleted_comments():
+    model = identifier()
+    ids = [f"c{i}" for i in range(60)]
+    model.analyze_comments(make_comments(ids), video_id="video")
+
+    after = model.update_comments("video", make_comments(ids[1:]))
+
+    assert all("c0" not in comment_ids for comment_ids in after.values())
+    assert sum(len(comment_ids) for comment_ids in after.values()) == 59
+
+
+def test_update_comments_reclusters_when_the_video_grew_too_much():
+    model = identifier(max_growth=0.5)
+    model.analyze_comments(make_comments([f"c{i}" for i in range(30)]), video_id="video")
+    model._cohere.embedded_texts.clear()
+
+    model.update_comments("video", make_comments([f"c{i}" for i in range(60)]))
+
+    # the re-clustering embeds every comment again (through the embedding cache in the application)
+    assert len(model._cohere.embedded_texts) == 30 + 60
+
+
+def test_update_comments_without_a_kept_clustering_clusters_everything():
+    model = identifier()
+
+    clusters = model.update_comments("video", make_comments([f"c{i}" for i in range(60)]))
+
+    assert sum(len(comment_ids) for comment_ids in clusters.values()) == 60
+
+
+def test_clustering_states_are_bounded():
+    model = identifier(states_bytes=1)
+
+    model.analyze_comments(make_comments([f"c{i}" for i in range(60)]), video_id="video")
+
+    assert "video" not in model._videos
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from comment_analysis.cluster_summarizer import ClusterSummarizer
+from common.comment_store import CommentStore
+
+
+class FakeCohere:
+    def __init__(self):
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def summarize_comments(self, comments):
+        with self._lock:
+            self.prompts.append(comments)
+        return f"summary of {comments.splitlines()[0]}"
+
+
+@pytest.fixture
+def comments():
+    store = CommentStore()
+    for i in range(40):
+        store.add(f"c{i}", "author", f"comment {i}")
+    store.add("long", "author", "x" * 200)
+    return store
+
+
+def test_every_cluster_is_summarized_once(comments):
+    cohere = FakeCohere()
+    summarizer = ClusterSummarizer(cohere, max_workers=3)
+    clusters = {"0": ["c0", "c1"], "1": ["c2"], "2": ["c3", "c4", "c5"]}
+
+    summaries = summarizer.summarize(clusters, comments)
+    again = summarizer.summarize(dict(reversed(list(clusters.items()))), comments)
+
+    assert summaries == {"0": "summary of comment 0", "1": "summary of comment 2", "2": "summary of comment 3"}
+    assert again == summaries
+    assert len(cohere.prompts) == 3
+
+
+def test_summaries_are_keyed_by_cluster_members(comments):
+    cohere = FakeCohere()
+    summarizer = ClusterSummarizer(cohere)
+    summarizer.summarize({"0": ["c0", "c1"]}, comments)
+
+    # the same members under another cluster id and in another order hit the cache, new members do not
+    summarizer.summarize({"7": ["c1", "c0"]}, comments)
+    summarizer.summarize({"0": ["c0", "c1", "c2"]}, comments)
+
+    assert len(cohere.prompts) == 2
+    assert ClusterSummarizer.summary_key(["a", "b"]) == ClusterSummarizer.summary_key(["b", "a"])
+
+
+def test_prompt_leaves_out_long_and_extra_comments(comments):
+    cohere = FakeCohere()
+    summarizer = ClusterSummarizer(cohere)
+
+    summarizer.summarize({"0": ["long", "missing"] + [f"c{i}" for i in range(40)]}, comments)
+
+    (prompt,) = cohere.prompts
+    assert prompt.splitlines() == [f"comment {i}" for i in range(15)]
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+
+from comment_analysis.clustering_backends import (
+    DBSCANBackend, HDBSCANBackend, MiniBatchKMeansBackend, chunk_rows, create_backend, fit_projection,
+    project_embeddings,
+)
+
+
+def blobs(n_samples, n_features=64, centers=5, cluster_std=0.5, random_state=0):
+    centers = np.random.default_rng(random_state).standard_normal((centers, n_features)) * 10
+    embeddings, labels = make_blobs(n_samples, n_features=n_features, centers=centers, cluster_std=cluster_std,
+                                    random_state=random_state)
+    return embeddings.astype(np.float32), labels
+
+
+def test_chunk_rows_fits_the_budget():
+    assert chunk_rows(1024 * 1024, 10) == 10
+    assert chunk_rows(10 * 1024 * 1024, 1) == 1
+    assert chunk_rows(10 * 1024 * 1024, 1, minimum=4) == 4
+
+
+def test_projected_embeddings_are_unit_vectors():
+    embeddings, _ = blobs(500, n_features=128)
+    projection = fit_projection(embeddings, n_components=16)
+
+    normalized = project_embeddings(embeddings, projection, memory_budget_mb=0.01)
+
+    assert normalized.shape == (500, 16)
+    np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), 1, rtol=1e-5)
+
+
+@pytest.mark.parametrize("backend", [DBSCANBackend(), HDBSCANBackend(), MiniBatchKMeansBackend(n_clusters=5)])
+def test_backends_find_well_separated_clusters(backend):
+    embeddings, labels = blobs(1000)
+
+    backend.fit(embeddings)
+
+    assert adjusted_rand_score(labels, backend.labels_) > 0.95
+    assert len(backend.core_points_) == len(backend.core_labels_)
+
+
+@pytest.mark.parametrize("n_samples", [1, 2, 4])
+def test_hdbscan_handles_videos_with_few_comments(n_samples):
+    embeddings, _ = blobs(n_samples)
+
+    backend = HDBSCANBackend().fit(embeddings)
+
+    assert backend.labels_.tolist() == [-1] * n_samples
+    assert len(backend.core_points_) == 0
+
+
+def test_minibatch_kmeans_converges_on_overlapping_clusters():
+    # one partial_fit over the whole matrix stops far from the converged centers on this data
+    embeddings, labels = make_blobs(20_000, n_features=128, centers=20, cluster_std=9, random_state=0)
+
+    backend = MiniBatchKMeansBackend(n_clusters=20, n_components=None).fit(embeddings.astype(np.float32))
+
+    assert adjusted_rand_score(labels, backend.labels_) > 0.97
+
+
+def test_dbscan_respects_the_memory_budget_chunks():
+    embeddings, labels = blobs(600)
+
+    chunked = DBSCANBackend(memory_budget_mb=0.001).fit(embeddings)
+    unchunked = DBSCANBackend().fit(embeddings)
+
+    np.testing.assert_array_equal(chunked.labels_, unchunked.labels_)
+
+
+def test_empty_embeddings_have_no_clusters():
+    backend = MiniBatchKMeansBackend().fit(np.empty((0, 16), dtype=np.float32))
+
+    assert len(backend.labels_) == 0
+    assert backend.assignment_radius_ == 0.0
+
+
+def test_create_backend_rejects_unknown_names():
+    assert isinstance(create_backend("dbscan", eps=0.2), DBSCANBackend)
+    with pytest.raises(ValueError):
+        create_backend("kmedoids")
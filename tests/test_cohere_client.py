@@ -0,0 +1,110 @@
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from apis.cohere import cohere_client
+from apis.cohere.cohere_client import MODERATION_EXAMPLES, CohereClient
+from common.embedding_cache import EmbeddingCache
+
+
+LABELS = sorted({example.label for example in MODERATION_EXAMPLES})
+EXAMPLE_LABELS = {example.text: example.label for example in MODERATION_EXAMPLES}
+
+
+class FakeCohere:
+    """
+    Stand-in for cohere.Client that labels every text with its first word and records the requests. A text is
+    embedded as the sum of the one-hot vectors of its example label or of the labels it names
+    """
+
+    def __init__(self):
+        self.classify_requests = []
+        self.embed_requests = []
+        self._lock = threading.Lock()
+
+    def classify(self, model, inputs, examples):
+        with self._lock:
+            self.classify_requests.append(list(inputs))
+        return [SimpleNamespace(prediction=text.split()[0]) for text in inputs]
+
+    def embed(self, model, texts, truncate):
+        with self._lock:
+            self.embed_requests.append(list(texts))
+        return SimpleNamespace(embeddings=[embed_text(text).tolist() for text in texts])
+
+
+def embed_text(text):
+    words = [EXAMPLE_LABELS[text]] if text in EXAMPLE_LABELS else text.split()
+    return np.array([float(label in words) for label in LABELS])
+
+
+@pytest.fixture
+def fake():
+    return FakeCohere()
+
+
+@pytest.fixture
+def client(fake):
+    return CohereClient(embedding_cache=EmbeddingCache(cache_dir=None), client=fake)
+
+
+def test_classified_texts_are_not_sent_again(client, fake):
+    texts = ["appropriate comment", "negative comment", "neutral comment"]
+
+    assert client.classify_comments(texts) == ["appropriate", "negative", "neutral"]
+    assert client.classify_comments(texts[::-1]) == ["neutral", "negative", "appropriate"]
+    assert fake.classify_requests == [texts]
+
+
+@pytest.fixture
+def local_client(fake):
+    return CohereClient(embedding_cache=EmbeddingCache(cache_dir=None), moderation_mode="local", client=fake)
+
+
+def test_local_mode_labels_by_the_closest_examples_without_classify_requests(local_client, fake):
+    labels = local_client.classify_comments(["comment negative", "neutral one", "so inappropriate"])
+
+    assert labels == ["negative", "neutral", "inappropriate"]
+    assert fake.classify_requests == []
+    # the examples and the texts, each embedded once
+    assert sorted(map(len, fake.embed_requests)) == [3, len(EXAMPLE_LABELS)]
+
+
+def test_local_mode_sends_the_comments_below_the_margin_to_the_classify_endpoint(local_client, fake):
+    texts = ["appropriate comment", "negative or neutral", "neutral or negative"]
+
+    assert local_client.classify_comments(texts) == ["appropriate", "negative", "neutral"]
+    assert fake.classify_requests == [texts[1:]]
+
+
+def test_local_mode_uses_the_given_embeddings(local_client, fake):
+    texts = ["comment 1", "comment 2"]
+    embeddings = np.stack([embed_text("neutral"), embed_text("appropriate")])
+
+    assert local_client.classify_comments(texts, embeddings=embeddings) == ["neutral", "appropriate"]
+    assert texts not in fake.embed_requests
+
+
+def test_labels_are_cached_per_moderation_mode(client, fake, monkeypatch):
+    texts = ["negative comment", "comment appropriate"]
+
+    assert client.classify_comments(texts) == ["negative", "comment"]
+    client.moderation_mode = "local"
+    assert client.classify_comments(texts) == ["negative", "appropriate"]
+    client.moderation_mode = "remote"
+    assert client.classify_comments(texts) == ["negative", "comment"]
+    assert fake.classify_requests == [texts]
+
+    # new centroids invalidate the local labels, not the remote ones
+    classified_locally = []
+    classify_locally = client._classify_locally
+    monkeypatch.setattr(client, "_classify_locally",
+                        lambda texts, embeddings=None: classified_locally.append(texts) or classify_locally(texts))
+    monkeypatch.setattr(cohere_client, "MODERATION_CENTROIDS_VERSION", cohere_client.MODERATION_CENTROIDS_VERSION + 1)
+    client.classify_comments(texts)
+    client.moderation_mode = "local"
+    assert client.classify_comments(texts) == ["negative", "appropriate"]
+    assert classified_locally == [texts]
+    assert fake.classify_requests == [texts]
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from common.comment_store import CommentStore, iter_documents
+
+COMMENTS = [
+    {"t1": {"author": "ann", "text": "first", "likeCount": 3, "publishedAt": "2023-01-02T03:04:05Z",
+            "totalReplyCount": 2}},
+    {"r1": {"author": "bob", "text": "reply one", "likeCount": 0, "publishedAt": "2023-01-02T04:00:00Z",
+            "parentId": "t1"}},
+    {"t2": {"author": "bob", "text": "second", "likeCount": 1, "publishedAt": "2023-01-03T00:00:00Z",
+            "totalReplyCount": 0}},
+    {"r2": {"author": "ann", "text": "reply two", "likeCount": 5, "publishedAt": "2023-01-02T05:00:00Z",
+            "parentId": "t1"}},
+]
+
+
+def test_round_trip_keeps_the_documents():
+    store = CommentStore.from_comments(COMMENTS)
+
+    assert store.to_comments() == COMMENTS
+    assert list(iter_documents(store)) == list(iter_documents(COMMENTS))
+
+
+def test_columns_and_lookups():
+    store = CommentStore.from_comments(COMMENTS)
+
+    assert len(store) == 4
+    assert "r2" in store and "r3" not in store
+    assert store.ids.tolist() == ["t1", "r1", "t2", "r2"]
+    assert store.like_counts.tolist() == [3, 0, 1, 5]
+    assert store.authors.tolist() == ["ann", "bob", "bob", "ann"]
+    assert store.author_names == ["ann", "bob"]
+    assert store.parent_ids.tolist() == [None, "t1", None, "t1"]
+    assert store.text("t2") == "second"
+    assert store.row("missing") is None
+    assert store.published_at[0] == np.datetime64("2023-01-02T03:04:05")
+
+
+def test_children_index_keeps_the_replies_in_insertion_order():
+    store = CommentStore.from_comments(COMMENTS)
+
+    assert store.replies("t1").tolist() == ["r1", "r2"]
+    assert store.replies("t2").tolist() == []
+    store.add("r3", "cy", "reply three", parent_id="t2")
+    assert store.replies("t2").tolist() == ["r3"]
+
+
+def test_replies_added_before_their_parent_are_linked_to_it():
+    store = CommentStore()
+    store.add("r1", "bob", "early reply", parent_id="t1")
+    assert store["r1"]["parentId"] == "t1"
+    assert store.parent_rows.tolist() == [-1]
+
+    store.add("t1", "ann", "late parent")
+
+    assert store.parent_rows.tolist() == [1, -1]
+    assert store.replies("t1").tolist() == ["r1"]
+
+
+def test_adding_an_id_again_overwrites_it():
+    store = CommentStore.from_comments(COMMENTS)
+
+    store.add("t2", "cy", "edited")
+
+    assert len(store) == 4
+    assert store["t2"] == {"author": "cy", "text": "edited", "likeCount": 0, "publishedAt": None}
+
+
+def test_columns_grow_past_the_initial_capacity():
+    store = CommentStore()
+    for i in range(1000):
+        store.add(f"c{i}", f"author{i % 7}", f"text {i}")
+
+    assert len(store) == 1000
+    assert store.text("c999") == "text 999"
+    assert len(store.author_names) == 7
+
+
+def test_moderation_labels():
+    store = CommentStore.from_comments(COMMENTS)
+
+    store.set_moderation(["neutral", "negative", "appropriate", "neutral"])
+
+    assert store["r1"]["moderation"] == "negative"
+    with pytest.raises(ValueError):
+        store.set_moderation(["neutral"])
+
+
+def test_frame_has_a_categorical_author_column():
+    frame = CommentStore.from_comments(COMMENTS).to_frame()
+
+    assert frame["author"].tolist() == ["ann", "bob", "bob", "ann"]
+    assert frame["author"].dtype == "category"
+    assert frame["comment_id"].tolist() == ["t1", "r1", "t2", "r2"]
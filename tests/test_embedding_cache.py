@@ -0,0 +1,71 @@
+import numpy as np
+
+from common.embedding_cache import EmbeddingCache
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[len(text), float(sum(map(ord, text)))] for text in texts]
+
+
+def test_only_distinct_missing_texts_are_embedded(tmp_path):
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    embed = FakeEmbedder()
+
+    first = cache.embed(["a", "bb", "a"], "model", "END", embed)
+    second = cache.embed(["bb", "ccc"], "model", "END", embed)
+
+    assert embed.calls == [["a", "bb"], ["ccc"]]
+    assert first.dtype == np.float32
+    np.testing.assert_array_equal(first, [[1, 97], [2, 196], [1, 97]])
+    np.testing.assert_array_equal(second, [[2, 196], [3, 297]])
+
+
+def test_embeddings_are_keyed_by_model_and_truncation(tmp_path):
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    embed = FakeEmbedder()
+
+    cache.embed(["a"], "model", "END", embed)
+    cache.embed(["a"], "model", "NONE", embed)
+    cache.embed(["a"], "other", "END", embed)
+
+    assert len(embed.calls) == 3
+
+
+def test_disk_tier_is_shared_by_new_caches(tmp_path):
+    EmbeddingCache(cache_dir=str(tmp_path)).embed(["a", "bb"], "model", "END", FakeEmbedder())
+    embed = FakeEmbedder()
+
+    vectors = EmbeddingCache(cache_dir=str(tmp_path)).embed(["bb", "a"], "model", "END", embed)
+
+    assert embed.calls == []
+    np.testing.assert_array_equal(vectors, [[2, 196], [1, 97]])
+
+
+def test_partially_written_rows_are_dropped(tmp_path):
+    EmbeddingCache(cache_dir=str(tmp_path)).embed(["a", "bb"], "model", "END", FakeEmbedder())
+    (vectors_path,) = tmp_path.glob("*/vectors.f32")
+    with open(vectors_path, "r+b") as f:
+        f.truncate(12)
+    embed = FakeEmbedder()
+
+    vectors = EmbeddingCache(cache_dir=str(tmp_path)).embed(["a", "bb"], "model", "END", embed)
+
+    assert embed.calls == [["bb"]]
+    np.testing.assert_array_equal(vectors, [[1, 97], [2, 196]])
+
+
+def test_memory_only_cache(tmp_path):
+    cache = EmbeddingCache(cache_dir=None, memory_bytes=8)
+    embed = FakeEmbedder()
+
+    cache.embed(["a", "bb"], "model", "END", embed)
+    cache.embed(["bb", "a"], "model", "END", embed)
+
+    # the memory tier holds one 8-byte vector, the least recently used one is embedded again
+    assert embed.calls == [["a", "bb"], ["a"]]
+    assert cache.embed([], "model", "END", embed).shape == (0, 0)
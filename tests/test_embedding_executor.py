@@ -0,0 +1,112 @@
+import pytest
+
+import common.retry
+from apis.cohere.cohere_client import _is_payload_error, _is_retryable
+from apis.cohere.embedding_executor import EmbeddingExecutor
+
+
+class ApiError(Exception):
+    def __init__(self, http_status):
+        super().__init__(f"HTTP {http_status}")
+        self.http_status = http_status
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(common.retry.time, "sleep", lambda seconds: None)
+
+
+def make_executor(embed_batch, **kwargs):
+    return EmbeddingExecutor(embed_batch, requests_per_second=None, retryable=_is_retryable,
+                             splittable=_is_payload_error, **kwargs)
+
+
+def test_pack_batches_respects_text_and_character_budgets():
+    executor = make_executor(None, max_batch_texts=3, max_batch_chars=10)
+
+    batches = executor.pack_batches(["aaaa", "bbbb", "cc", "d", "e", "ffffffffffff", "g"])
+
+    assert batches == [(0, 3), (3, 5), (5, 6), (6, 7)]
+
+
+def test_vectors_are_returned_in_the_order_of_the_texts():
+    executor = make_executor(lambda texts: [[len(text)] for text in texts], max_batch_texts=2, max_workers=3)
+    texts = ["a" * length for length in range(1, 10)]
+
+    assert executor.embed(texts) == [[length] for length in range(1, 10)]
+
+
+def test_run_returns_the_results_of_any_batch_function():
+    executor = make_executor(lambda texts, suffix: [text + suffix for text in texts], max_batch_texts=2)
+
+    assert executor.run(["a", "b", "c"], suffix="!") == ["a!", "b!", "c!"]
+
+
+def test_batch_with_a_rejected_text_is_split_until_the_text_is_isolated():
+    requests = []
+
+    def embed_batch(texts):
+        requests.append(list(texts))
+        if "bad" in texts:
+            raise ApiError(400)
+        return [[1.0] for _ in texts]
+
+    executor = make_executor(embed_batch, max_batch_texts=8)
+
+    with pytest.raises(ApiError):
+        executor.embed(["ok"] * 7 + ["bad"])
+    # every request containing the bad text is sent once, the halves without it succeed
+    assert [len(texts) for texts in requests if "bad" in texts] == [8, 4, 2, 1]
+    assert sum(len(texts) for texts in requests if "bad" not in texts) == 7
+
+
+def test_payload_too_large_is_split_without_retrying():
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(len(texts))
+        if len(texts) > 2:
+            raise ApiError(413)
+        return [[1.0] for _ in texts]
+
+    executor = make_executor(embed_batch, max_batch_texts=8)
+
+    assert len(executor.embed(["text"] * 8)) == 8
+    assert calls == [8, 4, 2, 2, 4, 2, 2]
+
+
+def test_service_errors_are_retried_and_not_split():
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(len(texts))
+        raise ApiError(503)
+
+    executor = make_executor(embed_batch, max_batch_texts=96)
+
+    with pytest.raises(ApiError):
+        executor.embed(["text"] * 96)
+    assert calls == [96] * common.retry.RETRY_ATTEMPTS
+
+
+def test_transient_errors_are_retried():
+    failures = [ApiError(429), ConnectionError("reset")]
+
+    def embed_batch(texts):
+        if failures:
+            raise failures.pop(0)
+        return [[1.0] for _ in texts]
+
+    assert make_executor(embed_batch).embed(["a", "b"]) == [[1.0], [1.0]]
+
+
+def test_other_client_errors_fail_immediately():
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(len(texts))
+        raise ApiError(401)
+
+    with pytest.raises(ApiError):
+        make_executor(embed_batch, max_batch_texts=8).embed(["text"] * 8)
+    assert calls == [8]
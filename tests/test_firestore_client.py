@@ -0,0 +1,207 @@
+import threading
+import time
+
+from apis.firestore import firestore_client
+from apis.firestore.firestore_client import FirestoreClient
+
+
+class FakeSnapshot:
+    def __init__(self, document_id, data):
+        self.id = document_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self.exists else None
+
+
+class FakeDocumentRef:
+    def __init__(self, db, collection, document_id):
+        self.db = db
+        self.collection = collection
+        self.id = document_id
+
+    def set(self, data):
+        self.db.collections.setdefault(self.collection, {})[self.id] = dict(data)
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, document_id):
+        return FakeDocumentRef(self.db, self.name, document_id)
+
+    def select(self, fields):
+        return self
+
+    def stream(self):
+        self.db.streams.append(self.name)
+        for document_id, data in list(self.db.collections.get(self.name, {}).items()):
+            yield FakeSnapshot(document_id, data)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref, data))
+
+    def commit(self):
+        with self.db.lock:
+            self.db.in_flight += 1
+            self.db.max_in_flight = max(self.db.max_in_flight, self.db.in_flight)
+        # long enough for the other batches to start
+        time.sleep(0.01)
+        for ref, data in self.writes:
+            ref.set(data)
+        with self.db.lock:
+            self.db.in_flight -= 1
+            self.db.committed_batches.append(len(self.writes))
+
+
+class FakeDb:
+    """
+    In-memory stand-in for the Firestore client, recording the reads and the concurrency of the batch commits
+    """
+
+    def __init__(self, collections=None):
+        self.collections = collections or {}
+        self.requested_ids = []
+        self.streams = []
+        self.committed_batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def get_all(self, refs):
+        with self.lock:
+            self.requested_ids.extend(ref.id for ref in refs)
+        return [FakeSnapshot(ref.id, self.collections.get(ref.collection, {}).get(ref.id)) for ref in refs]
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def test_documents_are_returned_in_the_order_of_the_ids(monkeypatch):
+    monkeypatch.setattr(firestore_client, "READ_BATCH_SIZE", 3)
+    db = FakeDb({"video": {f"c{i}": {"text": f"comment {i}"} for i in range(10)}})
+
+    ids = ["c7", "c2", "missing", "c9", "c0", "c5", "c1", "c8"]
+    documents = FirestoreClient(db=db).get_documents_by_ids("video", ids)
+
+    assert [document["text"] for document in documents] == [f"comment {id[1:]}" for id in ids if id != "missing"]
+
+
+def test_duplicate_ids_are_read_once_and_returned_every_time():
+    db = FakeDb({"video": {"a": {"text": "a"}, "b": {"text": "b"}}})
+
+    documents = FirestoreClient(db=db).get_documents_by_ids("video", ["a", "b", "a", "a"])
+
+    assert [document["text"] for document in documents] == ["a", "b", "a", "a"]
+    assert sorted(db.requested_ids) == ["a", "b"]
+
+
+def test_cached_documents_are_not_read_again():
+    db = FakeDb({"video": {"a": {"text": "a"}, "b": {"text": "b"}}, "other": {"a": {"text": "other a"}}})
+    client = FirestoreClient(db=db)
+
+    client.get_documents_by_ids("video", ["a"])
+    documents = client.get_documents_by_ids("video", ["a", "b"])
+    documents[0]["text"] = "modified"
+
+    assert db.requested_ids == ["a", "b"]
+    assert client.get_document_by_id("video", "a") == {"text": "a"}
+    assert client.get_document_by_id("other", "a") == {"text": "other a"}
+    assert db.requested_ids == ["a", "b", "a"]
+
+
+def test_the_read_cache_has_one_budget_for_all_the_collections(monkeypatch):
+    db = FakeDb({f"video{i}": {"a": {"text": "x" * 1000}} for i in range(3)})
+    size = firestore_client._document_size({"text": "x" * 1000})
+    monkeypatch.setattr(firestore_client, "READ_CACHE_BYTES", 2 * size)
+    client = FirestoreClient(db=db)
+
+    for i in range(3):
+        client.get_document_by_id(f"video{i}", "a")
+
+    assert client._read_cache.size == 2 * size
+    assert ("video0", "a") not in client._read_cache
+
+
+def make_documents(count, text="comment"):
+    return [{f"c{i}": {"text": f"{text} {i}"}} for i in range(count)]
+
+
+def test_unchanged_documents_are_skipped(monkeypatch):
+    monkeypatch.setattr(firestore_client, "WRITE_DOCUMENTS_PER_SECOND", None)
+    db = FakeDb()
+    FirestoreClient(db=db).save_documents("video", make_documents(5))
+    # a new client reads the hashes stored with the documents
+    client = FirestoreClient(db=db)
+
+    documents = make_documents(5)
+    documents[3] = {"c3": {"text": "edited"}}
+    stats = client.save_documents("video", documents + [{"c5": {"text": "new"}}])
+
+    assert (stats["documents"], stats["skipped"]) == (2, 4)
+    assert db.streams == ["video", "video"]
+    assert client.get_document_by_id("video", "c3") == {"text": "edited"}
+    assert client.save_documents("video", documents)["skipped"] == 5
+
+
+def test_the_batches_in_flight_are_bounded(monkeypatch):
+    monkeypatch.setattr(firestore_client, "WRITE_DOCUMENTS_PER_SECOND", None)
+    monkeypatch.setattr(firestore_client, "WRITE_BATCH_SIZE", 2)
+    db = FakeDb()
+    # documents read ahead of the committed batches, by document
+    read_ahead = []
+
+    def documents():
+        for index, document in enumerate(make_documents(40)):
+            read_ahead.append(index - 2 * len(db.committed_batches))
+            yield document
+
+    FirestoreClient(db=db).save_documents("video", documents(), max_workers=2)
+
+    assert db.committed_batches == [2] * 20
+    assert db.max_in_flight == 2
+    # at most 2 * max_workers batches pending, plus the batch being filled
+    assert max(read_ahead) < 2 * (2 * 2 + 1)
+
+
+def test_the_write_stats_are_reported(monkeypatch):
+    monkeypatch.setattr(firestore_client, "WRITE_DOCUMENTS_PER_SECOND", None)
+    monkeypatch.setattr(firestore_client, "WRITE_BATCH_SIZE", 3)
+    client = FirestoreClient(db=FakeDb())
+    client.save_documents("video", make_documents(4))
+
+    stats = client.save_documents("video", make_documents(7))
+
+    assert (stats["documents"], stats["skipped"]) == (3, 4)
+    assert stats["bytes"] == sum(len(f'{{"text": "comment {i}"}}') for i in range(4, 7))
+    assert stats["seconds"] > 0
+    assert stats["documents_per_second"] == stats["documents"] / stats["seconds"]
+    assert stats["bytes_per_second"] == stats["bytes"] / stats["seconds"]
+    assert client.last_write_stats is stats
+
+
+def test_the_stored_hashes_are_bounded(monkeypatch):
+    monkeypatch.setattr(firestore_client, "WRITE_DOCUMENTS_PER_SECOND", None)
+    monkeypatch.setattr(firestore_client, "STORED_HASHES_SIZE", 10)
+    db = FakeDb()
+    client = FirestoreClient(db=db)
+
+    for video in ("video0", "video1", "video2"):
+        client.save_documents(video, make_documents(4))
+
+    assert client._stored_hashes.size == 8
+    assert "video0" not in client._stored_hashes
+    assert client.save_documents("video0", make_documents(4))["skipped"] == 4
+    assert db.streams == ["video0", "video1", "video2", "video0"]
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from common.comment_store import CommentStore
+from pipeline.ingestion import CommentIngestionPipeline, CommentLimitExceeded
+
+
+class FakeYouTube:
+    def __init__(self, pages, declared_count=None):
+        self.pages = pages
+        self.declared_count = declared_count
+        self.pages_fetched = 0
+
+    def get_comment_count(self, video_id):
+        return self.declared_count
+
+    def stream_comment_threads(self, video_id):
+        for page in self.pages:
+            self.pages_fetched += 1
+            yield page
+
+
+class FakeDocumentStore:
+    def __init__(self):
+        self.saved = []
+
+    def save_documents(self, collection, documents):
+        self.saved.extend(documents.ids)
+
+
+class FakeCohere:
+    def __init__(self):
+        self.embedded = 0
+        self.classified = 0
+
+    def classify_comments(self, texts):
+        self.classified += len(texts)
+        return ["appropriate"] * len(texts)
+
+    def embed(self, texts):
+        self.embedded += len(texts)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+class FakeVectorIndex:
+    def __init__(self):
+        self.saved = []
+
+    def save(self, vectors, namespace):
+        self.saved.extend(comment_id for comment_id, _, _ in vectors)
+
+
+def make_pages(num_pages, page_size):
+    pages = []
+    for page_index in range(num_pages):
+        page = CommentStore()
+        for i in range(page_size):
+            page.add(f"c{page_index}-{i}", author="author", text=f"comment {page_index} {i}")
+        pages.append(page)
+    return pages
+
+
+def make_pipeline(youtube):
+    return CommentIngestionPipeline(youtube, FakeDocumentStore(), FakeCohere(), FakeVectorIndex())
+
+
+def test_run_ingests_every_page_in_order():
+    pipeline = make_pipeline(FakeYouTube(make_pages(3, 5)))
+
+    comments, embeddings = pipeline.run("video")
+
+    assert list(comments.ids) == [f"c{p}-{i}" for p in range(3) for i in range(5)]
+    assert embeddings.shape == (15, 4)
+    assert sorted(pipeline.firestore.saved) == sorted(comments.ids)
+    assert sorted(pipeline.pinecone.saved) == sorted(comments.ids)
+    assert set(comments.moderation) == {"appropriate"}
+
+
+def test_video_over_the_declared_limit_is_rejected_before_fetching():
+    youtube = FakeYouTube(make_pages(3, 5), declared_count=15)
+    pipeline = make_pipeline(youtube)
+
+    with pytest.raises(CommentLimitExceeded):
+        pipeline.run("video", comment_limit=10)
+
+    assert youtube.pages_fetched == 0
+    assert pipeline.firestore.saved == []
+
+
+def test_video_over_the_limit_with_stale_statistics_leaves_nothing_behind():
+    # the statistics undercount the comments, the limit is only exceeded on the last page
+    pipeline = make_pipeline(FakeYouTube(make_pages(3, 5), declared_count=5))
+
+    with pytest.raises(CommentLimitExceeded):
+        pipeline.run("video", comment_limit=12)
+
+    assert pipeline.firestore.saved == []
+    assert pipeline.pinecone.saved == []
+    assert pipeline.cohere.embedded == 0
+    assert pipeline.cohere.classified == 0
+
+
+def test_video_under_the_limit_is_ingested():
+    pipeline = make_pipeline(FakeYouTube(make_pages(2, 5), declared_count=10))
+
+    comments, embeddings = pipeline.run("video", comment_limit=11)
+
+    assert len(comments) == 10
+    assert len(pipeline.pinecone.saved) == 10
+
+
+def test_spilled_embeddings_are_memory_mapped(tmp_path):
+    pipeline = make_pipeline(FakeYouTube(make_pages(3, 5)))
+    embeddings_file = str(tmp_path / "embeddings.npy")
+
+    comments, embeddings = pipeline.run("video", embeddings_file=embeddings_file)
+
+    assert isinstance(embeddings, np.memmap)
+    assert embeddings.shape == (15, 4)
+    assert not (tmp_path / "embeddings.npy.part").exists()
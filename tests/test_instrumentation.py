@@ -0,0 +1,100 @@
+import json
+import threading
+
+import pytest
+
+from common import instrumentation
+from common.instrumentation import Metrics, instrumented, propagate_context, scope
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr(instrumentation, "_metrics", metrics)
+    return metrics
+
+
+@instrumented("fake", exclude=("helper",))
+class FakeComponent:
+    def process(self, texts, label=""):
+        return {text: label for text in texts}
+
+    def fail(self, texts):
+        raise RuntimeError("failed")
+
+    def retry(self):
+        instrumentation.get_metrics().record_retry()
+
+    def helper(self):
+        return None
+
+    def stream(self, texts):
+        yield from texts
+
+
+def test_calls_items_and_payloads_are_recorded(metrics):
+    FakeComponent().process(["ab", "cde"], label="x")
+
+    stats = metrics.snapshot(instrumentation.GLOBAL_SCOPE)["fake.process"]
+    assert stats["calls"] == 1 and stats["errors"] == 0
+    assert stats["items"] == 2
+    assert stats["bytes_sent"] == 5 + 1
+    assert stats["bytes_received"] == 5 + 2
+
+
+def test_errors_and_retries_are_recorded(metrics):
+    component = FakeComponent()
+    with pytest.raises(RuntimeError):
+        component.fail(["a"])
+    component.retry()
+
+    stats = metrics.snapshot(instrumentation.GLOBAL_SCOPE)
+    assert stats["fake.fail"]["errors"] == 1
+    assert stats["fake.retry"]["retries"] == 1
+
+
+def test_excluded_and_generator_methods_are_not_instrumented(metrics):
+    component = FakeComponent()
+    component.helper()
+    list(component.stream(["a"]))
+
+    assert metrics.snapshot() == {}
+
+
+def test_calls_are_attributed_to_the_scope_and_propagated_to_threads(metrics):
+    component = FakeComponent()
+    with scope("video"):
+        component.process(["a"])
+        thread = threading.Thread(target=propagate_context(component.process), args=(["b"],))
+        thread.start()
+        thread.join()
+    component.process(["c"])
+
+    assert metrics.snapshot("video")["fake.process"]["calls"] == 2
+    assert metrics.snapshot(instrumentation.GLOBAL_SCOPE)["fake.process"]["calls"] == 1
+
+
+def test_oldest_scopes_are_dropped(monkeypatch):
+    metrics = Metrics(max_scopes=2)
+    for name in ("a", "b", "c"):
+        metrics.record("fake.process", 0.1, scope=name)
+
+    assert metrics.scopes() == ["b", "c"]
+
+
+def test_exports(metrics):
+    metrics.record("fake.process", 0.5, items=3, scope='video "1"')
+
+    document = json.loads(metrics.to_json())
+    assert document["scopes"]['video "1"']["fake.process"]["items"] == 3
+    exposition = metrics.to_prometheus()
+    assert '# TYPE tubetalk_operation_calls_total counter' in exposition
+    assert 'tubetalk_operation_items_total{analysis="video \\"1\\"",component="fake",method="process"} 3' \
+        in exposition
+
+
+def test_large_payloads_are_estimated_from_a_sample():
+    texts = ["x" * 10] * 1000
+
+    assert instrumentation._payload_size(texts) == 10_000
+    assert instrumentation._payload_size({"key": texts}) == 3 + 10_000
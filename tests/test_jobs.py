@@ -0,0 +1,182 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from comment_analysis.topic_identifier import TopicResult
+from common.comment_store import CommentStore
+from pipeline.jobs import DONE, FAILED, STAGES, AnalysisJobRunner
+
+
+class FakeYouTube:
+    def __init__(self, comment_count, latest_comment_id):
+        self.comment_count = comment_count
+        self.latest_comment_id = latest_comment_id
+
+    def get_comment_count(self, video_id):
+        return self.comment_count
+
+    def get_latest_comment_id(self, video_id):
+        return self.latest_comment_id
+
+
+class FakeIngestion:
+    def __init__(self, youtube):
+        self.youtube = youtube
+        self.runs = []
+
+    def run(self, video_id, comment_limit=None, embeddings_file=None):
+        self.runs.append(video_id)
+        comments = CommentStore()
+        for i in range(self.youtube.comment_count):
+            comments.add(f"c{i}", "author", f"comment {i}")
+        return comments, np.ones((len(comments), 4), dtype=np.float32)
+
+
+class FakeTopicModel:
+    def __call__(self, texts, video_id=None):
+        self.texts = texts
+
+    def identify_topics(self, num_topics):
+        self.num_topics = num_topics
+
+    def extract_topics(self, num_words):
+        return TopicResult([["word"] * num_words] * self.num_topics,
+                           np.ones((self.num_topics, num_words), dtype=np.float32),
+                           np.ones((len(self.texts), self.num_topics), dtype=np.float32))
+
+
+class FakeClusterModel:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.runs = 0
+
+    def update_comments(self, video_id, comments, embeddings=None):
+        self.runs += 1
+        if self.runs <= self.failures:
+            raise RuntimeError("clustering failed")
+        return {0: list(comments.ids)}
+
+
+class FakeSummarizer:
+    def summarize(self, clusters, comments):
+        return {cluster_id: "summary" for cluster_id in clusters}
+
+
+def wait(job, timeout=10):
+    deadline = time.time() + timeout
+    while not job.finished:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return job
+
+
+@pytest.fixture
+def youtube():
+    return FakeYouTube(comment_count=3, latest_comment_id="thread-1")
+
+
+@pytest.fixture
+def ingestion(youtube):
+    return FakeIngestion(youtube)
+
+
+def create_runner(ingestion, tmp_path, cluster_model=None, **kwargs):
+    return AnalysisJobRunner(ingestion, cluster_model or FakeClusterModel(), FakeSummarizer(),
+                             topic_model_factory=FakeTopicModel, data_dir=str(tmp_path / "jobs"), **kwargs)
+
+
+@pytest.fixture
+def runner(ingestion, tmp_path):
+    return create_runner(ingestion, tmp_path)
+
+
+def test_jobs_run_every_stage(runner):
+    job = wait(runner.submit("video"))
+
+    assert job.state == DONE
+    assert job.completed_stages == list(STAGES)
+    assert job.results["clusters"] == {"0": ["c0", "c1", "c2"]}
+
+
+def test_new_comment_with_the_same_count_is_analyzed_again(runner, youtube, ingestion):
+    first = wait(runner.submit("video"))
+    youtube.latest_comment_id = "thread-2"
+
+    second = wait(runner.submit("video"))
+
+    assert second is not first
+    assert second.fingerprint != first.fingerprint
+    assert ingestion.runs == ["video", "video"]
+
+
+def test_concurrent_submissions_share_the_job(runner, ingestion):
+    jobs = [runner.submit("video") for _ in range(3)]
+
+    assert jobs[1] is jobs[0] and jobs[2] is jobs[0]
+    wait(jobs[0])
+    assert runner.get("video", jobs[0].fingerprint) is jobs[0]
+    assert ingestion.runs == ["video"]
+
+
+def test_stage_outputs_are_loaded_by_a_new_runner(runner, ingestion, tmp_path):
+    job = wait(runner.submit("video"))
+    cluster_model = FakeClusterModel()
+
+    reloaded = wait(create_runner(ingestion, tmp_path, cluster_model=cluster_model).submit("video"))
+
+    assert reloaded.state == DONE
+    assert ingestion.runs == ["video"] and cluster_model.runs == 0
+    assert reloaded.results["ingest"]["comments"].to_comments() == job.results["ingest"]["comments"].to_comments()
+    np.testing.assert_array_equal(reloaded.results["ingest"]["embeddings"], job.results["ingest"]["embeddings"])
+    assert reloaded.results["topics"].words == job.results["topics"].words
+    np.testing.assert_array_equal(reloaded.results["topics"].document_topics, job.results["topics"].document_topics)
+    assert reloaded.results["clusters"] == job.results["clusters"]
+    assert reloaded.results["summaries"] == job.results["summaries"]
+
+
+def test_failed_analysis_resumes_from_its_first_missing_stage(ingestion, tmp_path):
+    cluster_model = FakeClusterModel(failures=1)
+    runner = create_runner(ingestion, tmp_path, cluster_model=cluster_model)
+    failed = wait(runner.submit("video"))
+    assert failed.state == FAILED
+    assert failed.completed_stages == ["ingest", "topics"]
+
+    job = wait(runner.submit("video"))
+
+    assert job is not failed and job.state == DONE
+    assert ingestion.runs == ["video"] and cluster_model.runs == 2
+
+
+def test_large_videos_are_flagged(ingestion, tmp_path):
+    runner = create_runner(ingestion, tmp_path, large_video_min_comments=3)
+
+    assert wait(runner.submit("video")).large
+
+
+def test_topics_stages_of_a_video_do_not_overlap(ingestion, youtube, tmp_path):
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    class SlowTopicModel(FakeTopicModel):
+        def __call__(self, texts, video_id=None):
+            with lock:
+                running.append(video_id)
+                overlaps.append(running.count(video_id) > 1)
+            time.sleep(0.2)
+            with lock:
+                running.remove(video_id)
+            super().__call__(texts, video_id)
+
+    runner = AnalysisJobRunner(ingestion, FakeClusterModel(), FakeSummarizer(), topic_model_factory=SlowTopicModel,
+                               data_dir=str(tmp_path / "jobs"))
+    first = runner.submit("video")
+    youtube.latest_comment_id = "thread-2"
+    second = runner.submit("video")
+
+    assert first.fingerprint != second.fingerprint
+    assert wait(first).state == DONE and wait(second).state == DONE
+    assert overlaps == [False, False]
+    assert runner._topic_locks == {}
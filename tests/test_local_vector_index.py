@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+from apis.local_index import local_vector_index
+from apis.local_index.local_vector_index import LocalVectorIndex
+
+
+def random_vectors(count, dimension=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dimension)).astype(np.float32)
+
+
+def records(vectors, prefix="v", metadata=None):
+    return [(f"{prefix}{i}", vector, metadata(i) if metadata else {}) for i, vector in enumerate(vectors)]
+
+
+def exact_top(vectors, query, top_k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return [f"v{i}" for i in np.argsort(-(unit @ query))[:top_k]]
+
+
+@pytest.fixture(params=["memory", "disk"])
+def index(request, tmp_path):
+    return LocalVectorIndex("index", data_dir=None if request.param == "memory" else str(tmp_path))
+
+
+def test_query_returns_the_most_similar_ids(index):
+    vectors = random_vectors(200)
+    index.save(records(vectors), "video")
+
+    assert index.query("video", vectors[7] * 3, top_k=5) == exact_top(vectors, vectors[7], 5)
+    assert index.query("video", None, id="v7", top_k=1) == ["v7"]
+    assert index.query("video", None, id="missing") == []
+    assert index.query("other", vectors[0]) == []
+
+
+def test_query_batch_matches_single_queries(index):
+    vectors = random_vectors(300)
+    index.save(records(vectors, metadata=lambda i: {"parity": i % 2}), "video")
+
+    results = index.query_batch("video", vectors[:4], filter={"parity": 0}, top_k=3, include_metadata=True)
+
+    for query, result in zip(vectors[:4], results):
+        assert result["ids"] == index.query("video", query, filter={"parity": 0}, top_k=3)
+        assert result["metadata"] == [{"parity": 0}] * 3
+        assert result["scores"] == sorted(result["scores"], reverse=True)
+
+
+def test_metadata_filters(index):
+    vectors = random_vectors(30)
+    index.save(records(vectors, metadata=lambda i: {"author": f"a{i % 3}", "likes": i}), "video")
+
+    def matching(filter):
+        return set(index.query("video", vectors[0], filter=filter, top_k=30))
+
+    assert matching({"author": "a1"}) == {f"v{i}" for i in range(1, 30, 3)}
+    assert matching({"author": {"$nin": ["a0", "a1"]}}) == {f"v{i}" for i in range(2, 30, 3)}
+    assert matching({"$or": [{"likes": {"$in": [1, 2]}}, {"author": "a0", "likes": {"$ne": 0}}]}) == \
+        {"v1", "v2"} | {f"v{i}" for i in range(3, 30, 3)}
+    with pytest.raises(Exception):
+        matching({"likes": {"$gt": 3}})
+
+
+def test_none_filters_match_missing_and_none_fields(index):
+    vectors = random_vectors(9)
+    index.save(records(vectors, metadata=lambda i: [{}, {"parent": None}, {"parent": "p"}][i % 3]), "video")
+
+    def matching(filter):
+        return set(index.query("video", vectors[0], filter=filter, top_k=9))
+
+    without_parent = {f"v{i}" for i in range(9) if i % 3 != 2}
+    assert matching({"parent": None}) == without_parent
+    assert matching({"parent": {"$eq": None}}) == without_parent
+    assert matching({"parent": {"$in": [None, "p"]}}) == {f"v{i}" for i in range(9)}
+    assert matching({"parent": {"$ne": None}}) == {"v2", "v5", "v8"}
+    assert matching({"parent": {"$nin": [None]}}) == {"v2", "v5", "v8"}
+
+
+def test_saving_an_id_again_replaces_its_vector(index):
+    vectors = random_vectors(10)
+    index.save(records(vectors), "video")
+
+    index.save([("v0", vectors[1], {"replaced": True})], "video")
+
+    fetched = index.fetch_by_ids(["v0", "missing"], "video")["vectors"]
+    assert list(fetched) == ["v0"]
+    np.testing.assert_allclose(fetched["v0"]["values"], vectors[1])
+    assert fetched["v0"]["metadata"] == {"replaced": True}
+    assert len(index.query("video", vectors[1], top_k=20)) == 10
+
+
+def test_delete_by_ids_filters_and_namespace(index):
+    vectors = random_vectors(10)
+    index.save(records(vectors, metadata=lambda i: {"parity": i % 2}), "video")
+
+    index.delete("video", ["v0", "v1"])
+    index.delete("video", None, filters={"parity": 1})
+
+    assert sorted(index.query("video", vectors[0], top_k=20)) == ["v2", "v4", "v6", "v8"]
+    with pytest.raises(Exception):
+        index.delete("video", None, delete_all=True, filters={"parity": 0})
+    index.delete("video", None, delete_all=True)
+    assert index.query("video", vectors[0]) == []
+
+
+def test_dimension_mismatch_is_rejected(index):
+    index.save(records(random_vectors(2)), "video")
+
+    with pytest.raises(Exception):
+        index.save(records(random_vectors(2, dimension=8)), "video")
+
+
+def test_overwritten_rows_are_compacted(tmp_path):
+    index = LocalVectorIndex("index", data_dir=str(tmp_path))
+    vectors = random_vectors(100)
+    index.save(records(vectors), "video")
+
+    for _ in range(3):
+        index.save(records(vectors[:60]), "video")
+
+    namespace = index._namespace("video")
+    assert namespace._num_rows < 2 * namespace.size
+    assert (tmp_path / "index" / "video" / "vectors.f32").stat().st_size == namespace._num_rows * 16 * 4
+    assert index.query("video", vectors[70], top_k=3) == exact_top(vectors, vectors[70], 3)
+
+
+def test_namespaces_are_reloaded_and_torn_writes_dropped(tmp_path):
+    vectors = random_vectors(20)
+    LocalVectorIndex("index", data_dir=str(tmp_path)).save(records(vectors), "video")
+    vectors_path = tmp_path / "index" / "video" / "vectors.f32"
+    with open(vectors_path, "r+b") as f:
+        f.truncate(19 * 16 * 4 + 10)
+
+    index = LocalVectorIndex("index", data_dir=str(tmp_path))
+
+    assert index.query("video", vectors[3], top_k=1) == ["v3"]
+    assert list(index.fetch_by_ids(["v18", "v19"], "video")["vectors"]) == ["v18"]
+    index.save(records(vectors[19:], prefix="w"), "video")
+    assert LocalVectorIndex("index", data_dir=str(tmp_path)).query("video", vectors[19], top_k=1) == ["w0"]
+
+
+def test_large_namespaces_are_searched_through_the_ivf_index(monkeypatch):
+    monkeypatch.setattr(local_vector_index, "IVF_MIN_VECTORS", 1000)
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 16))
+    vectors = (centers[rng.integers(0, 20, 2000)] + 0.1 * rng.normal(size=(2000, 16))).astype(np.float32)
+    index = LocalVectorIndex("index", data_dir=None)
+    index.save(records(vectors), "video")
+
+    queries = vectors[:50]
+    recall = np.mean([
+        len(set(index.query("video", query, top_k=10)) & set(exact_top(vectors, query, 10))) / 10
+        for query in queries
+    ])
+
+    assert index._namespace("video")._ivf is not None
+    assert recall > 0.9
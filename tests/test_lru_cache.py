@@ -0,0 +1,78 @@
+import threading
+
+from common import lru_cache
+from common.lru_cache import LRUCache
+
+
+def test_least_recently_used_values_are_evicted():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+
+    cache.put("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_cache_is_bounded_by_the_size_of_the_values():
+    cache = LRUCache(max_size=10, sizeof=len)
+    cache.put("a", "x" * 4)
+    cache.put("b", "x" * 4)
+    cache.put("c", "x" * 4)
+
+    assert len(cache) == 2 and cache.size == 8
+    cache.put("big", "x" * 11)
+    assert "big" not in cache and cache.size == 8
+
+
+def test_putting_a_key_again_replaces_its_size():
+    cache = LRUCache(max_size=10, sizeof=len)
+    cache.put("a", "x" * 4)
+    cache.put("a", "x" * 6)
+
+    assert cache.size == 6
+    # a value that no longer fits drops the previous one
+    cache.put("a", "x" * 11)
+    assert "a" not in cache and cache.size == 0
+
+
+def test_values_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(lru_cache.time, "monotonic", lambda: now[0])
+    cache = LRUCache(max_size=10, ttl=5)
+    cache.put("a", 1)
+
+    now[0] = 104.0
+    assert cache.get("a") == 1
+    now[0] = 105.0
+    assert cache.get("a", "expired") == "expired"
+    assert cache.size == 0
+
+
+def test_pop_and_clear():
+    cache = LRUCache(max_size=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a", "missing") == "missing"
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_concurrent_puts_keep_the_size_consistent():
+    cache = LRUCache(max_size=50)
+
+    def put(offset):
+        for i in range(1000):
+            cache.put((offset, i), i)
+
+    threads = [threading.Thread(target=put, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == cache.size == 50
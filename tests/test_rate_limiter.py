@@ -0,0 +1,53 @@
+import pytest
+
+from common import rate_limiter
+from common.rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = {"now": 0.0, "sleeps": []}
+
+    def sleep(seconds):
+        clock["sleeps"].append(seconds)
+        clock["now"] += seconds
+
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(rate_limiter.time, "sleep", sleep)
+    return clock
+
+
+def test_burst_is_served_without_waiting(clock):
+    limiter = RateLimiter(rate=10)
+
+    for _ in range(10):
+        limiter.acquire()
+
+    assert clock["sleeps"] == []
+
+
+def test_requests_beyond_the_burst_wait_for_tokens(clock):
+    limiter = RateLimiter(rate=10, burst=2)
+    for _ in range(4):
+        limiter.acquire()
+
+    assert clock["now"] == pytest.approx(0.2)
+
+
+def test_large_requests_are_let_through_and_paid_back(clock):
+    limiter = RateLimiter(rate=10, burst=5)
+
+    limiter.acquire(20)
+    assert clock["now"] == 0.0
+    limiter.acquire(1)
+
+    # the bucket was 15 tokens short, plus the token of the second request
+    assert clock["now"] == pytest.approx(1.6)
+
+
+def test_no_rate_disables_the_limit(clock):
+    limiter = RateLimiter(rate=None)
+
+    limiter.acquire(1_000_000)
+
+    assert clock["sleeps"] == []
@@ -0,0 +1,55 @@
+import pytest
+
+from common import retry
+from common.retry import retry_call
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(retry.time, "sleep", delays.append)
+    return delays
+
+
+def flaky(failures, error=RuntimeError):
+    calls = []
+
+    def call():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise error(len(calls))
+        return len(calls)
+
+    return call, calls
+
+
+def test_failures_are_retried_with_exponential_backoff(delays):
+    call, calls = flaky(2)
+
+    assert retry_call(call, attempts=4, base_delay=1.0, max_delay=10.0) == 3
+    assert len(delays) == 2
+    assert 0.5 <= delays[0] <= 1.0 and 1.0 <= delays[1] <= 2.0
+
+
+def test_delay_is_capped(delays):
+    call, _ = flaky(5)
+
+    retry_call(call, attempts=6, base_delay=1.0, max_delay=3.0)
+
+    assert max(delays) <= 3.0
+
+
+def test_last_error_is_raised_once_the_attempts_are_exhausted(delays):
+    call, calls = flaky(10)
+
+    with pytest.raises(RuntimeError, match="3"):
+        retry_call(call, attempts=3)
+    assert len(calls) == 3
+
+
+def test_errors_that_are_not_retryable_are_raised_at_once(delays):
+    call, calls = flaky(10, error=ValueError)
+
+    with pytest.raises(ValueError):
+        retry_call(call, retryable=lambda e: not isinstance(e, ValueError))
+    assert len(calls) == 1 and delays == []
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from apis.sqlite.sqlite_client import SQLiteClient
+from common.comment_store import CommentStore
+
+COMMENTS = [
+    {"t1": {"author": "ann", "text": "first", "likeCount": 3, "publishedAt": "2023-01-02T03:04:05Z"}},
+    {"r1": {"author": "bob", "text": "reply", "likeCount": 0, "publishedAt": "2023-01-02T04:00:00Z",
+            "parentId": "t1"}},
+    {"t2": {"author": "bob", "text": "second", "likeCount": 7, "publishedAt": "2023-01-03T00:00:00Z"}},
+]
+
+
+@pytest.fixture
+def client(tmp_path):
+    return SQLiteClient(database_file=str(tmp_path / "db" / "documents.sqlite3"))
+
+
+def test_documents_are_read_back_in_the_requested_order(client):
+    client.save_documents("video", COMMENTS)
+
+    documents = client.get_documents_by_ids("video", ["t2", "missing", "t1", "t2"])
+
+    assert [document["text"] for document in documents] == ["second", "first", "second"]
+    assert client.get_document_by_id("video", "r1")["parentId"] == "t1"
+    assert client.get_document_by_id("video", "missing") is None
+
+
+def test_comment_stores_are_saved_like_document_lists(client):
+    client.save_documents("video", CommentStore.from_comments(COMMENTS))
+
+    assert client.get_document_by_id("video", "t1") == COMMENTS[0]["t1"]
+
+
+def test_unchanged_documents_are_skipped(client):
+    assert client.save_documents("video", COMMENTS)["documents"] == 3
+
+    edited = COMMENTS[:2] + [{"t2": dict(COMMENTS[2]["t2"], likeCount=8)}]
+    stats = client.save_documents("video", edited)
+
+    assert (stats["documents"], stats["skipped"]) == (1, 2)
+    assert client.last_write_stats is stats
+    assert client.get_document_by_id("video", "t2")["likeCount"] == 8
+
+
+def test_filters_on_indexed_and_other_fields(client):
+    client.save_documents("video", COMMENTS)
+
+    def texts(filters):
+        return sorted(document["text"] for document in client.get_documents_by_filters("video", filters))
+
+    assert texts([("parentId", "==", "t1")]) == ["reply"]
+    assert texts([("likeCount", ">=", 3)]) == ["first", "second"]
+    assert texts([("author", "in", ["bob"]), ("likeCount", "<", 5)]) == ["reply"]
+    assert texts([("author", "not-in", ["bob"])]) == ["first"]
+    assert texts([]) == ["first", "reply", "second"]
+    with pytest.raises(Exception):
+        texts([("likeCount", "array-contains", 3)])
+
+
+def test_collections_are_separate_tables(client):
+    client.save_document("video one", COMMENTS[0])
+
+    assert client.get_document_by_id("video two", "t1") is None
+    assert client.get_document_by_id("video one", "t1")["text"] == "first"
+
+
+def test_threads_use_their_own_connections(client):
+    errors = []
+
+    def save(offset):
+        try:
+            client.save_documents("video", [{f"c{offset}-{i}": {"author": "a", "text": "t"}} for i in range(50)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(client.get_documents_by_filters("video", [])) == 200
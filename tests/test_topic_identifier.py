@@ -0,0 +1,209 @@
+import multiprocessing
+import threading
+
+import gensim
+import numpy as np
+import pytest
+
+import comment_analysis.topic_identifier as topic_identifier
+from comment_analysis.topic_identifier import TopicIdentifier
+
+VOCABULARIES = [
+    ["apple", "banana", "cherry", "grape", "mango", "melon", "peach", "plum"],
+    ["guitar", "piano", "violin", "drums", "trumpet", "flute", "cello", "harp"],
+    ["soccer", "tennis", "hockey", "rugby", "cricket", "boxing", "skiing", "rowing"],
+]
+
+
+def make_texts(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(VOCABULARIES[i % 3], 6)) for i in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def topic_data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(topic_identifier, "TOPIC_DATA_DIR", str(tmp_path / "topics"))
+    # gensim initializes the models from numpy's global random state
+    np.random.seed(0)
+
+
+@pytest.fixture(autouse=True)
+def worker_pool(monkeypatch):
+    monkeypatch.setattr(topic_identifier, "_worker_pool", None)
+    yield
+    if topic_identifier._worker_pool is not None:
+        topic_identifier._worker_pool.terminate()
+
+
+def topic_vocabularies(result):
+    return sorted(
+        next(index for index, vocabulary in enumerate(VOCABULARIES) if set(words) <= set(vocabulary))
+        for words in result.words
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_topics_are_recovered(monkeypatch, workers):
+    monkeypatch.setattr(TopicIdentifier, "_workers", staticmethod(lambda: workers))
+    model = TopicIdentifier(make_texts(1500))
+    model.identify_topics(num_topics=3)
+
+    result = model.extract_topics(num_words=3)
+
+    assert topic_vocabularies(result) == [0, 1, 2]
+    assert result.document_topics.shape == (1500, 3)
+
+
+def test_trainings_share_one_worker_pool_and_stop_on_convergence(monkeypatch):
+    pools = []
+    create_pool = multiprocessing.Pool
+
+    def pool(*args, **kwargs):
+        pools.append(args)
+        return create_pool(*args, **kwargs)
+
+    evaluations = []
+    log_perplexity = gensim.models.LdaModel.log_perplexity
+
+    def evaluate(self, *args, **kwargs):
+        evaluations.append(args)
+        return log_perplexity(self, *args, **kwargs)
+
+    def train(seed):
+        model = TopicIdentifier(make_texts(600, seed=seed))
+        model.identify_topics(num_topics=3)
+        results.append(model.extract_topics())
+
+    monkeypatch.setattr(TopicIdentifier, "_workers", staticmethod(lambda: 2))
+    monkeypatch.setattr(topic_identifier.multiprocessing, "Pool", pool)
+    monkeypatch.setattr(gensim.models.LdaModel, "log_perplexity", evaluate)
+    results = []
+    threads = [threading.Thread(target=train, args=(seed,)) for seed in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 2
+    assert pools == [(2,)]
+    # the bound is evaluated once per pass of every training
+    assert 4 <= len(evaluations) < 2 * topic_identifier.MAX_PASSES
+
+
+def test_models_are_trained_once_per_number_of_topics(monkeypatch):
+    trainings = []
+    create_lda_model = TopicIdentifier._create_lda_model
+    monkeypatch.setattr(TopicIdentifier, "_create_lda_model",
+                        lambda self, num_topics: trainings.append(num_topics) or create_lda_model(self, num_topics))
+    model = TopicIdentifier(make_texts(300))
+
+    for num_topics in (3, 3, 4, 3):
+        model.identify_topics(num_topics=num_topics)
+        model.extract_topics()
+
+    assert trainings == [3, 4]
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    counters = {"trainings": 0, "tokenized": 0}
+    create_lda_model = TopicIdentifier._create_lda_model
+    tokenize = topic_identifier._tokenize
+
+    def count_training(self, num_topics):
+        counters["trainings"] += 1
+        return create_lda_model(self, num_topics)
+
+    def count_tokenized(texts):
+        counters["tokenized"] += len(texts)
+        return tokenize(texts)
+
+    monkeypatch.setattr(TopicIdentifier, "_workers", staticmethod(lambda: 1))
+    monkeypatch.setattr(TopicIdentifier, "_create_lda_model", count_training)
+    monkeypatch.setattr(topic_identifier, "_tokenize", count_tokenized)
+    return counters
+
+
+def video_topics(texts, num_topics=3):
+    model = TopicIdentifier()
+    model.set_texts(texts, video_id="video")
+    model.identify_topics(num_topics=num_topics)
+    return model.extract_topics(num_words=3)
+
+
+def video_files(tmp_path):
+    return sorted(path.name for path in (tmp_path / "topics" / "video").iterdir())
+
+
+def test_same_texts_in_another_order_reuse_the_corpus_and_models(counters):
+    texts = make_texts(300)
+    result = video_topics(texts)
+    order = np.random.default_rng(1).permutation(len(texts))
+    counters.update(trainings=0, tokenized=0)
+
+    reordered = video_topics([texts[position] for position in order])
+
+    assert counters == {"trainings": 0, "tokenized": 0}
+    np.testing.assert_allclose(reordered.document_topics, result.document_topics[order], atol=1e-6)
+
+
+def test_new_texts_are_appended_and_update_the_models(counters, tmp_path):
+    texts = make_texts(300)
+    video_topics(texts)
+    first_shard = (tmp_path / "topics" / "video" / "corpus-0.mm").read_bytes()
+    counters.update(trainings=0, tokenized=0)
+
+    new_texts = make_texts(30, seed=1)
+    result = video_topics(new_texts[:10] + texts + new_texts[10:])
+
+    assert counters == {"trainings": 0, "tokenized": 30}
+    assert result.document_topics.shape == (330, 3)
+    assert (tmp_path / "topics" / "video" / "corpus-0.mm").read_bytes() == first_shard
+    assert "corpus-1.mm" in video_files(tmp_path)
+
+    counters.update(trainings=0, tokenized=0)
+    video_topics(texts + new_texts)
+    assert counters == {"trainings": 0, "tokenized": 0}
+
+
+def test_update_texts_keeps_the_corpus_keyed_on_its_texts(counters):
+    texts = make_texts(300)
+    new_texts = make_texts(30, seed=1)
+    model = TopicIdentifier()
+    model.set_texts(texts, video_id="video")
+    model.identify_topics(num_topics=3)
+    model.extract_topics()
+    model.update_texts(new_texts, video_id="video")
+    assert model.extract_topics().document_topics.shape == (330, 3)
+    counters.update(trainings=0, tokenized=0)
+
+    video_topics(new_texts + texts)
+
+    assert counters == {"trainings": 0, "tokenized": 0}
+
+
+def test_deleted_texts_rebuild_the_corpus_and_delete_the_previous_models(counters, tmp_path):
+    texts = make_texts(300)
+    video_topics(texts)
+    assert "lda-3.gensim" in video_files(tmp_path)
+    counters.update(trainings=0, tokenized=0)
+
+    model = TopicIdentifier()
+    model.set_texts(texts[1:], video_id="video")
+
+    assert counters == {"trainings": 0, "tokenized": 299}
+    assert not [name for name in video_files(tmp_path) if name.startswith("lda-")]
+    model.identify_topics(num_topics=3)
+    assert model.extract_topics().document_topics.shape == (299, 3)
+    assert counters["trainings"] == 1
+
+
+def test_parallel_tokenization_keeps_the_order_of_the_texts(monkeypatch):
+    monkeypatch.setattr(TopicIdentifier, "_workers", staticmethod(lambda: 2))
+    monkeypatch.setattr(topic_identifier, "PARALLEL_PREPROCESSING_MIN_TEXTS", 10)
+    monkeypatch.setattr(topic_identifier, "PREPROCESSING_CHUNK_SIZE", 7)
+    texts = make_texts(100)
+
+    tokens = [tokens for chunk in TopicIdentifier()._tokenize_chunks(texts) for tokens in chunk]
+
+    assert tokens == topic_identifier._tokenize(texts)
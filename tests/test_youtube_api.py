@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+from apis.youtube.youtube_api import YouTubeAPI
+
+# replies of every thread, by thread index
+REPLY_COUNTS = [0, 2, 7, 0, 130, 1, 5]
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeResource:
+    def __init__(self, list_fn):
+        self.list_fn = list_fn
+
+    def list(self, **parameters):
+        return FakeRequest(self.list_fn(**parameters))
+
+
+def comment_snippet(text):
+    return {"authorDisplayName": "author", "textDisplay": text, "likeCount": 0,
+            "publishedAt": "2023-01-01T00:00:00Z"}
+
+
+def reply_resource(thread, reply):
+    return {"id": f"t{thread}.t{thread}r{reply}", "snippet": comment_snippet(f"reply {thread}.{reply}")}
+
+
+class FakeService:
+    """
+    Serves REPLY_COUNTS threads, two per page, with at most 2 inline replies per thread and 50 replies per page
+    """
+
+    def __init__(self):
+        self.reply_requests = []
+        self._lock = threading.Lock()
+
+    def commentThreads(self):
+        return FakeResource(self._threads)
+
+    def comments(self):
+        return FakeResource(self._replies)
+
+    def _threads(self, pageToken=None, maxResults=100, **parameters):
+        start = int(pageToken or 0)
+        end = min(start + 2, len(REPLY_COUNTS))
+        items = [{
+            "id": f"t{thread}",
+            "snippet": {"totalReplyCount": REPLY_COUNTS[thread],
+                        "topLevelComment": {"snippet": comment_snippet(f"thread {thread}")}},
+            "replies": {"comments": [reply_resource(thread, reply) for reply in range(min(2, REPLY_COUNTS[thread]))]},
+        } for thread in range(start, end)]
+        response = {"items": items}
+        if end < len(REPLY_COUNTS):
+            response["nextPageToken"] = str(end)
+        return response
+
+    def _replies(self, parentId, pageToken=None, **parameters):
+        with self._lock:
+            self.reply_requests.append(parentId)
+        thread = int(parentId[1:])
+        start = int(pageToken or 0)
+        end = min(start + 50, REPLY_COUNTS[thread])
+        response = {"items": [reply_resource(thread, reply) for reply in range(start, end)]}
+        if end < REPLY_COUNTS[thread]:
+            response["nextPageToken"] = str(end)
+        return response
+
+
+def expected_ids():
+    threads = [f"t{thread}" for thread in range(len(REPLY_COUNTS))]
+    inline = [f"t{thread}r{reply}" for thread, count in enumerate(REPLY_COUNTS) if count <= 2 for reply in range(count)]
+    fetched = [f"t{thread}r{reply}" for thread, count in enumerate(REPLY_COUNTS) if count > 2 for reply in range(count)]
+    return threads, inline, fetched
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_every_reply_page_is_fetched(max_workers):
+    service = FakeService()
+
+    store = YouTubeAPI(service=service).fetch_comment_threads("video", max_workers=max_workers)
+
+    threads, inline, fetched = expected_ids()
+    assert len(store) == len(threads) + len(inline) + len(fetched)
+    assert sorted(service.reply_requests) == ["t2", "t4", "t4", "t4", "t6"]
+    assert store.replies("t4").tolist() == [f"t4r{reply}" for reply in range(130)]
+    assert store.replies("t1").tolist() == ["t1r0", "t1r1"]
+    assert store["t4r129"]["parentId"] == "t4"
+
+
+def test_fetched_replies_follow_the_order_of_their_threads():
+    store = YouTubeAPI(service=FakeService()).fetch_comment_threads("video", max_workers=4)
+
+    reply_parents = [parent for parent in store.parent_ids if parent is not None]
+    fetched_parents = [parent for parent in reply_parents if parent in ("t2", "t4", "t6")]
+    assert fetched_parents == sorted(fetched_parents, key=lambda parent: int(parent[1:]))
+
+
+def test_streamed_pages_hold_every_comment():
+    pages = list(YouTubeAPI(service=FakeService()).stream_comment_threads("video", max_workers=2))
+
+    ids = [comment_id for page in pages for comment_id in page.ids]
+    threads, inline, fetched = expected_ids()
+    assert sorted(ids) == sorted(threads + inline + fetched)
+    assert pages[0].ids.tolist() == ["t0", "t1", "t1r0", "t1r1"]